@@ -0,0 +1,108 @@
+"""
+Append-only buffers dùng chung giữa các phiên bản state (copy-on-write không phải copy)
+
+- Writer chỉ ghi vào phần dư sau độ dài đã publish, rồi mới tăng độ dài; khi đầy thì
+  cấp phát buffer mới gấp đôi (cùng cách với buffer embeddings / mã int8)
+- Reader đọc độ dài trước rồi mới đọc buffer, và tự giới hạn theo kích thước của
+  state mà nó đang giữ, nên không bao giờ thấy dòng của state mới hơn
+- Dùng cho documents của VectorDBState và posting lists của MetadataIndex / BM25Index:
+  insert 1 document tốn O(kích thước document), không phải O(corpus)
+"""
+from itertools import islice
+from typing import Iterable, Iterator, List, Sequence
+
+import numpy as np
+
+
+class GrowableArray:
+    """Mảng numpy chỉ append (1 hoặc nhiều cột), capacity tăng gấp đôi khi đầy"""
+
+    __slots__ = ("data", "size")
+
+    def __init__(self, columns: int = 1, dtype=np.int64, capacity: int = 4):
+        shape = (capacity,) if columns == 1 else (capacity, columns)
+        self.data = np.empty(shape, dtype=dtype)
+        self.size = 0
+
+    def append(self, values) -> None:
+        values = np.asarray(values, dtype=self.data.dtype)
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            capacity = max(needed, 2 * len(self.data))
+            grown = np.empty((capacity,) + self.data.shape[1:], dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            grown[self.size:needed] = values
+            # Buffer mới đã đủ dữ liệu trước khi được gán; size tăng sau cùng
+            self.data = grown
+        else:
+            self.data[self.size:needed] = values
+        self.size = needed
+
+    def view(self) -> np.ndarray:
+        """Các phần tử đã append (đọc size trước buffer: buffer luôn chứa đủ size phần tử)"""
+        size = self.size
+        return self.data[:size]
+
+    def truncated(self, size: int) -> "GrowableArray":
+        """Bản sao độc lập chỉ gồm size phần tử đầu"""
+        clone = GrowableArray(1 if self.data.ndim == 1 else self.data.shape[1], self.data.dtype, max(4, size))
+        clone.append(self.data[:size])
+        return clone
+
+
+def rows_before(rows: np.ndarray, limit: int) -> np.ndarray:
+    """Phần đầu của posting list (row ids tăng dần) có row < limit"""
+    if len(rows) and rows[-1] >= limit:
+        return rows[:np.searchsorted(rows, limit)]
+    return rows
+
+
+class AppendOnlyList(Sequence):
+    """
+    List chỉ append dùng chung giữa các state
+
+    copy() là O(1): bản sao dùng chung list bên dưới và chỉ thấy _size phần tử đầu.
+    """
+
+    __slots__ = ("_items", "_size")
+
+    def __init__(self, items: Iterable = ()):
+        self._items = list(items)
+        self._size = len(self._items)
+
+    def copy(self) -> "AppendOnlyList":
+        clone = AppendOnlyList.__new__(AppendOnlyList)
+        clone._items = self._items
+        clone._size = self._size
+        return clone
+
+    def extend(self, values: Iterable) -> None:
+        if len(self._items) != self._size:
+            # List bên dưới đã bị 1 bản sao khác append tiếp (vd: write lỗi không được publish)
+            self._items = self._items[:self._size]
+        self._items.extend(values)
+        self._size = len(self._items)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._size)
+            if step == 1:
+                return self._items[start:stop]
+            return [self._items[i] for i in range(start, stop, step)]
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("AppendOnlyList index out of range")
+        return self._items[index]
+
+    def __iter__(self) -> Iterator:
+        return islice(self._items, self._size)
+
+    def __bool__(self) -> bool:
+        return self._size > 0
+
+    def tolist(self) -> List:
+        return self._items[:self._size]
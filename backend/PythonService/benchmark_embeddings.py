@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark embedding model local: PyTorch (SentenceTransformer) vs ONNX fp32 vs ONNX int8
+
+Đo trên CPU cho cùng model và cùng bộ câu:
+- latency 1 query (p50/p95/p99, như search / chọn credential)
+- throughput theo batch (câu/giây, như ingest documents)
+- độ khớp embeddings so với PyTorch (cosine nhỏ nhất / trung bình)
+
+Cần sentence-transformers, onnxruntime, transformers (export ONNX lần đầu cần thêm onnx).
+
+Chạy:
+    python benchmark_embeddings.py --threads 1,2,4 --queries 200 --batch-size 32
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVICE_DIR)
+
+from model_registry import DEFAULT_EMBEDDING_MODEL
+from onnx_encoder import PROBE_SENTENCES, OnnxSentenceEncoder, cosine_rows, load_onnx_encoder, model_dir_for
+from benchmark_vector_db import percentiles
+
+SENTENCE_TEMPLATES = [
+    "Xem thời khóa biểu tuần {i}",
+    "Điểm môn học số {i} của tôi là bao nhiêu?",
+    "Giải thích khái niệm đạo hàm trong bài giảng {i}",
+    "How do I submit assignment {i} before the deadline?",
+    "Gửi email cho giảng viên về đồ án nhóm {i}",
+    "Tài liệu ôn thi cuối kỳ môn Cấu trúc dữ liệu chương {i}, gồm cây nhị phân, bảng băm và đồ thị",
+    "Netflix account number {i} for movies",
+    "Lịch thi học kỳ {i} ở phòng máy tầng 3",
+]
+
+
+def make_sentences(count: int):
+    return [SENTENCE_TEMPLATES[i % len(SENTENCE_TEMPLATES)].format(i=i) for i in range(count)]
+
+
+def bench_model(model, queries, corpus, batch_size: int):
+    """(percentiles latency 1 query, câu/giây khi encode corpus theo batch)"""
+    model.encode(queries[:4])  # warm-up
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        model.encode(query)
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    model.encode(corpus, batch_size=batch_size)
+    throughput = len(corpus) / (time.perf_counter() - start)
+    return percentiles(latencies), throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PyTorch vs ONNX sentence embeddings on CPU")
+    parser.add_argument("--model", default=DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument("--onnx-dir", default=os.getenv("EMBED_ONNX_DIR", "onnx_models"))
+    parser.add_argument("--threads", default="0", help="Danh sách số thread onnxruntime, vd: 1,2,4 (0 = mặc định)")
+    parser.add_argument("--queries", type=int, default=200, help="Số query đo latency")
+    parser.add_argument("--corpus", type=int, default=1000, help="Số câu đo throughput")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    queries = make_sentences(args.queries)
+    corpus = make_sentences(args.corpus)
+    check = PROBE_SENTENCES + corpus[:200]
+
+    print("=" * 72)
+    print("📊 Embedding backend benchmark")
+    print(f"   model={args.model} cpu={os.cpu_count()} torch threads={torch.get_num_threads()}")
+    print(f"   queries={args.queries} corpus={args.corpus} batch={args.batch_size}")
+    print("=" * 72)
+
+    torch_model = SentenceTransformer(args.model, device="cpu")
+    reference = torch_model.encode(check, convert_to_numpy=True)
+    rows = [("torch", "-", *bench_model(torch_model, queries, corpus, args.batch_size), 1.0, 1.0)]
+
+    # Export (fp32 + int8) 1 lần rồi đo từng biến thể với từng số thread
+    load_onnx_encoder(args.model, base_dir=args.onnx_dir, quantize=True, min_cosine=0.0)
+    model_dir = model_dir_for(args.onnx_dir, args.model)
+    for quantized in (False, True):
+        for threads in (int(t) for t in args.threads.split(",")):
+            encoder = OnnxSentenceEncoder(model_dir, quantized=quantized, num_threads=threads)
+            cosines = cosine_rows(reference, encoder.encode(check))
+            latency, throughput = bench_model(encoder, queries, corpus, args.batch_size)
+            name = "onnx-int8" if quantized else "onnx-fp32"
+            rows.append((name, threads or "auto", latency, throughput, float(cosines.min()), float(cosines.mean())))
+
+    print(f"\n{'backend':<10} {'threads':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sent/s':>9} {'min cos':>8} {'mean cos':>9}")
+    for name, threads, latency, throughput, min_cos, mean_cos in rows:
+        print(
+            f"{name:<10} {threads:>7} {latency['p50']:>8.2f} {latency['p95']:>8.2f} {latency['p99']:>8.2f} "
+            f"{throughput:>9.1f} {min_cos:>8.4f} {mean_cos:>9.4f}"
+        )
+    print("-" * 72)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark SimpleVectorDB: latency search (p50/p95/p99) khi đang bulk ingest
+
+So sánh 3 kịch bản trên cùng 1 corpus tổng hợp (không gọi Gemini API):
+1. idle:        chỉ có các reader thread search liên tục
+2. ingest:      reader + 1 writer thread add_documents liên tục (copy-on-write state)
+3. global-lock: như (2) nhưng search và add_documents dùng chung 1 mutex
+                (mô phỏng cách làm không có reader-writer model)
+
+Embedder tổng hợp sinh vector ngẫu nhiên theo hash của text và sleep --embed-latency
+giây cho mỗi batch ingest để mô phỏng round trip tới embedding API.
+
+Chạy:
+    python benchmark_vector_db.py --docs 20000 --dim 768 --readers 4 --duration 10
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SyntheticEmbedder:
+    """Embedder giả lập cùng interface với EmbeddingBatcher.embed"""
+
+    def __init__(self, dim: int, ingest_latency: float = 0.0):
+        self.dim = dim
+        self.ingest_latency = ingest_latency
+
+    def _vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+
+    def embed(self, texts, task_type="retrieval_document", on_progress=None):
+        if task_type == "retrieval_document" and self.ingest_latency:
+            time.sleep(self.ingest_latency)
+        embeddings = [self._vector(text).tolist() for text in texts]
+        if on_progress:
+            on_progress(len(texts), len(texts))
+        return {"embeddings": embeddings, "failed": [], "errors": []}
+
+
+class GlobalLockDB:
+    """Bọc SimpleVectorDB bằng 1 mutex cho cả đọc lẫn ghi (baseline để so sánh)"""
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+
+    def search(self, *args, **kwargs):
+        with self.lock:
+            return self.db.search(*args, **kwargs)
+
+    def add_documents(self, *args, **kwargs):
+        with self.lock:
+            return self.db.add_documents(*args, **kwargs)
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    values = np.asarray(samples) * 1000
+    return {
+        "count": len(values),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max())
+    }
+
+
+def run_scenario(db, readers: int, duration: float, ingest: bool, batch_size: int, n_results: int):
+    """Chạy reader threads (+ writer nếu ingest) trong `duration` giây"""
+    stop = threading.Event()
+    latencies = [[] for _ in range(readers)]
+    ingested = [0]
+
+    def reader(slot: int):
+        rng = np.random.default_rng(slot)
+        while not stop.is_set():
+            query = f"câu hỏi số {rng.integers(1_000_000)}"
+            start = time.perf_counter()
+            db.search(query, n_results)
+            latencies[slot].append(time.perf_counter() - start)
+
+    def writer():
+        batch = 0
+        while not stop.is_set():
+            documents = [f"tài liệu ingest {batch}-{i}" for i in range(batch_size)]
+            metadatas = [{"category": "benchmark", "source": "ingest"} for _ in documents]
+            db.add_documents(documents, metadatas)
+            ingested[0] += batch_size
+            batch += 1
+
+    threads = [threading.Thread(target=reader, args=(slot,), daemon=True) for slot in range(readers)]
+    if ingest:
+        threads.append(threading.Thread(target=writer, daemon=True))
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    stats = percentiles([value for slot in latencies for value in slot])
+    stats["ingested"] = ingested[0]
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark search latency under concurrent ingestion")
+    parser.add_argument("--docs", type=int, default=20000, help="Số documents ban đầu")
+    parser.add_argument("--dim", type=int, default=768, help="Số chiều embedding")
+    parser.add_argument("--readers", type=int, default=4, help="Số thread search song song")
+    parser.add_argument("--duration", type=float, default=10.0, help="Thời gian mỗi kịch bản (giây)")
+    parser.add_argument("--batch-size", type=int, default=200, help="Số documents mỗi lần add_documents")
+    parser.add_argument("--embed-latency", type=float, default=0.2, help="Độ trễ giả lập mỗi batch ingest (giây)")
+    parser.add_argument("--n-results", type=int, default=5)
+    args = parser.parse_args()
+
+    # Import main trong thư mục tạm để vector_db mặc định của app không đụng tới knowledge_base.json thật
+    workdir = tempfile.mkdtemp(prefix="vector_db_bench_")
+    os.chdir(workdir)
+    sys.path.insert(0, SERVICE_DIR)
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    os.environ.setdefault("EMBED_CACHE_FILE", os.path.join(workdir, "embedding_cache.sqlite3"))
+    from main import SimpleVectorDB
+
+    print("=" * 60)
+    print("📊 SimpleVectorDB concurrency benchmark")
+    print(f"   docs={args.docs} dim={args.dim} readers={args.readers} duration={args.duration}s")
+    print(f"   ingest batch={args.batch_size} embed latency={args.embed_latency}s")
+    print("=" * 60)
+
+    results = {}
+    for name, ingest, locked in (("idle", False, False), ("ingest", True, False), ("global-lock", True, True)):
+        embedder = SyntheticEmbedder(args.dim, ingest_latency=args.embed_latency)
+        db = SimpleVectorDB(
+            storage_file=os.path.join(workdir, f"{name}.json"),
+            compact_every=10 ** 9,
+            embedder=embedder
+        )
+        db.add_documents(
+            [f"tài liệu {i}" for i in range(args.docs)],
+            [{"category": f"c{i % 10}", "source": "seed"} for i in range(args.docs)]
+        )
+        target = GlobalLockDB(db) if locked else db
+        print(f"\n▶️  {name} ...")
+        results[name] = run_scenario(target, args.readers, args.duration, ingest, args.batch_size, args.n_results)
+
+    print("\n" + "-" * 60)
+    print(f"{'scenario':<12} {'searches':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'ingested':>9}")
+    for name, stats in results.items():
+        print(
+            f"{name:<12} {stats['count']:>9} {stats['p50']:>8.2f} {stats['p95']:>8.2f} "
+            f"{stats['p99']:>8.2f} {stats['max']:>8.2f} {stats['ingested']:>9}"
+        )
+    print("-" * 60)
+
+
+if __name__ == "__main__":
+    main()
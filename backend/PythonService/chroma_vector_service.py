@@ -4,24 +4,79 @@ Sử dụng ChromaDB với HNSW index cho performance tối ưu
 """
 import chromadb
 from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
+import asyncio
+import json
 import os
-from typing import List, Dict, Optional
+import re
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple, Union
 import logging
 
+import numpy as np
+
+from dedupe import SimHashIndex, simhash
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from model_registry import DEFAULT_EMBEDDING_MODEL, get_model_registry
+from pagination import clamp_page_size, decode_cursor, encode_cursor, export_record
+from query_batcher import QueryMicroBatcher
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+HYBRID_CANDIDATE_FACTOR = 4  # Hybrid: số ứng viên mỗi nguồn = n_results * factor
+CURSOR_SCAN_BATCH = 1000  # Số ID mỗi lần dò ngược tìm id cuối trang trước (get_documents_page)
+INGEST_BATCH_SIZE = 64
+INGEST_WORKERS = 2
+DEDUPE_MODES = ("skip", "merge")
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class IngestJobCompletedError(Exception):
+    """job_id đã được dùng cho 1 job ingest chạy xong (không resume được)"""
+
+
+def validate_job_id(job_id: str) -> str:
+    """job_id chỉ gồm chữ, số, "_" và "-" (được dùng làm tên file checkpoint)"""
+    if not isinstance(job_id, str) or not JOB_ID_PATTERN.match(job_id):
+        raise ValueError(f"Invalid job_id: {job_id!r} (allowed: letters, digits, '_' and '-')")
+    return job_id
+
+
+def iter_jsonl_documents(path: str) -> Iterator[Dict]:
+    """Đọc file JSONL ({"document", "metadata"?, "id"?} mỗi dòng) theo kiểu stream cho ingest_stream()"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
 
 class ChromaVectorService:
     """Production-grade vector service với ChromaDB"""
     
-    def __init__(self, persist_directory: str = "./chroma_db"):
+    def __init__(
+        self,
+        persist_directory: str = "./chroma_db",
+        query_batch_window_ms: float = 5.0,
+        query_batch_max_size: int = 32,
+        dedupe_similarity: float = 0.95,
+        dedupe_simhash_distance: int = 3
+    ):
         """
         Initialize ChromaDB với persistent storage
         
         Args:
             persist_directory: Thư mục lưu trữ database
+            query_batch_window_ms: Thời gian gom các query đồng thời trước khi encode chung
+            query_batch_max_size: Số query tối đa mỗi lần encode
+            dedupe_similarity: Cosine tối thiểu để coi 2 documents là gần trùng
+            dedupe_simhash_distance: Số bit SimHash khác nhau tối đa để coi là gần trùng (< 4)
         """
         self.persist_directory = persist_directory
         
@@ -34,11 +89,13 @@ class ChromaVectorService:
             )
         )
         
-        # Initialize embedding model
-        # Sử dụng model đa ngôn ngữ (Vietnamese + English)
-        logger.info("Loading embedding model...")
-        self.embedding_model = SentenceTransformer(
-            'paraphrase-multilingual-MiniLM-L12-v2'
+        # Embedding model đa ngôn ngữ (Vietnamese + English), load lười và dùng chung qua registry
+        self.model_name = DEFAULT_EMBEDDING_MODEL
+        # Query của các request đồng thời được encode chung 1 batch (CPU hiệu quả hơn nhiều)
+        self.query_batcher = QueryMicroBatcher(
+            self._encode_queries,
+            window_ms=query_batch_window_ms,
+            max_batch=query_batch_max_size
         )
         
         # Get or create collection
@@ -50,13 +107,28 @@ class ChromaVectorService:
             }
         )
         
+        # BM25 index trên nội dung documents, dựng lười ở lần tìm lexical/hybrid đầu tiên
+        # (lock: search_async chạy search trong executor, song song với add / delete)
+        self.lexical_index = BM25Index()
+        self._lexical_ids: Optional[List[str]] = None
+        self._lexical_rows: Dict[str, int] = {}
+        self._lexical_lock = threading.Lock()
+        
+        # Fingerprint SimHash để chặn documents gần trùng khi insert, dựng lười ở lần dedupe đầu tiên
+        # (mọi thao tác đọc / sửa fingerprints giữ _dedupe_lock)
+        self.dedupe_similarity = dedupe_similarity
+        self.fingerprints = SimHashIndex(max_distance=dedupe_simhash_distance)
+        self._fingerprints_ready = False
+        self._dedupe_lock = threading.Lock()
+        
         logger.info(f"✅ ChromaDB initialized: {self.collection.count()} documents")
     
     def add_documents(
         self,
         documents: List[str],
         metadatas: Optional[List[Dict]] = None,
-        ids: Optional[List[str]] = None
+        ids: Optional[List[str]] = None,
+        dedupe: Optional[str] = None
     ) -> Dict:
         """
         Thêm documents vào vector database
@@ -65,36 +137,35 @@ class ChromaVectorService:
             documents: List văn bản cần thêm
             metadatas: Metadata cho mỗi document
             ids: IDs tùy chỉnh (auto-generate nếu None)
+            dedupe: None (thêm tất cả), "skip" (bỏ documents gần trùng) hoặc
+                "merge" (bỏ và tăng metadata "duplicates" của document đã có)
         
         Returns:
-            Dict với status và count
+            Dict với status, count (số đã thêm) và skipped (số bị bỏ do trùng)
         """
         try:
-            # Generate IDs if not provided
+            # Generate IDs if not provided (uuid: không trùng khi nhiều request add cùng lúc)
             if ids is None:
-                start_id = self.collection.count()
-                ids = [f"doc_{start_id + i}" for i in range(len(documents))]
+                ids = [f"doc_{uuid.uuid4().hex}" for _ in documents]
             
             # Generate embeddings
-            embeddings = self.embedding_model.encode(
-                documents,
-                show_progress_bar=False,
-                convert_to_numpy=True
-            ).tolist()
+            embeddings = self._encode_documents(documents)
             
             # Add to ChromaDB
-            self.collection.add(
-                documents=documents,
-                embeddings=embeddings,
-                metadatas=metadatas or [{"source": "manual"} for _ in documents],
-                ids=ids
+            added, skipped = self._insert(
+                ids,
+                documents,
+                embeddings,
+                metadatas or [{"source": "manual"} for _ in documents],
+                dedupe=dedupe
             )
             
-            logger.info(f"✅ Added {len(documents)} documents to ChromaDB")
+            logger.info(f"✅ Added {added} documents to ChromaDB" + (f" ({skipped} near-duplicates skipped)" if skipped else ""))
             
             return {
                 "status": "success",
-                "count": len(documents),
+                "count": added,
+                "skipped": skipped,
                 "total_documents": self.collection.count()
             }
         
@@ -105,11 +176,421 @@ class ChromaVectorService:
                 "message": str(e)
             }
     
+    @property
+    def embedding_model(self):
+        """SentenceTransformer dùng chung (load ở lần encode đầu tiên)"""
+        return get_model_registry().get(self.model_name)
+    
+    def _encode_queries(self, queries: List[str]) -> List[List[float]]:
+        """Encode 1 batch queries (gọi từ worker thread của query_batcher)"""
+        return self.embedding_model.encode(
+            queries,
+            show_progress_bar=False,
+            convert_to_numpy=True
+        ).tolist()
+    
+    def _encode_documents(self, documents: List[str]) -> List[List[float]]:
+        return self.embedding_model.encode(
+            documents,
+            show_progress_bar=False,
+            convert_to_numpy=True
+        ).tolist()
+    
+    def _insert(
+        self,
+        ids: List[str],
+        documents: List[str],
+        embeddings: List[List[float]],
+        metadatas: List[Dict],
+        dedupe: Optional[str] = None,
+        upsert: bool = False
+    ) -> Tuple[int, int]:
+        """Ghi 1 batch (add hoặc upsert), lọc documents gần trùng nếu có dedupe; trả về (số đã ghi, số bị bỏ)"""
+        if dedupe is not None and dedupe not in DEDUPE_MODES:
+            raise ValueError(f"Invalid dedupe mode: {dedupe}. Use one of {DEDUPE_MODES}")
+        write = self.collection.upsert if upsert else self.collection.add
+        if dedupe is None:
+            write(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+            self._index_lexical(ids, documents)
+            # Kiểm tra ready trong lock: không lọt documents khi _ensure_fingerprints đang dựng dở
+            with self._dedupe_lock:
+                if self._fingerprints_ready:
+                    for doc_id, doc in zip(ids, documents):
+                        self.fingerprints.add(doc_id, simhash(doc))
+            return len(ids), 0
+        
+        # Kiểm tra + ghi trong 1 lock: 2 request đồng thời không cùng lọt cùng 1 nội dung
+        with self._dedupe_lock:
+            matches, fingerprints = self._find_duplicates(ids, documents, embeddings)
+            keep = [i for i, match in enumerate(matches) if match is None]
+            if keep:
+                kept_ids = [ids[i] for i in keep]
+                kept_docs = [documents[i] for i in keep]
+                write(
+                    ids=kept_ids,
+                    documents=kept_docs,
+                    embeddings=[embeddings[i] for i in keep],
+                    metadatas=[metadatas[i] for i in keep]
+                )
+                self._index_lexical(kept_ids, kept_docs)
+                for i in keep:
+                    self.fingerprints.add(ids[i], fingerprints[i])
+            if dedupe == "merge":
+                # Trùng với chính nó (upsert lại khi resume ingest) thì không tính
+                self._merge_duplicates(Counter(
+                    match[0] for i, match in enumerate(matches) if match and match[0] != ids[i]
+                ))
+        return len(keep), len(ids) - len(keep)
+    
+    def _ensure_fingerprints(self):
+        """Dựng SimHash index từ collection nếu chưa có"""
+        if self._fingerprints_ready:
+            return
+        self.fingerprints.reset()
+        for record in self.iter_documents():
+            self.fingerprints.add(record['id'], simhash(record.get('document') or ""))
+        self._fingerprints_ready = True
+        logger.info(f"Built SimHash index over {len(self.fingerprints)} documents")
+    
+    def _find_duplicates(
+        self,
+        ids: List[str],
+        documents: List[str],
+        embeddings: List[List[float]]
+    ) -> Tuple[List[Optional[Tuple[str, str]]], List[int]]:
+        """
+        Tìm document gần trùng cho từng document mới
+        
+        1. SimHash (không cần query Chroma): gần như trùng nguyên văn
+        2. Nearest neighbour trong Chroma: cosine >= dedupe_similarity (diễn đạt lại)
+        3. Các document đứng trước trong cùng batch (SimHash + cosine)
+        
+        Returns:
+            ([(id document trùng, "simhash" | "embedding") hoặc None], fingerprints)
+        """
+        self._ensure_fingerprints()
+        fingerprints = [simhash(doc) for doc in documents]
+        matches: List[Optional[Tuple[str, str]]] = [None] * len(documents)
+        for i, fingerprint in enumerate(fingerprints):
+            nearest = self.fingerprints.nearest(fingerprint)
+            if nearest is not None:
+                matches[i] = (nearest[0], "simhash")
+        
+        pending = [i for i, match in enumerate(matches) if match is None]
+        if pending and self.collection.count():
+            results = self.collection.query(
+                query_embeddings=[embeddings[i] for i in pending],
+                n_results=1,
+                include=["distances"]
+            )
+            for i, neighbour_ids, distances in zip(pending, results['ids'], results['distances']):
+                # Cosine distance = 1 - cosine similarity
+                if neighbour_ids and 1 - distances[0] >= self.dedupe_similarity:
+                    matches[i] = (neighbour_ids[0], "embedding")
+        
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1)
+        unit = vectors / np.where(norms > 0, norms, 1)[:, None]
+        batch_fingerprints = SimHashIndex(self.fingerprints.max_distance, self.fingerprints.bands)
+        kept: List[int] = []
+        for i in range(len(documents)):
+            if matches[i] is None:
+                nearest = batch_fingerprints.nearest(fingerprints[i])
+                if nearest is not None:
+                    matches[i] = (nearest[0], "simhash")
+                elif kept:
+                    similarities = unit[kept] @ unit[i]
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.dedupe_similarity:
+                        matches[i] = (ids[kept[best]], "embedding")
+            if matches[i] is None:
+                kept.append(i)
+                batch_fingerprints.add(ids[i], fingerprints[i])
+        return matches, fingerprints
+    
+    def _merge_duplicates(self, counts: Dict[str, int]):
+        """Cộng số bản trùng đã gộp vào metadata "duplicates" của document được giữ lại"""
+        if not counts:
+            return
+        existing = self.collection.get(ids=list(counts), include=["metadatas"])
+        if not existing['ids']:
+            return
+        self.collection.update(
+            ids=existing['ids'],
+            metadatas=[
+                {**(metadata or {}), "duplicates": int((metadata or {}).get("duplicates", 0)) + counts[doc_id]}
+                for doc_id, metadata in zip(existing['ids'], existing['metadatas'])
+            ]
+        )
+    
+    def compact_duplicates(self, batch_size: int = 256, dry_run: bool = False) -> Dict:
+        """
+        Job offline: gộp các documents gần trùng đang có trong collection
+        
+        Duyệt collection theo thứ tự lưu trữ; document nào gần trùng (SimHash hoặc
+        cosine >= dedupe_similarity) với 1 document đã giữ trước đó thì bị xóa và
+        được cộng vào metadata "duplicates" của document giữ lại.
+        
+        Args:
+            batch_size: Số documents đọc / query mỗi lần
+            dry_run: Chỉ đếm, không xóa
+        """
+        start = time.perf_counter()
+        kept_fingerprints = SimHashIndex(self.fingerprints.max_distance, self.fingerprints.bands)
+        kept = set()
+        duplicate_of: Dict[str, str] = {}
+        scanned = 0
+        
+        records = self.iter_documents(batch_size=batch_size, include_embeddings=True)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            scanned += len(batch)
+            neighbours = self.collection.query(
+                query_embeddings=[record['embedding'] for record in batch],
+                n_results=min(5, self.collection.count()),
+                include=["distances"]
+            )
+            for record, neighbour_ids, distances in zip(batch, neighbours['ids'], neighbours['distances']):
+                fingerprint = simhash(record.get('document') or "")
+                nearest = kept_fingerprints.nearest(fingerprint)
+                target = nearest[0] if nearest is not None else None
+                if target is None:
+                    target = next((
+                        neighbour for neighbour, distance in zip(neighbour_ids, distances)
+                        if neighbour in kept and 1 - distance >= self.dedupe_similarity
+                    ), None)
+                if target is None:
+                    kept.add(record['id'])
+                    kept_fingerprints.add(record['id'], fingerprint)
+                else:
+                    duplicate_of[record['id']] = target
+        
+        if duplicate_of and not dry_run:
+            with self._dedupe_lock:
+                dropped = list(duplicate_of)
+                for i in range(0, len(dropped), batch_size):
+                    self.collection.delete(ids=dropped[i:i + batch_size])
+                self._merge_duplicates(Counter(duplicate_of.values()))
+                self._invalidate_lexical_index()
+                self._fingerprints_ready = False
+                self.fingerprints.reset()
+        
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"✅ Duplicate compaction{' (dry run)' if dry_run else ''}: "
+            f"{len(duplicate_of)} of {scanned} documents are near-duplicates ({elapsed:.1f}s)"
+        )
+        return {
+            "status": "success",
+            "dry_run": dry_run,
+            "scanned": scanned,
+            "duplicates": len(duplicate_of),
+            "deleted": 0 if dry_run else len(duplicate_of),
+            "elapsed_seconds": round(elapsed, 3),
+            "total_documents": self.collection.count()
+        }
+    
+    def _index_lexical(self, ids: List[str], documents: List[str]):
+        """Cập nhật BM25 index (nếu đã dựng) sau khi insert"""
+        with self._lexical_lock:
+            if self._lexical_ids is None:
+                return
+            if any(doc_id in self._lexical_rows for doc_id in ids):
+                # Upsert ghi đè documents đã có: dựng lại ở lần tìm lexical sau
+                self._reset_lexical_index()
+                return
+            self._lexical_rows.update((doc_id, len(self._lexical_ids) + i) for i, doc_id in enumerate(ids))
+            self._lexical_ids.extend(ids)
+            self.lexical_index.add(documents)
+    
+    def _checkpoint_path(self, job_id: str) -> str:
+        validate_job_id(job_id)
+        return os.path.join(self.persist_directory, "ingest_jobs", f"{job_id}.json")
+    
+    def get_ingest_job(self, job_id: str) -> Optional[Dict]:
+        """Checkpoint của 1 job ingest (None nếu chưa có)"""
+        path = self._checkpoint_path(job_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def _save_checkpoint(self, checkpoint: Dict):
+        path = self._checkpoint_path(checkpoint["job_id"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    
+    def ingest_stream(
+        self,
+        documents: Iterable[Union[str, Dict]],
+        batch_size: int = INGEST_BATCH_SIZE,
+        workers: int = INGEST_WORKERS,
+        job_id: Optional[str] = None,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        dedupe: Optional[str] = None
+    ) -> Dict:
+        """
+        Ingest 1 luồng documents (iterator) theo batch cố định
+        
+        - Chỉ giữ tối đa 2 * workers batch trong RAM; worker pool encode song song,
+          batch được upsert vào ChromaDB theo đúng thứ tự ngay khi encode xong
+        - ID = <job_id>_<batch>_<vị trí> (hoặc "id" của item): không trùng giữa các job
+          và giống hệt khi chạy lại, nên upsert lại 1 batch không tạo bản sao
+        - Sau mỗi batch ghi checkpoint; gọi lại với cùng job_id và cùng luồng input
+          sẽ bỏ qua các batch đã commit và chạy tiếp từ batch lỗi
+        
+        Args:
+            documents: Iterator các str hoặc dict {"document", "metadata"?, "id"?}
+            batch_size: Số documents mỗi batch (job resume dùng batch_size trong checkpoint)
+            workers: Số thread encode song song
+            job_id: ID job để resume (mặc định: sinh mới)
+            on_progress: Callback(số documents đã commit, số batch đã commit)
+            dedupe: None / "skip" / "merge" (xem add_documents)
+        
+        Returns:
+            Dict status / job_id / count / skipped (gần trùng, như add_documents) /
+            already_committed (documents đã commit ở lần chạy trước) / batches / docs_per_second
+            (status "error" kèm resume_from_batch nếu dừng giữa chừng)
+        
+        Raises:
+            ValueError: job_id không hợp lệ
+            IngestJobCompletedError: job_id thuộc 1 job đã chạy xong
+        """
+        job_id = validate_job_id(job_id) if job_id else f"ingest_{uuid.uuid4().hex[:12]}"
+        checkpoint = self.get_ingest_job(job_id) or {
+            "job_id": job_id, "batch_size": batch_size, "committed_batches": 0, "documents": 0, "completed": False
+        }
+        if checkpoint.get("completed"):
+            raise IngestJobCompletedError(f"Ingest job {job_id} already completed; use a new job_id")
+        if checkpoint["batch_size"] != batch_size:
+            logger.warning(f"⚠️ Job {job_id} resumes with its original batch_size={checkpoint['batch_size']}")
+            batch_size = checkpoint["batch_size"]
+        resume_from = checkpoint["committed_batches"]
+        already_committed = checkpoint["documents"]
+        
+        def batches():
+            items = iter(documents)
+            while True:
+                batch = list(islice(items, batch_size))
+                if not batch:
+                    return
+                yield [
+                    (item, {"source": "ingest"}, None) if isinstance(item, str)
+                    else (item["document"], item.get("metadata") or {"source": "ingest"}, item.get("id"))
+                    for item in batch
+                ]
+        
+        start = time.perf_counter()
+        inserted = 0
+        skipped = 0
+        pending = deque()
+        
+        def commit_next():
+            nonlocal skipped
+            index, batch, future = pending.popleft()
+            embeddings = future.result()
+            ids = [doc_id or f"{job_id}_{index:06d}_{i:04d}" for i, (_, _, doc_id) in enumerate(batch)]
+            written, duplicates = self._insert(
+                ids,
+                [doc for doc, _, _ in batch],
+                embeddings,
+                [metadata for _, metadata, _ in batch],
+                dedupe=dedupe,
+                upsert=True
+            )
+            skipped += duplicates
+            checkpoint["committed_batches"] = index + 1
+            checkpoint["documents"] += len(batch)
+            self._save_checkpoint(checkpoint)
+            if on_progress:
+                on_progress(checkpoint["documents"], checkpoint["committed_batches"])
+            return written
+        
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            try:
+                for index, batch in enumerate(batches()):
+                    if index < resume_from:
+                        continue
+                    texts = [doc for doc, _, _ in batch]
+                    pending.append((index, batch, pool.submit(self._encode_documents, texts)))
+                    if len(pending) >= 2 * max(1, workers):
+                        inserted += commit_next()
+                while pending:
+                    inserted += commit_next()
+            except Exception as e:
+                for _, _, future in pending:
+                    future.cancel()
+                logger.error(f"❌ Ingest job {job_id} stopped at batch {checkpoint['committed_batches']}: {e}")
+                return {
+                    "status": "error",
+                    "job_id": job_id,
+                    "message": str(e),
+                    "count": inserted,
+                    "resume_from_batch": checkpoint["committed_batches"],
+                    "total_documents": self.collection.count()
+                }
+        
+        elapsed = time.perf_counter() - start
+        checkpoint["completed"] = True
+        self._save_checkpoint(checkpoint)
+        logger.info(f"✅ Ingest job {job_id}: {inserted} documents in {elapsed:.1f}s ({inserted / elapsed if elapsed else 0:.1f} docs/s)")
+        return {
+            "status": "success",
+            "job_id": job_id,
+            "count": inserted,
+            "skipped": skipped,
+            "already_committed": already_committed,
+            "batches": checkpoint["committed_batches"],
+            "elapsed_seconds": round(elapsed, 3),
+            "docs_per_second": round(inserted / elapsed, 1) if elapsed else None,
+            "total_documents": self.collection.count()
+        }
+    
+    def _ensure_lexical_index(self):
+        """Dựng BM25 index từ collection nếu chưa có / đã bị invalidate (gọi khi đang giữ _lexical_lock)"""
+        if self._lexical_ids is not None:
+            return
+        results = self.collection.get(include=["documents"])
+        self._lexical_ids = list(results['ids'])
+        self._lexical_rows = {doc_id: row for row, doc_id in enumerate(self._lexical_ids)}
+        self.lexical_index.rebuild([doc or "" for doc in results['documents']])
+        logger.info(f"Built BM25 index over {len(self._lexical_ids)} documents")
+    
+    def _reset_lexical_index(self):
+        self._lexical_ids = None
+        self._lexical_rows = {}
+        self.lexical_index.reset()
+    
+    def _invalidate_lexical_index(self):
+        with self._lexical_lock:
+            self._reset_lexical_index()
+    
+    def _lexical_search(self, query: str, n_results: int, where: Optional[Dict] = None):
+        """(IDs, điểm BM25) top BM25 (không gọi embedding model)"""
+        allowed = self.collection.get(where=where, include=[])['ids'] if where else None
+        with self._lexical_lock:
+            self._ensure_lexical_index()
+            rows = None
+            if allowed is not None:
+                rows = np.asarray(
+                    sorted(self._lexical_rows[doc_id] for doc_id in allowed if doc_id in self._lexical_rows),
+                    dtype=np.int64
+                )
+            top_rows, top_scores = self.lexical_index.search(query, n_results, rows)
+            return [self._lexical_ids[row] for row in top_rows], [float(score) for score in top_scores]
+    
     def search(
         self,
         query: str,
         n_results: int = 5,
-        where: Optional[Dict] = None
+        where: Optional[Dict] = None,
+        mode: str = "vector",
+        query_embedding: Optional[List[float]] = None
     ) -> Dict:
         """
         Tìm kiếm semantic với ChromaDB
@@ -118,45 +599,161 @@ class ChromaVectorService:
             query: Câu hỏi/query
             n_results: Số kết quả trả về
             where: Filter metadata (vd: {"category": "programming"})
+            mode: "vector" (HNSW), "lexical" (BM25, không encode query)
+                hoặc "hybrid" (trộn thứ hạng BM25 + vector bằng RRF)
+            query_embedding: Embedding đã encode sẵn (mặc định: encode qua micro-batcher)
         
         Returns:
-            Dict với documents, distances, metadatas
+            Dict với documents, distances, metadatas (lexical/hybrid có thêm scores)
         """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}', expected one of {SEARCH_MODES}")
+        empty = {"documents": [], "distances": [], "metadatas": [], "ids": []}
+        if mode != "vector":
+            empty["scores"] = []
         try:
-            # Generate query embedding
-            query_embedding = self.embedding_model.encode(
-                query,
-                show_progress_bar=False,
-                convert_to_numpy=True
-            ).tolist()
+            if mode == "lexical":
+                ids, scores = self._lexical_search(query, n_results, where)
+                results = self._get_ordered(ids)
+                results["scores"] = scores
+                return results
+            
+            # Generate query embedding (gom batch với các request đồng thời)
+            if query_embedding is None:
+                query_embedding = self.query_batcher.encode(query)
             
             # Search in ChromaDB
             results = self.collection.query(
                 query_embeddings=[query_embedding],
-                n_results=n_results,
+                n_results=n_results if mode == "vector" else n_results * HYBRID_CANDIDATE_FACTOR,
                 where=where
             )
-            
-            return {
+            vector_results = {
                 "documents": results['documents'][0] if results['documents'] else [],
                 "distances": results['distances'][0] if results['distances'] else [],
                 "metadatas": results['metadatas'][0] if results['metadatas'] else [],
                 "ids": results['ids'][0] if results['ids'] else []
             }
+            if mode == "vector":
+                return vector_results
+            
+            # Hybrid: trộn thứ hạng, distance cosine tính lại cho các ids chỉ có ở BM25
+            lexical_ids, _ = self._lexical_search(query, n_results * HYBRID_CANDIDATE_FACTOR, where)
+            fused = reciprocal_rank_fusion([vector_results['ids'], lexical_ids])[:n_results]
+            ids = [doc_id for doc_id, _ in fused]
+            merged = self._get_ordered(ids, query_embedding)
+            known = dict(zip(vector_results['ids'], vector_results['distances']))
+            merged["distances"] = [
+                known.get(doc_id, distance) for doc_id, distance in zip(ids, merged["distances"])
+            ]
+            merged["scores"] = [score for _, score in fused]
+            return merged
         
         except Exception as e:
             logger.error(f"❌ Error searching: {e}")
-            return {
-                "documents": [],
-                "distances": [],
-                "metadatas": [],
-                "ids": []
-            }
+            return empty
+    
+    async def search_async(
+        self,
+        query: str,
+        n_results: int = 5,
+        where: Optional[Dict] = None,
+        mode: str = "vector"
+    ) -> Dict:
+        """search() cho async endpoint: chờ micro-batcher không chặn event loop, query ChromaDB trong thread pool"""
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}', expected one of {SEARCH_MODES}")
+        query_embedding = None
+        if mode != "lexical":
+            query_embedding = await self.query_batcher.encode_async(query)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, partial(self.search, query, n_results, where, mode, query_embedding)
+        )
+    
+    def _get_ordered(self, ids: List[str], query_embedding: Optional[List[float]] = None) -> Dict:
+        """
+        Lấy documents/metadatas theo đúng thứ tự ids
+        
+        Nếu có query_embedding, tính thêm cosine distance từ embeddings đã lưu.
+        """
+        if not ids:
+            return {"documents": [], "distances": [], "metadatas": [], "ids": []}
+        include = ["documents", "metadatas"] + (["embeddings"] if query_embedding is not None else [])
+        results = self.collection.get(ids=ids, include=include)
+        position = {doc_id: i for i, doc_id in enumerate(results['ids'])}
+        order = [position[doc_id] for doc_id in ids if doc_id in position]
+        distances = [None] * len(order)
+        if query_embedding is not None and order:
+            embeddings = np.asarray(results['embeddings'], dtype=np.float32)[order]
+            query = np.asarray(query_embedding, dtype=np.float32)
+            denom = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query)
+            similarities = np.divide(embeddings @ query, denom, out=np.zeros(len(order), dtype=np.float32), where=denom > 0)
+            distances = [float(1 - sim) for sim in similarities]
+        return {
+            "documents": [results['documents'][i] for i in order],
+            "distances": distances,
+            "metadatas": [results['metadatas'][i] for i in order],
+            "ids": [results['ids'][i] for i in order]
+        }
+    
+    def search_batch(
+        self,
+        queries: List[str],
+        n_results: int = 5,
+        where: Optional[Dict] = None
+    ) -> List[Dict]:
+        """
+        Tìm kiếm nhiều queries cùng lúc
+        
+        Encode tất cả queries trong 1 lần gọi model và gửi 1 collection.query
+        với nhiều query_embeddings (ChromaDB chấm điểm cả batch).
+        
+        Args:
+            queries: Danh sách câu hỏi/query
+            n_results: Số kết quả trả về cho mỗi query
+            where: Filter metadata áp dụng cho tất cả queries
+        
+        Returns:
+            List kết quả theo thứ tự queries, mỗi phần tử có dạng như search()
+        """
+        empty = {"documents": [], "distances": [], "metadatas": [], "ids": []}
+        if not queries:
+            return []
+        try:
+            query_embeddings = self.embedding_model.encode(
+                queries,
+                show_progress_bar=False,
+                convert_to_numpy=True
+            ).tolist()
+            
+            results = self.collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+                where=where
+            )
+            
+            return [
+                {
+                    "documents": results['documents'][i] if results['documents'] else [],
+                    "distances": results['distances'][i] if results['distances'] else [],
+                    "metadatas": results['metadatas'][i] if results['metadatas'] else [],
+                    "ids": results['ids'][i] if results['ids'] else []
+                }
+                for i in range(len(queries))
+            ]
+        
+        except Exception as e:
+            logger.error(f"❌ Error batch searching: {e}")
+            return [dict(empty) for _ in queries]
     
     def delete_documents(self, ids: List[str]) -> Dict:
         """Xóa documents theo IDs"""
         try:
             self.collection.delete(ids=ids)
+            self._invalidate_lexical_index()
+            with self._dedupe_lock:
+                for doc_id in ids:
+                    self.fingerprints.remove(doc_id)
             return {"status": "success", "deleted": len(ids)}
         except Exception as e:
             return {"status": "error", "message": str(e)}
@@ -169,6 +766,9 @@ class ChromaVectorService:
                 name="knowledge_base",
                 metadata={"hnsw:space": "cosine"}
             )
+            self._invalidate_lexical_index()
+            with self._dedupe_lock:
+                self.fingerprints.reset()
             return {"status": "success", "message": "All documents deleted"}
         except Exception as e:
             return {"status": "error", "message": str(e)}
@@ -194,6 +794,110 @@ class ChromaVectorService:
                 "ids": [],
                 "count": 0
             }
+    
+    def _get_rows(
+        self,
+        offset: int,
+        limit: int,
+        include_embeddings: bool = False,
+        include_documents: bool = True,
+        max_text_chars: Optional[int] = None
+    ) -> List[Dict]:
+        include = ["metadatas"]
+        if include_documents:
+            include.append("documents")
+        if include_embeddings:
+            include.append("embeddings")
+        results = self.collection.get(limit=limit, offset=offset, include=include)
+        embeddings = results.get('embeddings') if include_embeddings else None
+        return [
+            export_record(
+                doc_id,
+                results['documents'][i] if include_documents else "",
+                results['metadatas'][i],
+                embedding=embeddings[i] if embeddings is not None else None,
+                include_documents=include_documents,
+                max_text_chars=max_text_chars
+            )
+            for i, doc_id in enumerate(results['ids'])
+        ]
+    
+    def _cursor_offset(self, position: Dict) -> int:
+        """
+        Offset bắt đầu của trang sau cursor
+        
+        Cursor giữ (offset, id cuối trang trước). Chroma get() trả theo thứ tự thêm vào
+        và delete chỉ dồn các dòng lên trước, nên nếu dòng offset-1 không còn là id đó
+        thì dò ngược từ offset (chỉ lấy IDs) để tìm lại: không bỏ sót / lặp dòng khi
+        có delete giữa 2 trang.
+        """
+        offset = max(0, int(position.get("offset", 0)))
+        last_id = position.get("last_id")
+        if last_id is None or offset == 0:
+            return offset
+        # id cuối trang trước đã bị xóa: tiếp tục từ offset cũ
+        if not self.collection.get(ids=[last_id], include=[])['ids']:
+            return offset
+        end = offset
+        while end > 0:
+            begin = max(0, end - CURSOR_SCAN_BATCH)
+            ids = self.collection.get(limit=end - begin, offset=begin, include=[])['ids']
+            if last_id in ids:
+                return begin + ids.index(last_id) + 1
+            end = begin
+        return offset
+    
+    def get_documents_page(
+        self,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        include_embeddings: bool = False,
+        include_documents: bool = True,
+        max_text_chars: Optional[int] = None
+    ) -> Dict:
+        """
+        1 trang documents theo thứ tự thêm vào (cursor-based)
+        
+        Chroma không có keyset theo ID nên trang vẫn đọc bằng get(limit, offset):
+        chi phí tăng theo offset (phía SQLite), nhưng cursor kèm id cuối trang
+        để trang sau không lệch khi có delete (xem _cursor_offset).
+        
+        Returns:
+            Dict items / count / total / next_cursor (None = trang cuối)
+        
+        Raises:
+            ValueError: Cursor không hợp lệ
+        """
+        limit = clamp_page_size(limit)
+        offset = self._cursor_offset(decode_cursor(cursor))
+        items = self._get_rows(offset, limit, include_embeddings, include_documents, max_text_chars)
+        total = self.collection.count()
+        end = offset + len(items)
+        next_cursor = None
+        if items and end < total:
+            next_cursor = encode_cursor({"offset": end, "last_id": items[-1]['id']})
+        return {
+            "items": items,
+            "count": len(items),
+            "total": total,
+            "next_cursor": next_cursor
+        }
+    
+    def iter_documents(
+        self,
+        batch_size: int = 500,
+        include_embeddings: bool = False,
+        include_documents: bool = True,
+        max_text_chars: Optional[int] = None
+    ) -> Iterator[Dict]:
+        """Duyệt toàn bộ collection theo từng batch, mỗi lần sinh 1 record (cho export NDJSON)"""
+        offset = 0
+        while True:
+            rows = self._get_rows(offset, batch_size, include_embeddings, include_documents, max_text_chars)
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            offset += len(rows)
 
 
 # Singleton instance
@@ -204,7 +908,12 @@ def get_chroma_service() -> ChromaVectorService:
     """Get or create singleton instance"""
     global _chroma_service
     if _chroma_service is None:
-        _chroma_service = ChromaVectorService()
+        _chroma_service = ChromaVectorService(
+            query_batch_window_ms=float(os.getenv("QUERY_BATCH_WINDOW_MS", 5)),
+            query_batch_max_size=int(os.getenv("QUERY_BATCH_MAX_SIZE", 32)),
+            dedupe_similarity=float(os.getenv("DEDUPE_SIMILARITY", 0.95)),
+            dedupe_simhash_distance=int(os.getenv("DEDUPE_SIMHASH_DISTANCE", 3))
+        )
     return _chroma_service
 
 
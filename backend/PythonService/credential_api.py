@@ -6,6 +6,8 @@ Integrates with vector database for semantic search
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 from typing import List, Optional
+import threading
+import time
 try:
     from credential_vector_service import get_credential_vector_service
 except ImportError:
@@ -29,6 +31,16 @@ class AddCredentialRequest(BaseModel):
     tags: Optional[List[str]] = None
 
 
+class BulkAddCredentialRequest(BaseModel):
+    credentials: List[AddCredentialRequest]
+    batch_size: int = 64
+
+
+class ReembedRequest(BaseModel):
+    model_name: Optional[str] = None  # Mặc định: model hiện tại
+    batch_size: int = 256
+
+
 class SearchCredentialRequest(BaseModel):
     user_id: int
     query: str
@@ -87,6 +99,65 @@ async def add_credential_to_vector_db(request: AddCredentialRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/vector/add-bulk")
+def add_credentials_bulk(request: BulkAddCredentialRequest):
+    """
+    Thêm / cập nhật nhiều credential trong 1 request (encode theo batch, upsert theo chunk)
+    Dùng khi onboarding cả trường thay vì gọi /vector/add cho từng credential
+    """
+    service = get_credential_vector_service()
+    if not hasattr(service, "add_credentials_bulk"):
+        raise HTTPException(status_code=501, detail="Bulk upsert requires the ChromaDB credential service")
+    result = service.add_credentials_bulk(
+        [credential.model_dump() for credential in request.credentials],
+        batch_size=request.batch_size
+    )
+    return {"status": "success" if not result["failed"] else "partial", **result}
+
+
+# Job re-embed chạy nền (tối đa 1 job mỗi process)
+_reembed_job = {"status": "idle"}
+_reembed_lock = threading.Lock()
+
+
+def _run_reembed(service, model_name: Optional[str], batch_size: int):
+    def on_progress(done: int, total: int):
+        _reembed_job.update(done=done, total=total)
+
+    try:
+        result = service.reembed_all(model_name=model_name, batch_size=batch_size, on_progress=on_progress)
+        _reembed_job.update(status="completed", result=result, finished_at=time.time())
+    except Exception as e:
+        logger.error(f"Credential re-embedding failed: {e}")
+        _reembed_job.update(status="failed", error=str(e), finished_at=time.time())
+
+
+@router.post("/vector/reembed")
+async def start_reembed(request: ReembedRequest):
+    """Bắt đầu job tính lại embeddings của mọi credential (vd: sau khi đổi model)"""
+    service = get_credential_vector_service()
+    if not hasattr(service, "reembed_all"):
+        raise HTTPException(status_code=501, detail="Re-embedding requires the ChromaDB credential service")
+    with _reembed_lock:
+        if _reembed_job["status"] == "running":
+            raise HTTPException(status_code=409, detail="A re-embedding job is already running")
+        _reembed_job.clear()
+        _reembed_job.update(status="running", model_name=request.model_name, done=0, total=None, started_at=time.time())
+    threading.Thread(
+        target=_run_reembed,
+        args=(service, request.model_name, request.batch_size),
+        name="credential-reembed",
+        daemon=True
+    ).start()
+    return dict(_reembed_job)
+
+
+@router.get("/vector/reembed/status")
+async def get_reembed_status():
+    """Tiến độ job re-embed (done / total, kết quả hoặc lỗi khi xong)"""
+    return dict(_reembed_job)
+
+
 @router.post("/vector/search", response_model=List[CredentialSearchResult])
 async def semantic_search_credentials(request: SearchCredentialRequest):
     """
@@ -171,6 +242,15 @@ async def get_credential_count(user_id: int):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/vector/cache-stats")
+async def get_credential_cache_stats():
+    """Cache ma trận credential theo user + cache kết quả chọn credential (hit/miss)"""
+    service = get_credential_vector_service()
+    if not hasattr(service, "cache_stats"):
+        return {"enabled": False}
+    return service.cache_stats()
+
+
 @router.post("/ai/select-credential")
 async def ai_select_credential(request: SearchCredentialRequest):
     """
@@ -4,21 +4,189 @@ Provides semantic search for credentials using embeddings
 """
 
 import os
-from typing import List, Dict, Optional
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Dict, Optional, Tuple
 import chromadb
 from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
 import logging
 
+import numpy as np
+
+from model_registry import DEFAULT_EMBEDDING_MODEL, get_model_registry
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+COLLECTION_NAME = "user_credentials"
+SIMILAR_TABLE_K = 10  # Số credential giống nhất được tính sẵn cho mỗi credential
+
+
+def credential_text(purpose: str, description: Optional[str] = None, tags: Optional[List[str]] = None) -> str:
+    """Văn bản được embed cho 1 credential"""
+    combined_text = f"{purpose}"
+    if description:
+        combined_text += f". {description}"
+    if tags:
+        combined_text += f". Tags: {', '.join(tags)}"
+    return combined_text
+
+
+def credential_metadata(
+    credential_id: int,
+    user_id: int,
+    service_name: str,
+    purpose: str,
+    category: str = "OTHER",
+    tags: Optional[List[str]] = None
+) -> Dict:
+    metadata = {
+        "user_id": user_id,
+        "credential_id": credential_id,
+        "service_name": service_name,
+        "category": category,
+        "purpose": purpose[:500],  # Limit length
+    }
+    if tags:
+        metadata["tags"] = ",".join(tags)
+    return metadata
+
+
+class UserCredentialIndex:
+    """
+    Embeddings (ma trận n x dim) + metadata các credential của 1 user, dùng để chấm điểm trong RAM
+    
+    Kèm bảng similar: top SIMILAR_TABLE_K credential giống nhất của từng credential.
+    Index không bị sửa sau khi tạo: upserted() / removed() trả về index mới và chỉ
+    tính lại các dòng bảng similar bị ảnh hưởng.
+    """
+    
+    def __init__(
+        self,
+        ids: List[str],
+        embeddings,
+        documents: List[str],
+        metadatas: List[Dict],
+        similar: Optional[Dict[str, List[Tuple[str, float]]]] = None
+    ):
+        self.ids = ids
+        self.rows = {doc_id: row for row, doc_id in enumerate(ids)}
+        self.documents = documents
+        self.metadatas = metadatas
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        self.matrix = matrix.reshape(len(ids), -1) if len(ids) else np.zeros((0, 0), dtype=np.float32)
+        self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.loaded_at = time.monotonic()
+        if similar is None:
+            similar = self._similar_table()
+        self.similar = similar
+    
+    def scores(self, query_embedding: np.ndarray) -> np.ndarray:
+        """
+        1 - squared L2 distance tới query: cùng thang điểm với collection.query
+        (collection dùng metric mặc định l2 của Chroma)
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        return 1 - (self.sq_norms - 2 * (self.matrix @ query) + query @ query)
+    
+    def _ranked(self, row: int, scores: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """Top-k (id, score) theo scores của dòng `row`, bỏ chính nó"""
+        scores = scores.copy()
+        scores[row] = -np.inf
+        order = np.argsort(-scores, kind='stable')[:min(k, len(self.ids) - 1)]
+        return [(self.ids[i], float(scores[i])) for i in order]
+    
+    def top_similar(self, doc_id: str, k: int = SIMILAR_TABLE_K) -> List[Tuple[str, float]]:
+        row = self.rows[doc_id]
+        return self._ranked(row, self.scores(self.matrix[row]), k)
+    
+    def _similar_table(self) -> Dict[str, List[Tuple[str, float]]]:
+        # Toàn bộ n x n điểm trong 1 phép nhân ma trận (n nhỏ: vài chục credential)
+        pairwise = 1 - (self.sq_norms[:, None] + self.sq_norms[None, :] - 2 * (self.matrix @ self.matrix.T))
+        return {doc_id: self._ranked(row, pairwise[row], SIMILAR_TABLE_K) for row, doc_id in enumerate(self.ids)}
+    
+    def _patched_similar(self, previous: Dict, changed: set, removed: set):
+        """
+        Cập nhật bảng similar sau khi các id `changed` đổi embedding và các id `removed` bị xóa
+        
+        Dòng của id không đổi: bỏ các mục changed/removed rồi chèn điểm mới của changed.
+        Nếu dòng đang đầy (k mục) mà bị mất mục, ứng viên thay thế có thể nằm ngoài bảng
+        nên tính lại cả dòng (O(n)).
+        """
+        changed_scores = {doc_id: self.scores(self.matrix[self.rows[doc_id]]) for doc_id in changed}
+        stale = changed | removed
+        similar = {doc_id: self._ranked(self.rows[doc_id], changed_scores[doc_id], SIMILAR_TABLE_K) for doc_id in changed}
+        for doc_id, row in self.rows.items():
+            if doc_id in changed:
+                continue
+            entries = previous.get(doc_id, [])
+            kept = [entry for entry in entries if entry[0] not in stale]
+            if len(kept) < len(entries) and len(entries) == SIMILAR_TABLE_K:
+                similar[doc_id] = self.top_similar(doc_id)
+                continue
+            kept.extend((other, float(changed_scores[other][row])) for other in changed)
+            kept.sort(key=lambda entry: -entry[1])
+            similar[doc_id] = kept[:SIMILAR_TABLE_K]
+        return similar
+    
+    def upserted(self, ids: List[str], embeddings, documents: List[str], metadatas: List[Dict]) -> "UserCredentialIndex":
+        """Index mới sau khi thêm / cập nhật các credential"""
+        new_ids, new_docs, new_metas = list(self.ids), list(self.documents), list(self.metadatas)
+        rows = [np.asarray(embedding, dtype=np.float32) for embedding in self.matrix]
+        for doc_id, embedding, document, metadata in zip(ids, embeddings, documents, metadatas):
+            row = self.rows.get(doc_id)
+            if row is None:
+                new_ids.append(doc_id)
+                new_docs.append(document)
+                new_metas.append(metadata)
+                rows.append(np.asarray(embedding, dtype=np.float32))
+            else:
+                new_docs[row] = document
+                new_metas[row] = metadata
+                rows[row] = np.asarray(embedding, dtype=np.float32)
+        index = UserCredentialIndex(new_ids, np.asarray(rows), new_docs, new_metas, similar={})
+        index.similar = index._patched_similar(self.similar, set(ids), set())
+        index.loaded_at = self.loaded_at
+        return index
+    
+    def removed(self, ids: set) -> "UserCredentialIndex":
+        """Index mới sau khi xóa các credential"""
+        keep = [row for row, doc_id in enumerate(self.ids) if doc_id not in ids]
+        index = UserCredentialIndex(
+            [self.ids[row] for row in keep],
+            self.matrix[keep],
+            [self.documents[row] for row in keep],
+            [self.metadatas[row] for row in keep],
+            similar={}
+        )
+        index.similar = index._patched_similar(self.similar, set(), set(ids))
+        index.loaded_at = self.loaded_at
+        return index
+
 
 class CredentialVectorService:
     """Service for managing credential embeddings and semantic search"""
     
-    def __init__(self, persist_directory: str = "./chroma_credentials"):
-        """Initialize vector database and embedding model"""
+    def __init__(
+        self,
+        persist_directory: str = "./chroma_credentials",
+        selection_cache_ttl: float = 60.0,
+        selection_cache_size: int = 1024,
+        index_ttl: float = 300.0,
+        max_cached_users: int = 1000
+    ):
+        """
+        Initialize vector database and embedding model
+        
+        Args:
+            persist_directory: Thư mục lưu ChromaDB
+            selection_cache_ttl: Giây giữ kết quả search của cùng (user, query) (0 = tắt cache)
+            selection_cache_size: Số kết quả search tối đa được cache
+            index_ttl: Giây giữ ma trận credential của 1 user trước khi đọc lại từ Chroma
+                (giới hạn độ trễ khi worker khác thêm / xóa credential)
+            max_cached_users: Số user tối đa giữ ma trận trong RAM (LRU)
+        """
         self.persist_directory = persist_directory
         
         # Initialize ChromaDB
@@ -29,14 +197,39 @@ class CredentialVectorService:
         
         # Get or create collection
         self.collection = self.client.get_or_create_collection(
-            name="user_credentials",
+            name=COLLECTION_NAME,
             metadata={"description": "User credentials with semantic search"}
         )
         
-        # Initialize embedding model
-        self.model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+        # Embedding model dùng chung với ChromaVectorService, load ở lần encode đầu tiên
+        self.model_name = DEFAULT_EMBEDDING_MODEL
+        
+        # Ma trận credential theo user (load lười) + cache kết quả search theo (user, query).
+        # Generation của user tăng khi add/delete: index và kết quả cache cũ không còn được dùng.
+        # _user_ids: tập ID credential theo user, cập nhật cùng mỗi thay đổi -> đếm O(1),
+        # không phụ thuộc TTL của index.
+        self.selection_cache_ttl = selection_cache_ttl
+        self.selection_cache_size = selection_cache_size
+        self.index_ttl = index_ttl
+        self.max_cached_users = max_cached_users
+        self._user_indexes: "OrderedDict[int, UserCredentialIndex]" = OrderedDict()
+        self._selection_cache: "OrderedDict[Tuple, Tuple[float, List[Dict]]]" = OrderedDict()
+        self._user_ids: "OrderedDict[int, set]" = OrderedDict()
+        self._generations: Dict[int, int] = {}
+        self._cache_lock = threading.Lock()
+        # Ghi vào collection (add / delete / bulk upsert) tuần tự với reembed_all:
+        # ghi trong lúc job chạy sẽ dùng model cũ hoặc rơi vào collection sắp bị thay
+        self._write_lock = threading.RLock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.index_loads = 0
         logger.info("CredentialVectorService initialized successfully")
     
+    @property
+    def model(self):
+        """SentenceTransformer dùng chung từ registry"""
+        return get_model_registry().get(self.model_name)
+    
     def add_credential(
         self,
         credential_id: int,
@@ -50,35 +243,28 @@ class CredentialVectorService:
         """Add or update credential in vector database"""
         try:
             # Combine text for embedding
-            combined_text = f"{purpose}"
-            if description:
-                combined_text += f". {description}"
-            if tags:
-                combined_text += f". Tags: {', '.join(tags)}"
-            
-            # Generate embedding
-            embedding = self.model.encode(combined_text).tolist()
+            combined_text = credential_text(purpose, description, tags)
             
             # Prepare metadata
-            metadata = {
-                "user_id": user_id,
-                "credential_id": credential_id,
-                "service_name": service_name,
-                "category": category,
-                "purpose": purpose[:500],  # Limit length
-            }
+            metadata = credential_metadata(credential_id, user_id, service_name, purpose, category, tags)
             
-            if tags:
-                metadata["tags"] = ",".join(tags)
-            
-            # Add to collection
             doc_id = f"cred_{user_id}_{credential_id}"
-            self.collection.upsert(
-                ids=[doc_id],
-                embeddings=[embedding],
-                documents=[combined_text],
-                metadatas=[metadata]
-            )
+            with self._write_lock:
+                # Generate embedding
+                embedding = self.model.encode(combined_text).tolist()
+                
+                # Add to collection
+                self.collection.upsert(
+                    ids=[doc_id],
+                    embeddings=[embedding],
+                    documents=[combined_text],
+                    metadatas=[metadata]
+                )
+                self._apply_change(
+                    user_id,
+                    lambda index: index.upserted([doc_id], [embedding], [combined_text], [metadata]),
+                    added=[doc_id]
+                )
             
             logger.info(f"Added credential {credential_id} to vector DB")
             return True
@@ -87,6 +273,182 @@ class CredentialVectorService:
             logger.error(f"Error adding credential to vector DB: {e}")
             return False
     
+    def add_credentials_bulk(
+        self,
+        credentials: List[Dict],
+        batch_size: int = 64,
+        chunk_size: int = 512
+    ) -> Dict:
+        """
+        Thêm / cập nhật nhiều credential (vd: onboarding cả 1 trường)
+        
+        Encode theo batch và upsert vào Chroma theo từng chunk, thay cho N lần
+        add_credential(). Chunk lỗi không làm mất các chunk đã upsert.
+        Cùng 1 credential xuất hiện nhiều lần trong 1 chunk thì lấy lần cuối
+        (Chroma từ chối upsert có ID trùng trong cùng 1 lần gọi).
+        
+        Args:
+            credentials: List dict cùng field với add_credential()
+            batch_size: Số câu mỗi batch encode
+            chunk_size: Số credential mỗi lần upsert
+        
+        Returns:
+            Dict với upserted, failed (kèm lỗi từng credential / chunk) và throughput
+        """
+        start = time.perf_counter()
+        upserted = 0
+        failed = []
+        for chunk_start in range(0, len(credentials), chunk_size):
+            chunk = credentials[chunk_start:chunk_start + chunk_size]
+            rows: Dict[str, Tuple[str, Dict]] = {}
+            for offset, item in enumerate(chunk):
+                try:
+                    text = credential_text(item['purpose'], item.get('description'), item.get('tags'))
+                    metadata = credential_metadata(
+                        item['credential_id'],
+                        item['user_id'],
+                        item['service_name'],
+                        item['purpose'],
+                        item.get('category') or "OTHER",
+                        item.get('tags')
+                    )
+                except (KeyError, TypeError) as e:
+                    failed.append({"index": chunk_start + offset, "error": f"Invalid credential: {e}"})
+                    continue
+                doc_id = f"cred_{item['user_id']}_{item['credential_id']}"
+                # pop rồi gán lại: ID trùng giữ vị trí của lần xuất hiện cuối
+                rows.pop(doc_id, None)
+                rows[doc_id] = (text, metadata)
+            ids = list(rows)
+            texts = [text for text, _ in rows.values()]
+            metadatas = [metadata for _, metadata in rows.values()]
+            if not ids:
+                continue
+            with self._write_lock:
+                try:
+                    embeddings = np.asarray(self.model.encode(texts, batch_size=batch_size, show_progress_bar=False)).tolist()
+                    self.collection.upsert(
+                        ids=ids,
+                        embeddings=embeddings,
+                        documents=texts,
+                        metadatas=metadatas
+                    )
+                    upserted += len(ids)
+                except Exception as e:
+                    logger.error(f"Error upserting credential chunk at {chunk_start}: {e}")
+                    failed.append({"index": chunk_start, "count": len(ids), "error": str(e)})
+                    # Không biết chunk đã ghi tới đâu: bỏ index + số đếm đã cache
+                    for user_id in {metadata['user_id'] for metadata in metadatas}:
+                        self.invalidate_user(user_id)
+                    continue
+                by_user: Dict[int, List[int]] = {}
+                for row, metadata in enumerate(metadatas):
+                    by_user.setdefault(metadata['user_id'], []).append(row)
+                for user_id, user_rows in by_user.items():
+                    self._apply_change(
+                        user_id,
+                        lambda index, rows=user_rows: index.upserted(
+                            [ids[row] for row in rows],
+                            [embeddings[row] for row in rows],
+                            [texts[row] for row in rows],
+                            [metadatas[row] for row in rows]
+                        ),
+                        added=[ids[row] for row in user_rows]
+                    )
+        
+        elapsed = time.perf_counter() - start
+        logger.info(f"Bulk upserted {upserted} credentials in {elapsed:.1f}s ({len(failed)} failures)")
+        return {
+            "upserted": upserted,
+            "failed": failed,
+            "elapsed_seconds": round(elapsed, 3),
+            "credentials_per_second": round(upserted / elapsed, 1) if elapsed else None
+        }
+    
+    def reembed_all(
+        self,
+        model_name: Optional[str] = None,
+        batch_size: int = 256,
+        on_progress: Optional[Callable[[int, int], None]] = None
+    ) -> Dict:
+        """
+        Job offline: tính lại embeddings của mọi credential (vd: sau khi đổi model)
+        
+        Đọc collection theo trang, encode lại văn bản đã lưu và cập nhật embeddings.
+        Model mới khác số chiều thì ghi sang collection tạm rồi đổi tên thay collection cũ
+        (Chroma không cho trộn số chiều trong 1 collection).
+        Add / delete / bulk upsert chờ tới khi job xong (giữ _write_lock suốt job):
+        không ghi nào bị mất khi đổi collection hoặc bị embed bằng model cũ.
+        
+        Args:
+            model_name: Model dùng để embed (mặc định: model hiện tại); thành công thì service dùng model này
+            batch_size: Số credential mỗi lần đọc / encode / ghi
+            on_progress: Callback(số credential đã xong, tổng số)
+        """
+        model_name = model_name or self.model_name
+        model = get_model_registry().get(model_name)
+        with self._write_lock:
+            total = self.collection.count()
+            start = time.perf_counter()
+            
+            current_dim = None
+            sample = self.collection.get(limit=1, include=["embeddings"])
+            if sample['ids'] and sample['embeddings'] is not None:
+                current_dim = len(sample['embeddings'][0])
+            new_dim = model.get_sentence_embedding_dimension()
+            in_place = current_dim is None or current_dim == new_dim
+            target = self.collection
+            if not in_place:
+                staging_name = f"{COLLECTION_NAME}_reembed"
+                try:
+                    self.client.delete_collection(staging_name)
+                except Exception:
+                    pass
+                target = self.client.create_collection(name=staging_name, metadata=self.collection.metadata)
+            
+            done = 0
+            while done < total:
+                page = self.collection.get(limit=batch_size, offset=done, include=["documents", "metadatas"])
+                if not page['ids']:
+                    break
+                embeddings = np.asarray(
+                    model.encode([doc or "" for doc in page['documents']], batch_size=batch_size, show_progress_bar=False)
+                ).tolist()
+                if in_place:
+                    target.update(ids=page['ids'], embeddings=embeddings)
+                else:
+                    target.upsert(ids=page['ids'], embeddings=embeddings, documents=page['documents'], metadatas=page['metadatas'])
+                done += len(page['ids'])
+                elapsed = time.perf_counter() - start
+                logger.info(f"Re-embedded {done}/{total} credentials ({done / elapsed if elapsed else 0:.1f}/s)")
+                if on_progress:
+                    on_progress(done, total)
+            
+            # Trỏ service sang collection mới (cùng model mới) trước, rồi mới xóa collection cũ:
+            # request đến sau lúc này không bao giờ dùng collection đã bị xóa
+            with self._cache_lock:
+                self.collection = target
+                self.model_name = model_name
+                for user_id in list(self._generations) + list(self._user_indexes):
+                    self._generations[user_id] = self._generations.get(user_id, 0) + 1
+                self._user_indexes.clear()
+                self._user_ids.clear()
+                self._selection_cache.clear()
+            if not in_place:
+                self.client.delete_collection(COLLECTION_NAME)
+                target.modify(name=COLLECTION_NAME)
+        
+        elapsed = time.perf_counter() - start
+        return {
+            "model": model_name,
+            "reembedded": done,
+            "total": total,
+            "dimension": new_dim,
+            "rebuilt_collection": not in_place,
+            "elapsed_seconds": round(elapsed, 3),
+            "credentials_per_second": round(done / elapsed, 1) if elapsed else None
+        }
+    
     def search_credentials(
         self,
         user_id: int,
@@ -107,47 +469,142 @@ class CredentialVectorService:
             List of matching credentials with relevance scores
         """
         try:
-            # Generate query embedding
-            query_embedding = self.model.encode(query).tolist()
-            
-            # Prepare filter
-            where_filter = {"user_id": user_id}
-            if category:
-                where_filter["category"] = category
+            cache_key = (user_id, self._generation(user_id), query, category, top_k)
+            cached = self._cached_selection(cache_key)
+            if cached is not None:
+                return cached
             
-            # Search
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=top_k,
-                where=where_filter
-            )
-            
-            # Format results
+            index = self._user_index(user_id)
             credentials = []
-            if results['ids'] and len(results['ids'][0]) > 0:
-                for i in range(len(results['ids'][0])):
-                    credential = {
-                        "credential_id": results['metadatas'][0][i]['credential_id'],
-                        "service_name": results['metadatas'][0][i]['service_name'],
-                        "category": results['metadatas'][0][i]['category'],
-                        "purpose": results['metadatas'][0][i]['purpose'],
-                        "relevance_score": 1 - results['distances'][0][i],  # Convert distance to similarity
-                        "matched_text": results['documents'][0][i]
-                    }
-                    credentials.append(credential)
+            if index.ids and top_k > 0:
+                # Mỗi user chỉ có vài chục credential: chấm điểm trong RAM thay vì query Chroma
+                scores = index.scores(self.model.encode(query))
+                rows = np.arange(len(index.ids))
+                if category:
+                    rows = rows[[index.metadatas[row]['category'] == category for row in rows]]
+                for row in rows[np.argsort(-scores[rows], kind='stable')][:top_k]:
+                    metadata = index.metadatas[row]
+                    credentials.append({
+                        "credential_id": metadata['credential_id'],
+                        "service_name": metadata['service_name'],
+                        "category": metadata['category'],
+                        "purpose": metadata['purpose'],
+                        "relevance_score": float(scores[row]),
+                        "matched_text": index.documents[row]
+                    })
             
+            self._store_selection(cache_key, credentials)
             logger.info(f"Found {len(credentials)} credentials for query: {query}")
-            return credentials
+            return [dict(credential) for credential in credentials]
             
         except Exception as e:
             logger.error(f"Error searching credentials: {e}")
             return []
     
+    def _generation(self, user_id: int) -> int:
+        with self._cache_lock:
+            return self._generations.get(user_id, 0)
+    
+    def invalidate_user(self, user_id: int):
+        """Bỏ ma trận, số đếm + kết quả search đã cache của user (gọi sau khi credential thay đổi)"""
+        with self._cache_lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._user_indexes.pop(user_id, None)
+            self._user_ids.pop(user_id, None)
+    
+    def _apply_change(
+        self,
+        user_id: int,
+        update: Callable[[UserCredentialIndex], UserCredentialIndex],
+        added: Iterable[str] = (),
+        removed: Iterable[str] = ()
+    ):
+        """
+        Cập nhật tăng dần ma trận + bảng similar + tập ID của user đang được cache
+        (không đọc lại Chroma) và bỏ các kết quả search đã cache của user
+        """
+        with self._cache_lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            index = self._user_indexes.get(user_id)
+            if index is not None:
+                self._user_indexes[user_id] = update(index)
+            user_ids = self._user_ids.get(user_id)
+            if user_ids is not None:
+                user_ids.update(added)
+                user_ids.difference_update(removed)
+    
+    def _store_user_ids(self, user_id: int, ids: List[str]):
+        """Lưu tập ID vừa đọc từ Chroma (gọi khi giữ _cache_lock, generation chưa đổi)"""
+        self._user_ids[user_id] = set(ids)
+        self._user_ids.move_to_end(user_id)
+        while len(self._user_ids) > self.max_cached_users:
+            self._user_ids.popitem(last=False)
+    
+    def _user_index(self, user_id: int) -> UserCredentialIndex:
+        """Ma trận credential của user (đọc từ Chroma nếu chưa có / đã hết hạn)"""
+        with self._cache_lock:
+            index = self._user_indexes.get(user_id)
+            if index is not None and time.monotonic() - index.loaded_at < self.index_ttl:
+                self._user_indexes.move_to_end(user_id)
+                return index
+            generation = self._generations.get(user_id, 0)
+        
+        results = self.collection.get(
+            where={"user_id": user_id},
+            include=["embeddings", "documents", "metadatas"]
+        )
+        embeddings = results['embeddings'] if results['embeddings'] is not None else []
+        index = UserCredentialIndex(results['ids'], embeddings, results['documents'], results['metadatas'])
+        with self._cache_lock:
+            self.index_loads += 1
+            # Credential đổi trong lúc đang đọc: không lưu bản có thể đã cũ
+            if self._generations.get(user_id, 0) == generation:
+                self._user_indexes[user_id] = index
+                self._user_indexes.move_to_end(user_id)
+                while len(self._user_indexes) > self.max_cached_users:
+                    self._user_indexes.popitem(last=False)
+                self._store_user_ids(user_id, index.ids)
+        return index
+    
+    def _cached_selection(self, key: Tuple) -> Optional[List[Dict]]:
+        if self.selection_cache_ttl <= 0:
+            return None
+        with self._cache_lock:
+            entry = self._selection_cache.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.cache_misses += 1
+                return None
+            self._selection_cache.move_to_end(key)
+            self.cache_hits += 1
+            return [dict(credential) for credential in entry[1]]
+    
+    def _store_selection(self, key: Tuple, credentials: List[Dict]):
+        if self.selection_cache_ttl <= 0:
+            return
+        with self._cache_lock:
+            self._selection_cache[key] = (time.monotonic() + self.selection_cache_ttl, credentials)
+            self._selection_cache.move_to_end(key)
+            while len(self._selection_cache) > self.selection_cache_size:
+                self._selection_cache.popitem(last=False)
+    
+    def cache_stats(self) -> Dict:
+        with self._cache_lock:
+            return {
+                "cached_users": len(self._user_indexes),
+                "index_loads": self.index_loads,
+                "selection_cache_size": len(self._selection_cache),
+                "selection_cache_ttl": self.selection_cache_ttl,
+                "hits": self.cache_hits,
+                "misses": self.cache_misses
+            }
+    
     def delete_credential(self, user_id: int, credential_id: int) -> bool:
         """Delete credential from vector database"""
         try:
             doc_id = f"cred_{user_id}_{credential_id}"
-            self.collection.delete(ids=[doc_id])
+            with self._write_lock:
+                self.collection.delete(ids=[doc_id])
+                self._apply_change(user_id, lambda index: index.removed({doc_id}), removed=[doc_id])
             logger.info(f"Deleted credential {credential_id} from vector DB")
             return True
         except Exception as e:
@@ -155,12 +612,26 @@ class CredentialVectorService:
             return False
     
     def get_user_credentials_count(self, user_id: int) -> int:
-        """Get count of credentials for a user"""
+        """
+        Get count of credentials for a user
+        
+        O(1) từ tập ID của user đang cache (cập nhật cùng add / delete / bulk upsert).
+        Chưa có thì chỉ lấy IDs từ Chroma (include=[]) rồi cache lại, không đọc
+        embeddings / dựng ma trận + bảng similar.
+        """
         try:
-            results = self.collection.get(
-                where={"user_id": user_id}
-            )
-            return len(results['ids']) if results['ids'] else 0
+            with self._cache_lock:
+                user_ids = self._user_ids.get(user_id)
+                if user_ids is not None:
+                    self._user_ids.move_to_end(user_id)
+                    return len(user_ids)
+                generation = self._generations.get(user_id, 0)
+            ids = self.collection.get(where={"user_id": user_id}, include=[])['ids']
+            with self._cache_lock:
+                # Credential đổi trong lúc đang đọc: không lưu bản có thể đã cũ
+                if self._generations.get(user_id, 0) == generation:
+                    self._store_user_ids(user_id, ids)
+            return len(ids)
         except Exception as e:
             logger.error(f"Error getting credential count: {e}")
             return 0
@@ -171,43 +642,29 @@ class CredentialVectorService:
         credential_id: int,
         top_k: int = 3
     ) -> List[Dict]:
-        """Find similar credentials to a given credential"""
+        """Find similar credentials to a given credential (bảng top-k tính sẵn, cập nhật khi upsert / delete)"""
         try:
-            # Get the credential's embedding
             doc_id = f"cred_{user_id}_{credential_id}"
-            result = self.collection.get(
-                ids=[doc_id],
-                include=["embeddings"]
-            )
-            
-            if not result['embeddings']:
+            index = self._user_index(user_id)
+            if doc_id not in index.rows or top_k <= 0:
                 return []
             
-            embedding = result['embeddings'][0]
-            
-            # Search for similar
-            results = self.collection.query(
-                query_embeddings=[embedding],
-                n_results=top_k + 1,  # +1 because it will include itself
-                where={"user_id": user_id}
-            )
+            if top_k <= SIMILAR_TABLE_K:
+                similar = index.similar[doc_id][:top_k]
+            else:
+                similar = index.top_similar(doc_id, top_k)
             
-            # Format and exclude the original credential
             credentials = []
-            if results['ids'] and len(results['ids'][0]) > 0:
-                for i in range(len(results['ids'][0])):
-                    cred_id = results['metadatas'][0][i]['credential_id']
-                    if cred_id != credential_id:  # Exclude self
-                        credential = {
-                            "credential_id": cred_id,
-                            "service_name": results['metadatas'][0][i]['service_name'],
-                            "category": results['metadatas'][0][i]['category'],
-                            "purpose": results['metadatas'][0][i]['purpose'],
-                            "similarity_score": 1 - results['distances'][0][i]
-                        }
-                        credentials.append(credential)
-            
-            return credentials[:top_k]
+            for other_id, score in similar:
+                metadata = index.metadatas[index.rows[other_id]]
+                credentials.append({
+                    "credential_id": metadata['credential_id'],
+                    "service_name": metadata['service_name'],
+                    "category": metadata['category'],
+                    "purpose": metadata['purpose'],
+                    "similarity_score": score
+                })
+            return credentials
             
         except Exception as e:
             logger.error(f"Error finding similar credentials: {e}")
@@ -222,7 +679,11 @@ def get_credential_vector_service() -> CredentialVectorService:
     """Get or create singleton instance"""
     global _credential_vector_service
     if _credential_vector_service is None:
-        _credential_vector_service = CredentialVectorService()
+        _credential_vector_service = CredentialVectorService(
+            selection_cache_ttl=float(os.getenv("CREDENTIAL_SELECTION_CACHE_TTL", 60)),
+            selection_cache_size=int(os.getenv("CREDENTIAL_SELECTION_CACHE_SIZE", 1024)),
+            index_ttl=float(os.getenv("CREDENTIAL_INDEX_TTL", 300))
+        )
     return _credential_vector_service
 
 
@@ -0,0 +1,106 @@
+"""
+Near-Duplicate Detection
+Fingerprint SimHash (64 bit, trên shingles 3 từ) để phát hiện nhanh các văn bản gần trùng
+
+- simhash(): văn bản gần giống nhau -> fingerprint chỉ khác vài bit (Hamming distance nhỏ)
+- SimHashIndex: chia fingerprint thành `bands` đoạn bit; 2 fingerprint cách nhau
+  < bands bit chắc chắn trùng ít nhất 1 đoạn (nguyên lý Dirichlet), nên chỉ cần so
+  với các ứng viên cùng đoạn thay vì toàn bộ corpus
+- Bước kiểm tra bằng embedding (cosine >= ngưỡng) do vector service thực hiện
+"""
+import hashlib
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+SIMHASH_BITS = 64
+SHINGLE_SIZE = 3
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_BIT_POSITIONS = np.arange(SIMHASH_BITS, dtype=np.uint64)
+
+
+def _shingles(text: str) -> List[str]:
+    words = _WORD_RE.findall((text or "").lower())
+    if len(words) <= SHINGLE_SIZE:
+        return [" ".join(words)] if words else []
+    return [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+
+
+def simhash(text: str) -> int:
+    """Fingerprint SimHash 64 bit của văn bản (chuẩn hóa chữ thường, bỏ dấu câu)"""
+    shingles = _shingles(text)
+    if not shingles:
+        return 0
+    values = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles],
+        dtype=np.uint64
+    )
+    # Mỗi bit: +1 nếu shingle có bit đó, -1 nếu không; fingerprint lấy dấu của tổng
+    bits = (values[:, None] >> _BIT_POSITIONS) & np.uint64(1)
+    set_bits = np.flatnonzero(2 * bits.sum(axis=0, dtype=np.int64) > len(shingles))
+    return sum(1 << int(bit) for bit in set_bits)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+    """Index fingerprint -> ids, tìm các fingerprint cách <= max_distance bit"""
+
+    def __init__(self, max_distance: int = 3, bands: int = 4):
+        """
+        Args:
+            max_distance: Hamming distance tối đa để coi là gần trùng
+            bands: Số đoạn bit (phải > max_distance để không bỏ sót ứng viên)
+        """
+        if max_distance >= bands:
+            raise ValueError(f"max_distance ({max_distance}) must be smaller than bands ({bands})")
+        self.max_distance = max_distance
+        self.bands = bands
+        self._band_bits = SIMHASH_BITS // bands
+        self._fingerprints: Dict[str, int] = {}
+        self._buckets: Dict[Tuple[int, int], Set[str]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+    def _band_keys(self, fingerprint: int):
+        mask = (1 << self._band_bits) - 1
+        return [(band, fingerprint >> (band * self._band_bits) & mask) for band in range(self.bands)]
+
+    def add(self, doc_id: str, fingerprint: int):
+        self.remove(doc_id)
+        self._fingerprints[doc_id] = fingerprint
+        for key in self._band_keys(fingerprint):
+            self._buckets[key].add(doc_id)
+
+    def remove(self, doc_id: str):
+        fingerprint = self._fingerprints.pop(doc_id, None)
+        if fingerprint is None:
+            return
+        for key in self._band_keys(fingerprint):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(doc_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def reset(self):
+        self._fingerprints.clear()
+        self._buckets.clear()
+
+    def nearest(self, fingerprint: int) -> Optional[Tuple[str, int]]:
+        """(id, distance) gần nhất trong phạm vi max_distance, None nếu không có"""
+        best = None
+        candidates = set()
+        for key in self._band_keys(fingerprint):
+            candidates.update(self._buckets.get(key, ()))
+        for doc_id in candidates:
+            distance = hamming_distance(fingerprint, self._fingerprints[doc_id])
+            if distance <= self.max_distance and (best is None or distance < best[1]):
+                best = (doc_id, distance)
+        return best
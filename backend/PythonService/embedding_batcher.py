@@ -0,0 +1,208 @@
+"""
+Gemini Embedding Batcher
+Gom documents thành các batch embed_content và chạy song song có giới hạn
+
+- Mỗi request embed tối đa batch_size texts (Gemini giới hạn 100/request)
+- Tối đa max_concurrency batches chạy cùng lúc trong thread pool
+- Retry với exponential backoff + jitter khi bị rate limit (429) / lỗi tạm thời
+- Báo tiến độ từng phần qua callback, batch lỗi không làm mất các batch đã xong
+- Tra EmbeddingCache (nếu có) trước khi gọi provider, chỉ embed các texts chưa có
+"""
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+import logging
+
+import google.generativeai as genai
+
+from embedding_cache import EmbeddingCache
+
+try:
+    from google.api_core import exceptions as google_exceptions
+    RETRYABLE_EXCEPTIONS = (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+    )
+except ImportError:
+    RETRYABLE_EXCEPTIONS = ()
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+MAX_BATCH_SIZE = 100  # Giới hạn batchEmbedContents của Gemini
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Lỗi có nên retry không (rate limit / quota / server tạm thời)"""
+    if RETRYABLE_EXCEPTIONS and isinstance(error, RETRYABLE_EXCEPTIONS):
+        return True
+    message = str(error).lower()
+    return "429" in message or "quota" in message or "rate limit" in message or "503" in message
+
+
+class EmbeddingBatcher:
+    """Embed nhiều texts bằng batch requests song song có giới hạn"""
+
+    def __init__(
+        self,
+        model: str = EMBEDDING_MODEL,
+        batch_size: int = MAX_BATCH_SIZE,
+        max_concurrency: int = 4,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        cache: Optional[EmbeddingCache] = None
+    ):
+        """
+        Args:
+            model: Tên model embedding Gemini
+            batch_size: Số texts mỗi request (tối đa 100)
+            max_concurrency: Số batch chạy song song tối đa
+            max_retries: Số lần retry mỗi batch khi gặp lỗi tạm thời
+            base_delay: Thời gian chờ ban đầu (giây) cho backoff
+            max_delay: Thời gian chờ tối đa (giây) giữa 2 lần retry
+            cache: Cache embeddings dùng chung (None = luôn gọi provider)
+        """
+        self.model = model
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cache = cache
+
+    def _embed_batch(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Embed 1 batch, retry với exponential backoff khi gặp lỗi tạm thời"""
+        attempt = 0
+        while True:
+            try:
+                result = genai.embed_content(
+                    model=self.model,
+                    content=texts,
+                    task_type=task_type
+                )
+                return result['embedding']
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    raise
+                delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+                delay *= random.uniform(0.5, 1.0)  # jitter tránh các batch retry cùng lúc
+                attempt += 1
+                logger.warning(
+                    f"⚠️ Embedding batch rate limited ({e}), "
+                    f"retry {attempt}/{self.max_retries} in {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+    def embed(
+        self,
+        texts: List[str],
+        task_type: str = "retrieval_document",
+        on_progress: Optional[Callable[[int, int], None]] = None
+    ) -> Dict:
+        """
+        Embed danh sách texts theo batch
+
+        Args:
+            texts: Danh sách văn bản
+            task_type: retrieval_document / retrieval_query / ...
+            on_progress: Callback (số texts đã embed xong, tổng số texts)
+
+        Returns:
+            Dict với:
+            - embeddings: List embeddings theo thứ tự texts (None nếu batch đó lỗi)
+            - failed: Index các texts không embed được
+            - errors: Thông báo lỗi của các batch thất bại
+        """
+        if self.cache is None:
+            return self._embed_uncached(texts, task_type, on_progress)
+
+        total = len(texts)
+        embeddings = self.cache.get_many(self.model, task_type, texts)
+
+        # Chỉ embed các texts chưa có trong cache (mỗi text 1 lần dù lặp lại)
+        pending: Dict[str, List[int]] = {}
+        for i, (text, embedding) in enumerate(zip(texts, embeddings)):
+            if embedding is None:
+                pending.setdefault(text, []).append(i)
+        if not pending:
+            if on_progress and total:
+                on_progress(total, total)
+            return {"embeddings": embeddings, "failed": [], "errors": []}
+
+        cached_count = total - sum(len(indexes) for indexes in pending.values())
+        unique_texts = list(pending)
+
+        def report(done: int, _unique_total: int):
+            on_progress(cached_count + done, total)
+
+        result = self._embed_uncached(unique_texts, task_type, report if on_progress else None)
+        self.cache.put_many(self.model, task_type, unique_texts, result['embeddings'])
+
+        failed_unique = set(result['failed'])
+        failed: List[int] = []
+        for j, text in enumerate(unique_texts):
+            for i in pending[text]:
+                if j in failed_unique:
+                    failed.append(i)
+                else:
+                    embeddings[i] = result['embeddings'][j]
+        failed.sort()
+        return {"embeddings": embeddings, "failed": failed, "errors": result['errors']}
+
+    def _embed_uncached(
+        self,
+        texts: List[str],
+        task_type: str,
+        on_progress: Optional[Callable[[int, int], None]] = None
+    ) -> Dict:
+        """Embed texts bằng provider theo batch (không qua cache)"""
+        total = len(texts)
+        embeddings: List[Optional[List[float]]] = [None] * total
+        failed: List[int] = []
+        errors: List[str] = []
+        if total == 0:
+            return {"embeddings": embeddings, "failed": failed, "errors": errors}
+
+        batches = [
+            (start, texts[start:start + self.batch_size])
+            for start in range(0, total, self.batch_size)
+        ]
+
+        # 1 batch: gọi trực tiếp, không cần thread pool
+        if len(batches) == 1:
+            try:
+                embeddings[:] = self._embed_batch(texts, task_type)
+            except Exception as e:
+                failed.extend(range(total))
+                errors.append(str(e))
+            if on_progress:
+                on_progress(total - len(failed), total)
+            return {"embeddings": embeddings, "failed": failed, "errors": errors}
+
+        done = 0
+        workers = min(self.max_concurrency, len(batches))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self._embed_batch, batch, task_type): (start, len(batch))
+                for start, batch in batches
+            }
+            for future in as_completed(futures):
+                start, size = futures[future]
+                try:
+                    embeddings[start:start + size] = future.result()
+                    done += size
+                except Exception as e:
+                    failed.extend(range(start, start + size))
+                    errors.append(str(e))
+                    logger.error(f"❌ Embedding batch [{start}:{start + size}] failed: {e}")
+                if on_progress:
+                    on_progress(done, total)
+
+        failed.sort()
+        logger.info(f"Embedded {done}/{total} texts in {len(batches)} batches")
+        return {"embeddings": embeddings, "failed": failed, "errors": errors}
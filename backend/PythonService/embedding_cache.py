@@ -0,0 +1,147 @@
+"""
+Embedding Cache
+Cache embeddings theo nội dung: key = (model, task_type, sha256(text))
+
+- Tầng 1: LRU trong RAM, giới hạn số phần tử
+- Tầng 2: SQLite trên đĩa, tồn tại qua các lần restart
+- Đếm hit/miss từng tầng để theo dõi qua API
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def text_hash(text: str) -> str:
+    """sha256 của nội dung text"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """Cache 2 tầng (RAM LRU + SQLite) cho embeddings"""
+
+    def __init__(self, db_path: Optional[str] = "embedding_cache.sqlite3", max_memory_items: int = 10000):
+        """
+        Args:
+            db_path: File SQLite cho tầng đĩa (None = chỉ dùng RAM)
+            max_memory_items: Số embeddings tối đa giữ trong LRU RAM
+        """
+        self.db_path = db_path
+        self.max_memory_items = max_memory_items
+        self._memory: "OrderedDict[tuple, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._conn = None
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    task_type TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (model, task_type, text_hash)
+                )"""
+            )
+            self._conn.commit()
+
+    def _remember(self, key: tuple, embedding: List[float]):
+        """Đưa vào LRU RAM, loại phần tử cũ nhất khi đầy"""
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model: str, task_type: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Tra cache cho nhiều texts, trả về None ở vị trí miss"""
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        keys = [(model, task_type, text_hash(text)) for text in texts]
+
+        with self._lock:
+            disk_lookup = {}
+            for i, key in enumerate(keys):
+                embedding = self._memory.get(key)
+                if embedding is not None:
+                    self._memory.move_to_end(key)
+                    results[i] = embedding
+                    self.memory_hits += 1
+                else:
+                    disk_lookup.setdefault(key[2], []).append(i)
+
+            if disk_lookup and self._conn is not None:
+                hashes = list(disk_lookup)
+                # SQLite giới hạn số tham số mỗi câu lệnh
+                for start in range(0, len(hashes), 500):
+                    chunk = hashes[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows = self._conn.execute(
+                        f"SELECT text_hash, embedding FROM embeddings "
+                        f"WHERE model = ? AND task_type = ? AND text_hash IN ({placeholders})",
+                        [model, task_type, *chunk]
+                    ).fetchall()
+                    for hash_value, blob in rows:
+                        embedding = np.frombuffer(blob, dtype=np.float32).tolist()
+                        self._remember((model, task_type, hash_value), embedding)
+                        for i in disk_lookup.pop(hash_value):
+                            results[i] = embedding
+                            self.disk_hits += 1
+
+            self.misses += sum(len(indexes) for indexes in disk_lookup.values())
+        return results
+
+    def put_many(self, model: str, task_type: str, texts: Sequence[str], embeddings: Sequence[List[float]]):
+        """Lưu embeddings vào cả 2 tầng"""
+        rows = []
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                if embedding is None:
+                    continue
+                key = (model, task_type, text_hash(text))
+                self._remember(key, embedding)
+                rows.append((model, task_type, key[2], np.asarray(embedding, dtype=np.float32).tobytes()))
+
+            if rows and self._conn is not None:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, task_type, text_hash, embedding) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                self._conn.commit()
+
+    def stats(self) -> Dict:
+        """Thống kê hit/miss"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            disk_items = None
+            if self._conn is not None:
+                disk_items = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_items": len(self._memory),
+                "max_memory_items": self.max_memory_items,
+                "disk_items": disk_items
+            }
+
+    def clear(self):
+        """Xóa toàn bộ cache"""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM embeddings")
+                self._conn.commit()
@@ -0,0 +1,234 @@
+"""
+Identity Resolver
+Token JWT -> user_id mà không phải gọi Spring Boot (/api/auth/profile) ở mỗi request
+
+- Có signing key (JWT_SECRET = jwt.secret của Spring Boot, HS256): verify chữ ký + exp
+  ngay tại chỗ, token sai / hết hạn bị từ chối không cần round trip. Spring Boot chỉ đặt
+  username trong `sub` nên user_id lấy từ claim id/userId nếu có, không thì từ cache
+  username -> user_id (mỗi user chỉ cần gọi profile 1 lần)
+- Không có key: cache token -> user_id, TTL không vượt quá `exp` của token
+- Single-flight: nhiều request đồng thời cùng 1 token (hoặc cùng 1 user) chỉ gây ra
+  tối đa 1 lần gọi upstream, các request còn lại chờ và dùng chung kết quả
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+JWT_ALGORITHMS = {
+    "HS256": hashlib.sha256,
+    "HS384": hashlib.sha384,
+    "HS512": hashlib.sha512,
+}
+USER_ID_CLAIMS = ("userId", "user_id", "id")
+
+
+def _b64url_decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def _decode_segment(segment: str) -> Optional[Dict]:
+    try:
+        value = json.loads(_b64url_decode(segment).decode("utf-8"))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def decode_jwt_claims(token: str) -> Optional[Dict]:
+    """Payload của JWT KHÔNG verify chữ ký (chỉ dùng để đọc exp), None nếu sai định dạng"""
+    parts = (token or "").split(".")
+    if len(parts) != 3:
+        return None
+    return _decode_segment(parts[1])
+
+
+def verify_jwt(token: str, secret: bytes, leeway: float = 0) -> Optional[Dict]:
+    """Claims nếu chữ ký HMAC hợp lệ và token chưa hết hạn, ngược lại None"""
+    parts = (token or "").split(".")
+    if len(parts) != 3:
+        return None
+    header = _decode_segment(parts[0])
+    digest = JWT_ALGORITHMS.get((header or {}).get("alg"))
+    if digest is None:
+        return None
+    expected = hmac.new(secret, f"{parts[0]}.{parts[1]}".encode("ascii"), digest).digest()
+    try:
+        signature = _b64url_decode(parts[2])
+    except binascii.Error:
+        return None
+    if not hmac.compare_digest(expected, signature):
+        return None
+    claims = _decode_segment(parts[1])
+    if claims is None:
+        return None
+    exp = claims.get("exp")
+    if isinstance(exp, (int, float)) and exp + leeway <= time.time():
+        return None
+    return claims
+
+
+def _user_id_claim(claims: Dict) -> Optional[int]:
+    for name in USER_ID_CLAIMS:
+        value = claims.get(name)
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.isdigit():
+            return int(value)
+    return None
+
+
+class _Flight:
+    """1 lần gọi upstream đang chạy, các request cùng key chờ kết quả của nó"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[int] = None
+
+
+class IdentityResolver:
+    """Token -> user_id: verify cục bộ + cache có TTL + single-flight"""
+
+    def __init__(
+        self,
+        fetch_user_id: Callable[[str], Optional[int]],
+        signing_key: Optional[str] = None,
+        cache_ttl: float = 300,
+        max_entries: int = 10000,
+        leeway: float = 30,
+        flight_timeout: float = 10
+    ):
+        """
+        Args:
+            fetch_user_id: Hàm hỏi upstream user_id của token (None nếu token không hợp lệ)
+            signing_key: Secret HMAC mà Spring Boot dùng để ký JWT (None = không verify cục bộ)
+            cache_ttl: Thời gian (giây) tối đa giữ 1 entry; luôn bị chặn bởi exp của token
+            max_entries: Số entry tối đa mỗi cache (LRU)
+            leeway: Dung sai đồng hồ (giây) khi kiểm tra exp
+            flight_timeout: Thời gian tối đa (giây) các request chờ lần gọi upstream chung
+        """
+        self.fetch_user_id = fetch_user_id
+        self.signing_key = signing_key.encode("utf-8") if signing_key else None
+        self.cache_ttl = cache_ttl
+        self.max_entries = max(1, max_entries)
+        self.leeway = leeway
+        self.flight_timeout = flight_timeout
+        # sha256(token) -> (hết hạn lúc, user_id); subject -> (hết hạn lúc, user_id)
+        self._tokens: "OrderedDict[str, Tuple[float, int]]" = OrderedDict()
+        self._subjects: "OrderedDict[str, Tuple[float, int]]" = OrderedDict()
+        self._inflight: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.upstream_calls = 0
+        self.shared_calls = 0
+
+    @property
+    def verifies_locally(self) -> bool:
+        return self.signing_key is not None
+
+    def resolve(self, token: str) -> Optional[int]:
+        """user_id của token, None nếu token không hợp lệ / hết hạn / upstream lỗi"""
+        if not token:
+            return None
+        now = time.time()
+
+        if self.signing_key is not None:
+            claims = verify_jwt(token, self.signing_key, self.leeway)
+            if claims is None:
+                with self._lock:
+                    self.rejected += 1
+                return None
+            user_id = _user_id_claim(claims)
+            if user_id is not None:
+                with self._lock:
+                    self.hits += 1
+                return user_id
+            subject = claims.get("sub")
+            if isinstance(subject, str) and subject:
+                # Token đã được verify: map username -> user_id dùng được cho mọi token của user đó
+                return self._resolve_cached(self._subjects, f"sub:{subject}", subject, token, now + self.cache_ttl)
+        else:
+            claims = decode_jwt_claims(token) or {}
+
+        exp = claims.get("exp")
+        expires_at = now + self.cache_ttl
+        if isinstance(exp, (int, float)):
+            if exp <= now:
+                with self._lock:
+                    self.rejected += 1
+                return None
+            expires_at = min(expires_at, exp)
+        key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        return self._resolve_cached(self._tokens, key, key, token, expires_at)
+
+    def _resolve_cached(self, cache: "OrderedDict", flight_key: str, cache_key: str, token: str, expires_at: float) -> Optional[int]:
+        with self._lock:
+            entry = cache.get(cache_key)
+            if entry is not None and entry[0] > time.time():
+                cache.move_to_end(cache_key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            flight = self._inflight.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[flight_key] = _Flight()
+                self.upstream_calls += 1
+            else:
+                self.shared_calls += 1
+
+        if not leader:
+            flight.done.wait(self.flight_timeout)
+            return flight.result
+
+        try:
+            flight.result = self.fetch_user_id(token)
+        except Exception as e:
+            logger.warning(f"⚠️ Identity lookup failed: {e}")
+        finally:
+            with self._lock:
+                # Chỉ cache kết quả thành công; token bị upstream từ chối sẽ được hỏi lại lần sau
+                if flight.result is not None:
+                    cache[cache_key] = (expires_at, flight.result)
+                    cache.move_to_end(cache_key)
+                    while len(cache) > self.max_entries:
+                        cache.popitem(last=False)
+                self._inflight.pop(flight_key, None)
+            flight.done.set()
+        return flight.result
+
+    def invalidate(self, token: Optional[str] = None):
+        """Xóa cache của 1 token (vd: logout) hoặc toàn bộ"""
+        with self._lock:
+            if token is None:
+                self._tokens.clear()
+                self._subjects.clear()
+                return
+            self._tokens.pop(hashlib.sha256(token.encode("utf-8")).hexdigest(), None)
+            subject = (decode_jwt_claims(token) or {}).get("sub")
+            if isinstance(subject, str):
+                self._subjects.pop(subject, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "verifies_locally": self.verifies_locally,
+                "cache_ttl": self.cache_ttl,
+                "cached_tokens": len(self._tokens),
+                "cached_subjects": len(self._subjects),
+                "hits": self.hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+                "upstream_calls": self.upstream_calls,
+                "shared_calls": self.shared_calls
+            }
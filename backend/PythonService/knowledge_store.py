@@ -0,0 +1,468 @@
+"""
+Knowledge Base Storage Engine
+Append-only write-ahead log + snapshot nhị phân cho SimpleVectorDB
+
+- Snapshot gồm 2 file:
+    <name>.docs.json        : id, text, metadata của từng document (không có embedding)
+    <name>.emb.<gen>.npy    : ma trận embeddings float32 (N x dim), mở bằng np.memmap
+- Log: mỗi dòng là 1 thao tác JSON (add / delete / update metadata / clear), chỉ append;
+  embedding trong log là base64 của float32 (encode nhanh hơn nhiều so với list số JSON)
+- Khởi động: mmap snapshot rồi replay phần đuôi log
+- Compact định kỳ: ghi snapshot mới (atomic) và truncate log
+- Dòng đầu của log ghi generation của snapshot mà log nối tiếp: crash giữa lúc publish
+  snapshot mới và xóa log thì log cũ (đã nằm trong snapshot) bị bỏ qua khi load
+
+Embeddings được mmap read-only nên nhiều uvicorn worker dùng chung page cache
+của OS thay vì mỗi process giữ 1 bản copy list Python float.
+
+Chế độ shared (nhiều worker cùng ghi 1 knowledge base):
+- Mọi thao tác ghi giữ flock độc quyền trên <name>.lock
+- Sau mỗi lần ghi, file <name>.version (version, generation, số bytes log) được thay atomic
+- Worker khác so version để biết cần replay phần log mới hay load lại snapshot
+"""
+import base64
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+import logging
+
+import numpy as np
+
+try:
+    import fcntl
+    FILE_LOCK_AVAILABLE = True
+except ImportError:
+    # Windows: không có flock, chế độ shared chỉ an toàn với 1 worker
+    fcntl = None
+    FILE_LOCK_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 2
+
+
+def _decode_embedding(doc: Dict):
+    """Embedding của 1 record trong log (base64 float32, hoặc list số ở log định dạng cũ)"""
+    if "embedding_f32" in doc:
+        return np.frombuffer(base64.b64decode(doc["embedding_f32"]), dtype=np.float32)
+    return doc['embedding']
+
+
+class KnowledgeLogStore:
+    """Storage engine dạng log-structured cho knowledge base"""
+
+    def __init__(
+        self,
+        storage_file: str,
+        log_file: Optional[str] = None,
+        compact_every: int = 500,
+        shared: bool = False
+    ):
+        """
+        Args:
+            storage_file: Tên file knowledge base (vd: knowledge_base.json).
+                File JSON cũ ở đường dẫn này sẽ được migrate 1 lần sang snapshot nhị phân.
+            log_file: File write-ahead log (mặc định: <storage_file>.wal)
+            compact_every: Số thao tác trong log trước khi tự động compact
+            shared: Nhiều process cùng đọc/ghi (flock + version file)
+        """
+        self.storage_file = storage_file
+        self.base_path = os.path.splitext(storage_file)[0]
+        self.docs_file = f"{self.base_path}.docs.json"
+        self.log_file = log_file or f"{storage_file}.wal"
+        self.compact_every = compact_every
+        self.pending_ops = 0
+        self.generation = 0
+        self.shared = shared
+        self.lock_file = f"{self.base_path}.lock"
+        self.version_file = f"{self.base_path}.version"
+        # Version đã thấy và số bytes log đã replay (để đọc tiếp phần log mới của process khác)
+        self.version = 0
+        self.log_offset = 0
+        self._lock_fd = None
+        self._lock_depth = 0
+        if shared and not FILE_LOCK_AVAILABLE:
+            logger.warning("⚠️ fcntl not available: shared knowledge base is not locked across processes")
+
+    def exists(self) -> bool:
+        """Đã có dữ liệu trên đĩa chưa (snapshot, log hoặc file JSON cũ)"""
+        return any(os.path.exists(path) for path in (self.docs_file, self.log_file, self.storage_file))
+
+    # ------------------------------------------------------------------
+    # Đồng bộ giữa các process (chế độ shared)
+    # ------------------------------------------------------------------
+
+    @contextmanager
+    def locked(self, exclusive: bool = True, blocking: bool = True):
+        """
+        Giữ flock trên lock file (no-op nếu không shared), yield True nếu đã lấy được lock
+
+        Lồng nhau được (chỉ lần ngoài cùng lock/unlock). Caller phải tuần tự hóa
+        các thread trong process (SimpleVectorDB gọi khi đang giữ write lock).
+        """
+        if not self.shared or not FILE_LOCK_AVAILABLE:
+            yield True
+            return
+        if self._lock_depth == 0:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            try:
+                fcntl.flock(fd, flags if blocking else flags | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                yield False
+                return
+            self._lock_fd = fd
+        self._lock_depth += 1
+        try:
+            yield True
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+    def read_version(self) -> Optional[Dict]:
+        """Version mới nhất do các process publish ({version, generation, log_bytes}), None nếu chưa có"""
+        try:
+            with open(self.version_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _publish_version(self):
+        """Tăng version sau 1 thao tác ghi (gọi khi đang giữ lock độc quyền)"""
+        if not self.shared:
+            return
+        self.version += 1
+        tmp_path = f"{self.version_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "version": self.version,
+                "generation": self.generation,
+                "log_bytes": self.log_offset
+            }, f)
+        os.replace(tmp_path, self.version_file)
+
+    def read_new_entries(self, version: Dict) -> List[Dict]:
+        """
+        Các entries process khác đã append sau self.log_offset (cùng generation)
+
+        Không truncate log: chỉ đọc các dòng hoàn chỉnh tới log_bytes của version.
+        """
+        entries = []
+        if os.path.exists(self.log_file):
+            with open(self.log_file, 'rb') as f:
+                f.seek(self.log_offset)
+                data = f.read(max(0, version["log_bytes"] - self.log_offset))
+            for line in data.splitlines(keepends=True):
+                if not line.endswith(b"\n"):
+                    break
+                self.log_offset += len(line)
+                if line.strip():
+                    entry = json.loads(line.decode('utf-8'))
+                    if entry.get("op") != "header":
+                        entries.append(entry)
+        self.pending_ops += len(entries)
+        self.version = version["version"]
+        return entries
+
+    # ------------------------------------------------------------------
+    # Snapshot
+    # ------------------------------------------------------------------
+
+    def _embeddings_file(self, generation: int) -> str:
+        return f"{self.base_path}.emb.{generation}.npy"
+
+    def _load_snapshot(self) -> Tuple[List[Dict], Optional[np.ndarray]]:
+        """Đọc docs file và mmap file embeddings của snapshot hiện tại"""
+        if not os.path.exists(self.docs_file):
+            if os.path.exists(self.storage_file):
+                migrate_json_knowledge_base(self.storage_file, store=self)
+            else:
+                return [], None
+
+        with open(self.docs_file, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+
+        documents = snapshot["documents"]
+        self.generation = snapshot.get("generation", 0)
+        embeddings_file = snapshot.get("embeddings_file")
+        if not embeddings_file:
+            return documents, None
+
+        embeddings_path = os.path.join(os.path.dirname(self.docs_file), embeddings_file)
+        embeddings = np.load(embeddings_path, mmap_mode='r')
+        if embeddings.shape[0] != len(documents):
+            raise ValueError(
+                f"Snapshot corrupted: {len(documents)} documents but "
+                f"{embeddings.shape[0]} embeddings in {embeddings_path}"
+            )
+        return documents, embeddings
+
+    def load(self) -> Tuple[List[Dict], Optional[np.ndarray], List[List[float]]]:
+        """
+        Load snapshot và replay log
+
+        Returns:
+            (documents, base_embeddings, tail_embeddings)
+            - documents: id/document/metadata theo thứ tự, không chứa embedding
+            - base_embeddings: ma trận mmap của snapshot cho các documents đầu tiên
+              (bản copy trong RAM nếu log có xóa documents của snapshot)
+            - tail_embeddings: embeddings của các documents thêm sau snapshot (từ log)
+        """
+        base_docs, base = self._load_snapshot()
+        alive = np.ones(len(base_docs), dtype=bool)
+        base_index = {doc['id']: i for i, doc in enumerate(base_docs)}
+        tail = []
+
+        self.pending_ops = 0
+        self.log_offset = 0
+        version = self.read_version() if self.shared else None
+        self.version = version["version"] if version else 0
+        log_generation = self._log_generation()
+        if log_generation is not None and log_generation < self.generation:
+            # Compact bị crash sau khi publish snapshot, trước khi xóa log: mọi entry đã nằm trong snapshot
+            logger.warning(
+                f"⚠️ Ignoring stale log {self.log_file} (generation {log_generation} < snapshot {self.generation})"
+            )
+            os.remove(self.log_file)
+        if os.path.exists(self.log_file):
+            for entry in self._read_log():
+                op = entry.get("op")
+                if op == "header":
+                    continue
+                if op == "add":
+                    tail.extend(entry["docs"])
+                elif op == "delete":
+                    deleted = set(entry["ids"])
+                    for doc_id in deleted:
+                        if doc_id in base_index:
+                            alive[base_index[doc_id]] = False
+                    tail = [doc for doc in tail if doc['id'] not in deleted]
+                elif op == "update":
+                    updates = entry["metadatas"]
+                    for doc_id, metadata in updates.items():
+                        if doc_id in base_index and alive[base_index[doc_id]]:
+                            base_docs[base_index[doc_id]]['metadata'] = metadata
+                    for doc in tail:
+                        if doc['id'] in updates:
+                            doc['metadata'] = updates[doc['id']]
+                elif op == "clear":
+                    alive[:] = False
+                    tail = []
+                else:
+                    logger.warning(f"⚠️ Unknown log op: {op}")
+                self.pending_ops += 1
+            logger.info(f"Replayed {self.pending_ops} log entries from {self.log_file}")
+
+        if not alive.all():
+            # Log đã xóa một số documents của snapshot: chỉ giữ các dòng còn sống
+            # (bản copy RAM cho tới lần compact tiếp theo)
+            keep = np.flatnonzero(alive)
+            base_docs = [base_docs[i] for i in keep]
+            base = np.ascontiguousarray(base[keep]) if base is not None and len(keep) else None
+
+        documents = base_docs + [
+            {"id": doc['id'], "document": doc['document'], "metadata": doc['metadata']}
+            for doc in tail
+        ]
+        return documents, base, [_decode_embedding(doc) for doc in tail]
+
+    def _write_snapshot(self, documents: List[Dict], embeddings: Optional[np.ndarray]):
+        """
+        Ghi snapshot mới (không đụng tới log)
+
+        File embeddings mang số generation mới nên không ghi đè file đang được
+        mmap bởi process khác; docs file được os.replace sau cùng để luôn trỏ
+        tới 1 snapshot hoàn chỉnh.
+        """
+        old_generation = self.generation
+        generation = old_generation + 1
+        embeddings_file = None
+
+        if documents:
+            embeddings_path = self._embeddings_file(generation)
+            tmp_path = f"{embeddings_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(embeddings, dtype=np.float32))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, embeddings_path)
+            embeddings_file = os.path.basename(embeddings_path)
+
+        snapshot = {
+            "format": SNAPSHOT_FORMAT_VERSION,
+            "generation": generation,
+            "embeddings_file": embeddings_file,
+            "count": len(documents),
+            "documents": [
+                {"id": doc['id'], "document": doc['document'], "metadata": doc['metadata']}
+                for doc in documents
+            ]
+        }
+        tmp_docs = f"{self.docs_file}.tmp"
+        with open(tmp_docs, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_docs, self.docs_file)
+        self.generation = generation
+
+        # Dọn file embeddings của generation cũ (Windows không cho xóa file đang mmap)
+        old_path = self._embeddings_file(old_generation)
+        if os.path.exists(old_path):
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                logger.warning(f"⚠️ Could not remove old embeddings file {old_path}: {e}")
+
+    def compact(self, documents: List[Dict], embeddings: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """
+        Ghi snapshot mới từ trạng thái hiện tại và truncate log
+
+        Log chỉ bị xóa sau khi snapshot đã được ghi an toàn; crash giữa 2 bước thì
+        load() bỏ qua log vì header của nó mang generation cũ hơn snapshot.
+
+        Returns:
+            Ma trận embeddings mmap của snapshot mới (None nếu rỗng)
+        """
+        self._write_snapshot(documents, embeddings)
+
+        if os.path.exists(self.log_file):
+            os.remove(self.log_file)
+        self.pending_ops = 0
+        self.log_offset = 0
+        self._publish_version()
+
+        logger.info(f"Compacted knowledge base: {len(documents)} documents (generation {self.generation})")
+        if not documents:
+            return None
+        return np.load(self._embeddings_file(self.generation), mmap_mode='r')
+
+    # ------------------------------------------------------------------
+    # Write-ahead log
+    # ------------------------------------------------------------------
+
+    def _read_log(self):
+        """Đọc các entries hợp lệ trong log, cắt bỏ entry cuối bị ghi dở"""
+        valid_bytes = 0
+        with open(self.log_file, 'rb') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    valid_bytes += len(line)
+                    continue
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    # Entry bị ghi dở (crash giữa chừng) - dừng replay tại đây
+                    logger.warning(f"⚠️ Skipping torn log entry at {self.log_file}:{line_no}")
+                    break
+                valid_bytes += len(line)
+                yield entry
+
+        # Cắt phần đuôi hỏng để các lần append sau không bị dính vào
+        if valid_bytes < os.path.getsize(self.log_file):
+            with open(self.log_file, 'r+b') as f:
+                f.truncate(valid_bytes)
+        self.log_offset = valid_bytes
+
+    def _log_generation(self) -> Optional[int]:
+        """Generation ghi ở dòng header của log (None nếu chưa có log / log cũ không có header)"""
+        if not os.path.exists(self.log_file):
+            return None
+        with open(self.log_file, 'rb') as f:
+            first_line = f.readline()
+        try:
+            entry = json.loads(first_line.decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return None
+        if not isinstance(entry, dict) or entry.get("op") != "header":
+            return None
+        return entry.get("generation")
+
+    def _append(self, entry: Dict):
+        """Ghi 1 thao tác vào cuối log (flush + fsync)"""
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode('utf-8')
+        if not os.path.exists(self.log_file) or os.path.getsize(self.log_file) == 0:
+            # Log mới: dòng đầu ghi generation của snapshot hiện tại (ghi cùng entry đầu tiên)
+            header = {"op": "header", "generation": self.generation}
+            line = (json.dumps(header) + "\n").encode('utf-8') + line
+        with open(self.log_file, 'ab') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending_ops += 1
+        self.log_offset += len(line)
+        self._publish_version()
+
+    def append_documents(self, documents: List[Dict]):
+        """Ghi các documents mới (kèm embedding) vào log"""
+        if documents:
+            self._append({"op": "add", "docs": [
+                {
+                    "id": doc['id'],
+                    "document": doc['document'],
+                    "metadata": doc['metadata'],
+                    "embedding_f32": base64.b64encode(
+                        np.asarray(doc['embedding'], dtype=np.float32).tobytes()
+                    ).decode('ascii')
+                }
+                for doc in documents
+            ]})
+
+    def delete(self, ids: Iterable[str]):
+        """Ghi tombstone cho các document IDs"""
+        ids = list(ids)
+        if ids:
+            self._append({"op": "delete", "ids": ids})
+
+    def update_metadata(self, metadatas: Dict[str, Dict]):
+        """Ghi metadata mới (thay toàn bộ) cho các document IDs"""
+        if metadatas:
+            self._append({"op": "update", "metadatas": metadatas})
+
+    def clear(self):
+        """Ghi tombstone xóa toàn bộ knowledge base"""
+        self._append({"op": "clear"})
+
+    def needs_compaction(self) -> bool:
+        """Log đã đủ dài để compact chưa"""
+        return self.pending_ops >= self.compact_every
+
+
+def migrate_json_knowledge_base(json_file: str, store: Optional[KnowledgeLogStore] = None) -> int:
+    """
+    Migrate 1 lần từ knowledge_base.json (embeddings dạng JSON float) sang snapshot nhị phân
+
+    File JSON cũ được đổi tên thành <json_file>.migrated sau khi snapshot mới
+    đã được ghi xong, nên có thể chạy lại an toàn nếu bị gián đoạn.
+    Write-ahead log (nếu có) được giữ nguyên và replay lên snapshot mới.
+
+    Returns:
+        Số documents đã migrate
+    """
+    store = store or KnowledgeLogStore(json_file)
+    with open(json_file, 'r', encoding='utf-8') as f:
+        legacy_documents = json.load(f)
+
+    if legacy_documents:
+        embeddings = np.asarray([doc['embedding'] for doc in legacy_documents], dtype=np.float32)
+    else:
+        embeddings = None
+    store._write_snapshot(legacy_documents, embeddings)
+
+    os.replace(json_file, f"{json_file}.migrated")
+    logger.info(f"✅ Migrated {len(legacy_documents)} documents from {json_file} to {store.docs_file}")
+    return len(legacy_documents)
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    path = sys.argv[1] if len(sys.argv) > 1 else "knowledge_base.json"
+    count = migrate_json_knowledge_base(path)
+    print(f"✅ Migrated {count} documents from {path}")
@@ -0,0 +1,210 @@
+"""
+Lexical Index (BM25)
+Inverted index BM25 chạy song song với vector store để bắt các từ khóa chính xác
+(mã học phần, thuật ngữ tiếng Việt, tên công thức) mà dense embeddings hay bỏ sót
+
+- Tokenize: lowercase + bỏ dấu tiếng Việt ("Đạo hàm" -> "dao ham"), giữ nguyên mã
+  kiểu "IT3100", "CS-101" -> "cs-101"
+- Cập nhật tăng dần khi insert (posting lists append-only dùng chung giữa các bản copy(),
+  insert tốn O(kích thước document)), dựng lại sau khi xóa (row ids thay đổi)
+- Tìm kiếm lexical không cần gọi embedding API
+- Reciprocal Rank Fusion (RRF) để trộn thứ hạng lexical + vector
+"""
+import copy
+import math
+import re
+import unicodedata
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+import logging
+
+import numpy as np
+
+from append_only import GrowableArray, rows_before
+
+logger = logging.getLogger(__name__)
+
+RRF_K = 60  # Hằng số k của RRF (giá trị chuẩn trong bài báo gốc)
+
+# Từ + số, cho phép nối bằng - . _ bên trong (mã học phần, phiên bản, tên file)
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-._][a-z0-9]+)*")
+
+
+def fold_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt: "Cấu trúc dữ liệu" -> "Cau truc du lieu" """
+    text = text.replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in decomposed if unicodedata.category(ch) != "Mn")
+
+
+def tokenize(text: str) -> List[str]:
+    """Tách text thành tokens đã lowercase và bỏ dấu"""
+    if not text:
+        return []
+    return TOKEN_PATTERN.findall(fold_diacritics(text).lower())
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Hashable]], k: int = RRF_K) -> List[Tuple[Hashable, float]]:
+    """
+    Trộn nhiều danh sách xếp hạng: score(d) = sum 1 / (k + rank(d))
+
+    Returns:
+        List (item, score) theo score giảm dần
+    """
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class _SharedPostings:
+    """Posting lists + độ dài documents dùng chung giữa các bản copy() của 1 BM25Index"""
+
+    __slots__ = ("postings", "doc_lengths", "end")
+
+    def __init__(self):
+        # term -> GrowableArray 2 cột (row id, term frequency), row id tăng dần
+        self.postings: Dict[str, GrowableArray] = {}
+        self.doc_lengths = GrowableArray(dtype=np.float32)
+        # Số documents đã được index vào các buffer dùng chung
+        self.end = 0
+
+
+class BM25Index:
+    """Inverted index BM25 (Okapi) trên row ids của vector store"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """
+        Args:
+            k1: Độ bão hòa term frequency
+            b: Mức chuẩn hóa theo độ dài document
+        """
+        self.k1 = k1
+        self.b = b
+        self._shared = _SharedPostings()
+        self._size = 0
+        self._doc_lengths_array: Optional[np.ndarray] = None
+        self._total_length = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def copy(self) -> "BM25Index":
+        """
+        Bản sao O(1), an toàn để add() trong khi bản gốc vẫn đang được tìm kiếm
+
+        Các buffer dùng chung chỉ được append phía sau; bản gốc chỉ đọc các row < size của nó.
+        """
+        return copy.copy(self)
+
+    def _detach(self):
+        """Tách khỏi buffer dùng chung (đã bị 1 bản copy khác append tiếp), giữ các row < size"""
+        shared = _SharedPostings()
+        for token, posting in list(self._shared.postings.items()):
+            entries = posting.view()
+            count = len(rows_before(entries[:, 0], self._size))
+            if count:
+                shared.postings[token] = posting.truncated(count)
+        shared.doc_lengths = self._shared.doc_lengths.truncated(self._size)
+        shared.end = self._size
+        self._shared = shared
+
+    def add(self, texts: Sequence[str]):
+        """
+        Index các documents mới (nối tiếp cuối corpus)
+
+        Append vào posting lists dùng chung (không copy lại corpus): các bản copy()
+        cũ không thấy các row mới vì chỉ đọc row < size của chúng.
+        """
+        if self._shared.end != self._size:
+            self._detach()
+        new_postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        lengths: List[int] = []
+        for row, text in enumerate(texts, start=self.size):
+            tokens = tokenize(text)
+            counts: Dict[str, int] = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                rows, freqs = new_postings.setdefault(token, ([], []))
+                rows.append(row)
+                freqs.append(count)
+            lengths.append(len(tokens))
+        if not lengths:
+            return
+
+        shared = self._shared
+        for token, (rows, freqs) in new_postings.items():
+            entries = np.column_stack([rows, freqs])
+            posting = shared.postings.get(token)
+            if posting is None:
+                posting = GrowableArray(columns=2, dtype=np.int32)
+                posting.append(entries)
+                shared.postings[token] = posting
+            else:
+                posting.append(entries)
+        shared.doc_lengths.append(lengths)
+        self._size += len(lengths)
+        shared.end = self._size
+        self._doc_lengths_array = None
+        self._total_length += sum(lengths)
+
+    def rebuild(self, texts: Sequence[str]):
+        """Dựng lại toàn bộ index (sau khi xóa documents)"""
+        self.reset()
+        self.add(texts)
+
+    def reset(self):
+        self._shared = _SharedPostings()
+        self._size = 0
+        self._doc_lengths_array = None
+        self._total_length = 0
+
+    def scores(self, query: str) -> np.ndarray:
+        """Điểm BM25 của query với mọi document (0 nếu không chứa term nào)"""
+        total = self.size
+        result = np.zeros(total, dtype=np.float32)
+        if total == 0:
+            return result
+        avg_length = self._total_length / total or 1.0
+        doc_lengths = self._doc_lengths_array
+        if doc_lengths is None:
+            doc_lengths = self._doc_lengths_array = self._shared.doc_lengths.view()[:total]
+        for token in dict.fromkeys(tokenize(query)):
+            posting = self._shared.postings.get(token)
+            if posting is None:
+                continue
+            entries = posting.view()
+            rows = rows_before(entries[:, 0], total)
+            df = len(rows)
+            if df == 0:
+                continue
+            freqs = entries[:df, 1].astype(np.float32)
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * doc_lengths[rows] / avg_length)
+            result[rows] += idf * freqs * (self.k1 + 1) / (freqs + norm)
+        return result
+
+    def search(self, query: str, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k (row ids, điểm BM25) có điểm > 0
+
+        Args:
+            query: Câu truy vấn
+            k: Số kết quả
+            rows: Chỉ xét các dòng này (vd: các dòng khớp filter metadata)
+        """
+        scores = self.scores(query)
+        candidates = np.flatnonzero(scores > 0)
+        if rows is not None:
+            candidates = np.intersect1d(candidates, rows, assume_unique=True)
+        if len(candidates) == 0 or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        candidate_scores = scores[candidates]
+        if k < len(candidates):
+            top = np.argpartition(-candidate_scores, k - 1)[:k]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.argsort(-candidate_scores[top], kind='stable')]
+        return candidates[top], candidate_scores[top]
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test /api/chat: throughput + latency (p50/p95/p99) theo số request đồng thời
+
+2 chế độ:
+- --url: bắn vào server đang chạy (upstream thật: Spring Boot, Groq/Gemini, ...)
+- mặc định (in-process): app của main.py qua httpx.ASGITransport, các upstream blocking
+  (xác thực token, tìm video YouTube, vector search, Groq) được thay bằng hàm time.sleep()
+  có độ trễ giả lập,
+  chạy 2 lượt để so sánh:
+    * offload: như code hiện tại (run_blocking -> chat_executor)
+    * inline: gọi thẳng trên event loop (như trước) -> throughput không tăng theo concurrency
+
+Chạy:
+    python load_test_chat.py --concurrency 1,4,16,32 --requests 64
+    python load_test_chat.py --message "phát nhạc lofi"   # đường tool YouTube
+    python load_test_chat.py --url http://localhost:8000 --token <JWT> --concurrency 1,8,32
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVICE_DIR)
+
+from benchmark_vector_db import percentiles
+
+MESSAGES = [
+    "Giải thích khái niệm đạo hàm",
+    "Cấu trúc dữ liệu cây nhị phân là gì?",
+    "How do I submit the assignment before the deadline?",
+    "Tóm tắt chương 3 môn Cơ sở dữ liệu",
+]
+
+
+async def run_level(client: httpx.AsyncClient, concurrency: int, total: int, payload: dict, headers: dict):
+    """Gửi `total` request với tối đa `concurrency` request cùng lúc (payload có "message" thì dùng cố định)"""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        body = dict({"message": MESSAGES[i % len(MESSAGES)]}, **payload)
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post("/api/chat", json=body, headers=headers)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    return total / elapsed, percentiles(latencies), errors
+
+
+async def run_levels(client: httpx.AsyncClient, levels, total: int, payload: dict, headers: dict, label: str):
+    rows = []
+    for concurrency in levels:
+        rows.append((label, concurrency, *await run_level(client, concurrency, total, payload, headers)))
+    return rows
+
+
+def print_rows(rows):
+    print(f"\n{'mode':<9} {'conc':>5} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for label, concurrency, throughput, latency, errors in rows:
+        print(
+            f"{label:<9} {concurrency:>5} {throughput:>8.1f} {latency['p50']:>9.1f} "
+            f"{latency['p95']:>9.1f} {latency['p99']:>9.1f} {errors:>7}"
+        )
+    print("-" * 64)
+
+
+class SimulatedGroq:
+    """Groq client giả: blocking như requests.post thật, trả lời sau `latency` giây"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def generate_text(self, prompt, system_prompt=None, model=None, **kwargs):
+        time.sleep(self.latency)
+        return f"Simulated answer ({len(prompt)} chars prompt)"
+
+
+def simulate(args, levels):
+    os.environ.setdefault("GEMINI_API_KEY", "dummy")
+    os.chdir(tempfile.mkdtemp(prefix="chat_load_"))
+    import main
+
+    auth_latency = args.auth_ms / 1000
+    search_latency = args.search_ms / 1000
+    youtube_latency = args.youtube_ms / 1000
+
+    def fake_user_id(token):
+        time.sleep(auth_latency)
+        return 1
+
+    def fake_search(query, n_results=3, user_id=None, course_id=None):
+        time.sleep(search_latency)
+        return {"documents": [], "metadatas": [], "distances": []}
+
+    def fake_youtube_search(query):
+        time.sleep(youtube_latency)
+        return "dQw4w9WgXcQ"
+
+    async def inline(func, *a, **kw):
+        return func(*a, **kw)
+
+    main.get_user_id_from_token = fake_user_id
+    main.vector_segments.search = fake_search
+    main.search_youtube_video = fake_youtube_search
+    main.groq_client = SimulatedGroq(args.llm_ms / 1000)
+
+    payload = {"ai_provider": "groq", "model": "llama-3.3-70b-versatile", "use_rag": True}
+    if args.message:
+        payload["message"] = args.message
+    headers = {"Authorization": "Bearer load-test"}
+    offload = main.run_blocking
+
+    async def run_all():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=120) as client:
+            rows = await run_levels(client, levels, args.requests, payload, headers, "offload")
+            if not args.skip_inline:
+                main.run_blocking = inline
+                try:
+                    rows += await run_levels(client, levels, args.requests, payload, headers, "inline")
+                finally:
+                    main.run_blocking = offload
+        return rows
+
+    print("=" * 64)
+    print("📊 /api/chat load test (in-process, simulated upstreams)")
+    print(f"   auth={args.auth_ms}ms youtube={args.youtube_ms}ms search={args.search_ms}ms llm={args.llm_ms}ms "
+          f"workers={main.chat_executor._max_workers} requests/level={args.requests}")
+    print("=" * 64)
+    print_rows(asyncio.run(run_all()))
+
+
+def against_server(args, levels):
+    payload = {"ai_provider": args.provider, "model": args.model, "use_rag": True}
+    if args.message:
+        payload["message"] = args.message
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+
+    async def run_all():
+        async with httpx.AsyncClient(base_url=args.url, timeout=120) as client:
+            return await run_levels(client, levels, args.requests, payload, headers, "server")
+
+    print("=" * 64)
+    print(f"📊 /api/chat load test against {args.url} (requests/level={args.requests})")
+    print("=" * 64)
+    print_rows(asyncio.run(run_all()))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Load test /api/chat throughput vs concurrency")
+    parser.add_argument("--url", default=None, help="Server đang chạy (bỏ trống = in-process, upstream giả lập)")
+    parser.add_argument("--token", default=os.getenv("LOAD_TEST_TOKEN"), help="JWT gửi kèm (chế độ --url)")
+    parser.add_argument("--provider", default="gemini", help="ai_provider (chế độ --url)")
+    parser.add_argument("--model", default="gemini-2.5-flash", help="model (chế độ --url)")
+    parser.add_argument("--concurrency", default="1,4,16,32", help="Danh sách mức concurrency, vd: 1,8,32")
+    parser.add_argument("--requests", type=int, default=64, help="Số request mỗi mức")
+    parser.add_argument("--auth-ms", type=float, default=30, help="Độ trễ giả lập xác thực token")
+    parser.add_argument("--message", default=None, help="Gửi 1 tin nhắn cố định (vd: \"phát nhạc lofi\" để đi qua tool YouTube)")
+    parser.add_argument("--youtube-ms", type=float, default=300, help="Độ trễ giả lập tìm video YouTube")
+    parser.add_argument("--search-ms", type=float, default=20, help="Độ trễ giả lập vector search")
+    parser.add_argument("--llm-ms", type=float, default=200, help="Độ trễ giả lập LLM")
+    parser.add_argument("--skip-inline", action="store_true", help="Không chạy lượt so sánh inline")
+    args = parser.parse_args()
+
+    levels = [int(c) for c in args.concurrency.split(",")]
+    if args.url:
+        against_server(args, levels)
+    else:
+        simulate(args, levels)
+
+
+if __name__ == "__main__":
+    main_cli()
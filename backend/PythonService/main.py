@@ -15,15 +15,36 @@ if sys.platform == 'win32':
 
 from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, ConfigDict
-from typing import List, Optional, Dict
+from typing import Callable, List, Optional, Dict, Sequence
 import google.generativeai as genai
 import os
 from dotenv import load_dotenv
+import asyncio
+import copy
 import json
 import math
+import threading
+import time
+import numpy as np
 import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
+from identity_resolver import IdentityResolver
+from append_only import AppendOnlyList
+from knowledge_store import KnowledgeLogStore, _decode_embedding
+from embedding_batcher import EmbeddingBatcher
+from embedding_cache import EmbeddingCache
+from vector_index import IVFFlatIndex
+from metadata_index import DEFAULT_INDEXED_FIELDS, MetadataIndex
+from quantization import Int8Quantizer
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from segment_manager import SegmentManager
+from dedupe import SimHashIndex, simhash
+from pagination import clamp_page_size, decode_cursor, encode_cursor, export_record, ndjson_lines
 try:
     from youtube_helper import search_youtube_video, get_youtube_watch_url, get_youtube_embed_url
     YOUTUBE_HELPER_AVAILABLE = True
@@ -88,105 +109,1127 @@ def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
     
     return dot_product / (magnitude1 * magnitude2)
 
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+DEDUPE_MODES = ("skip", "merge")
+HYBRID_CANDIDATE_FACTOR = 4  # Hybrid: số ứng viên mỗi nguồn = n_results * factor
+
+class VectorDBState:
+    """
+    Trạng thái đọc của SimpleVectorDB: documents + embeddings + các index
+    
+    State đã publish không bao giờ bị sửa: writer tạo bản sao bằng copy(), cập nhật
+    bản sao rồi SimpleVectorDB gán lại self._state (1 phép gán tham chiếu, atomic).
+    Search giữ tham chiếu tới state lúc bắt đầu nên không cần lock và không bao giờ
+    thấy dữ liệu đang ghi dở.
+    """
+    
+    def __init__(
+        self,
+        metadata_fields: Sequence[str] = DEFAULT_INDEXED_FIELDS,
+        ann_index: Optional[IVFFlatIndex] = None,
+        quantizer: Optional[Int8Quantizer] = None
+    ):
+        # documents chỉ giữ id/document/metadata - embeddings nằm trong ma trận numpy
+        # (append-only, dùng chung giữa các state: copy() không copy lại corpus)
+        self.documents = AppendOnlyList()
+        # Inverted index metadata (category/tags/type/source) -> row ids, dùng cho filter + thống kê
+        self.metadata_index = MetadataIndex(metadata_fields)
+        # BM25 inverted index trên nội dung documents (tìm theo từ khóa, không cần embedding)
+        self.lexical_index = BM25Index()
+        # Embeddings của snapshot: ma trận float32 mmap read-only (dùng chung page cache giữa các worker)
+        self._base = None
+        self._base_norms = None
+        # Embeddings thêm sau snapshot: buffer float32 liên tục (N x dim) + norm từng dòng,
+        # capacity dư để append không phải copy lại toàn bộ
+        self._matrix = None
+        self._norms = None
+        self._size = 0
+        # ANN index tùy chọn (IVF-flat); None = brute-force trên toàn bộ ma trận
+        self.ann_index = ann_index
+        # Quantization int8 tùy chọn: chấm điểm vòng 1 trên mã int8, re-rank bằng float32
+        self.quantizer = quantizer
+        self._memory_usage = None
+    
+    def copy(self) -> "VectorDBState":
+        """
+        Bản sao để writer cập nhật (copy-on-write)
+        
+        O(1): buffer embeddings đuôi, documents và posting lists của metadata / BM25 index
+        được dùng chung; writer chỉ ghi vào phần dư sau kích thước của state này
+        (các state cũ không đọc tới) hoặc cấp phát buffer mới khi đầy.
+        """
+        clone = copy.copy(self)
+        clone._memory_usage = None
+        clone.documents = self.documents.copy()
+        clone.metadata_index = self.metadata_index.copy()
+        clone.lexical_index = self.lexical_index.copy()
+        if self.ann_index is not None:
+            clone.ann_index = self.ann_index.copy()
+        if self.quantizer is not None:
+            clone.quantizer = self.quantizer.copy()
+        return clone
+    
+    # ------------------------------------------------------------------
+    # Cập nhật (chỉ gọi trên bản sao chưa publish)
+    # ------------------------------------------------------------------
+    
+    @property
+    def base_count(self) -> int:
+        return 0 if self._base is None else self._base.shape[0]
+    
+    def vector_indexes(self):
+        """Các cấu trúc phụ trợ dựng trên ma trận embeddings (ANN index / quantizer)"""
+        return [index for index in (self.ann_index, self.quantizer) if index is not None]
+    
+    def reset_embeddings(self, base: Optional[np.ndarray] = None, tail_embeddings=None):
+        """Thay toàn bộ embeddings: phần snapshot (base) + phần đuôi trong RAM"""
+        self._base = base
+        self._base_norms = np.linalg.norm(base, axis=1) if base is not None else None
+        self._matrix = None
+        self._norms = None
+        self._size = 0
+        if tail_embeddings is not None and len(tail_embeddings):
+            self._append_embeddings(tail_embeddings)
+    
+    def _append_embeddings(self, embeddings):
+        """Append embeddings vào buffer đuôi (tăng capacity gấp đôi khi đầy)"""
+        rows = np.asarray(embeddings, dtype=np.float32)
+        if rows.ndim != 2 or rows.shape[0] == 0:
+            return
+        
+        needed = self._size + rows.shape[0]
+        if self._matrix is None or needed > self._matrix.shape[0]:
+            capacity = max(needed, 2 * (self._matrix.shape[0] if self._matrix is not None else 0), 64)
+            matrix = np.empty((capacity, rows.shape[1]), dtype=np.float32)
+            norms = np.empty(capacity, dtype=np.float32)
+            if self._size:
+                matrix[:self._size] = self._matrix[:self._size]
+                norms[:self._size] = self._norms[:self._size]
+            self._matrix = matrix
+            self._norms = norms
+        
+        self._matrix[self._size:needed] = rows
+        self._norms[self._size:needed] = np.linalg.norm(rows, axis=1)
+        self._size = needed
+    
+    def reindex(self):
+        """Dựng lại metadata index và BM25 index từ self.documents"""
+        self.metadata_index.rebuild([doc['metadata'] for doc in self.documents])
+        self.lexical_index.rebuild([doc['document'] for doc in self.documents])
+    
+    def append(self, new_docs: List[Dict]):
+        """Thêm documents (có embedding) vào cuối corpus và cập nhật tất cả index"""
+        self.documents.extend(
+            {"id": doc['id'], "document": doc['document'], "metadata": doc['metadata']}
+            for doc in new_docs
+        )
+        self._append_embeddings([doc['embedding'] for doc in new_docs])
+        self.metadata_index.add([doc['metadata'] for doc in new_docs])
+        self.lexical_index.add([doc['document'] for doc in new_docs])
+        self.update_vector_indexes(len(new_docs))
+    
+    def update_vector_indexes(self, added: int):
+        """Cập nhật ANN index / quantizer tăng dần sau khi append `added` dòng"""
+        if added == 0:
+            return
+        total = len(self.documents)
+        for index in self.vector_indexes():
+            if index.needs_training(total):
+                index.train(self.all_embeddings())
+            elif index.is_trained:
+                index.add(self._matrix[self._size - added:self._size])
+    
+    # ------------------------------------------------------------------
+    # Đọc
+    # ------------------------------------------------------------------
+    
+    def segments(self):
+        """Các đoạn (embeddings, norms) theo thứ tự self.documents: snapshot trước, đuôi sau"""
+        if self._base is not None:
+            yield self._base, self._base_norms
+        if self._size:
+            yield self._matrix[:self._size], self._norms[:self._size]
+    
+    def memory_usage(self) -> int:
+        """Ước lượng số bytes đang chiếm: embeddings (snapshot + đuôi), mã int8, text documents"""
+        if self._memory_usage is not None:
+            return self._memory_usage
+        total = sum(embeddings.nbytes + norms.nbytes for embeddings, norms in self.segments())
+        if self.quantizer is not None:
+            total += self.quantizer.nbytes
+        total += sum(len(doc['document']) for doc in self.documents)
+        # State đã publish không đổi nên chỉ cần tính 1 lần
+        self._memory_usage = total
+        return total
+    
+    def tail_embeddings(self) -> np.ndarray:
+        """Embeddings thêm sau snapshot (chưa compact)"""
+        return self._matrix[:self._size]
+    
+    def all_embeddings(self) -> Optional[np.ndarray]:
+        """Ma trận embeddings của tất cả documents (theo thứ tự self.documents)"""
+        parts = [matrix for matrix, _ in self.segments()]
+        if not parts:
+            return None
+        return np.concatenate(parts) if len(parts) > 1 else np.asarray(parts[0])
+    
+    def norms_all(self) -> np.ndarray:
+        """Norm của tất cả dòng embeddings"""
+        return np.concatenate([norms for _, norms in self.segments()])
+    
+    def gather_rows(self, rows: np.ndarray):
+        """(embeddings, norms) của các dòng `rows` (chỉ số toàn cục, base hoặc đuôi)"""
+        base_count = self.base_count
+        in_base = rows < base_count
+        dim = (self._base if self._base is not None else self._matrix).shape[1]
+        embeddings = np.empty((len(rows), dim), dtype=np.float32)
+        norms = np.empty(len(rows), dtype=np.float32)
+        if in_base.any():
+            embeddings[in_base] = self._base[rows[in_base]]
+            norms[in_base] = self._base_norms[rows[in_base]]
+        if not in_base.all():
+            tail_rows = rows[~in_base] - base_count
+            embeddings[~in_base] = self._matrix[tail_rows]
+            norms[~in_base] = self._norms[tail_rows]
+        return embeddings, norms
+    
+    def similarities_at(self, query_embedding: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Cosine similarity của query với các dòng `rows` (chỉ số toàn cục)"""
+        embeddings, norms = self.gather_rows(rows)
+        dots = embeddings @ query_embedding
+        denom = norms * np.linalg.norm(query_embedding)
+        return np.divide(dots, denom, out=np.zeros_like(dots), where=denom > 0)
+    
+    def similarity_matrix(self, query_embeddings: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Cosine similarity của m queries với các dòng (None = toàn bộ corpus)
+        
+        1 phép nhân ma trận-ma trận (số dòng x dim) @ (dim x m) cho mỗi segment,
+        trả về ma trận (số dòng, m).
+        """
+        query_norms = np.linalg.norm(query_embeddings, axis=1)
+        if rows is not None:
+            segments = [self.gather_rows(rows)]
+        else:
+            segments = list(self.segments())
+        parts = []
+        for matrix, norms in segments:
+            dots = matrix @ query_embeddings.T
+            denom = np.outer(norms, query_norms)
+            parts.append(np.divide(dots, denom, out=np.zeros_like(dots), where=denom > 0))
+        if not parts:
+            return np.zeros((0, len(query_embeddings)), dtype=np.float32)
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+    
+    def similarities(self, query_embedding: np.ndarray) -> np.ndarray:
+        """Cosine similarity của query với tất cả documents (base + đuôi)"""
+        query_norm = np.linalg.norm(query_embedding)
+        parts = []
+        for matrix, norms in self.segments():
+            dots = matrix @ query_embedding
+            denom = norms * query_norm
+            parts.append(np.divide(dots, denom, out=np.zeros_like(dots), where=denom > 0))
+        if not parts:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+    
+    @staticmethod
+    def top_k(similarities: np.ndarray, k: int) -> np.ndarray:
+        """Chỉ số top-k theo similarity giảm dần (argpartition O(N), chỉ sort k phần tử)"""
+        total = len(similarities)
+        k = min(k, total)
+        if k < total:
+            top_idx = np.argpartition(-similarities, k - 1)[:k]
+        else:
+            top_idx = np.arange(total)
+        return top_idx[np.argsort(-similarities[top_idx], kind='stable')]
+    
+    def filter_rows(self, where: Dict) -> np.ndarray:
+        """Row ids khớp filter metadata `where`"""
+        return self.metadata_index.rows(where, lambda: [doc['metadata'] for doc in self.documents])
+    
+    def index_ready(self, index) -> bool:
+        """ANN index / quantizer đã train và khớp toàn bộ corpus"""
+        return index is not None and index.is_trained and index.size == len(self.documents)
+    
+    def search_rows(
+        self,
+        query_embedding: np.ndarray,
+        n_results: int,
+        n_probe: Optional[int] = None,
+        where: Optional[Dict] = None
+    ):
+        """
+        Top-k (row ids, similarities) cho 1 query embedding
+        
+        1. Tập ứng viên: các dòng khớp filter `where` (metadata index), hoặc các cụm
+           gần nhất của ANN index nếu đã train, ngược lại toàn bộ corpus
+        2. Nếu bật quantizer: chấm điểm xấp xỉ trên mã int8, giữ rerank_factor * k ứng viên
+        3. Chấm điểm chính xác (float32) các ứng viên còn lại và lấy top-k
+        """
+        rows = None
+        if where:
+            rows = self.filter_rows(where)
+            if len(rows) == 0:
+                return rows, np.zeros(0, dtype=np.float32)
+        elif self.index_ready(self.ann_index):
+            candidates = self.ann_index.candidates(query_embedding, n_probe)
+            if len(candidates) >= n_results:
+                rows = candidates
+        
+        if self.index_ready(self.quantizer):
+            shortlist_size = self.quantizer.rerank_factor * n_results
+            if rows is None or len(rows) > shortlist_size:
+                approx = self.quantizer.scores(query_embedding, rows)
+                shortlist = self.top_k(approx, shortlist_size)
+                rows = shortlist if rows is None else rows[shortlist]
+        
+        if rows is None:
+            similarities = self.similarities(query_embedding)
+            top = self.top_k(similarities, n_results)
+            return top, similarities[top]
+        
+        similarities = self.similarities_at(query_embedding, rows)
+        top = self.top_k(similarities, n_results)
+        return rows[top], similarities[top]
+    
+    def format_results(self, rows, distances: List[Optional[float]]) -> Dict:
+        """Kết quả search dạng ChromaDB cho các row ids"""
+        top_results = [self.documents[i] for i in rows]
+        return {
+            "documents": [doc['document'] for doc in top_results],
+            "distances": distances,
+            "metadatas": [doc['metadata'] for doc in top_results],
+            "ids": [doc['id'] for doc in top_results]
+        }
+
 class SimpleVectorDB:
-    def __init__(self, storage_file: str = "vector_db.json"):
-        """Khởi tạo Simple Vector Database"""
+    def __init__(
+        self,
+        storage_file: str = "vector_db.json",
+        compact_every: int = 500,
+        embedder: Optional[EmbeddingBatcher] = None,
+        ann_index: Optional[IVFFlatIndex] = None,
+        metadata_fields: Sequence[str] = DEFAULT_INDEXED_FIELDS,
+        quantizer: Optional[Int8Quantizer] = None,
+        shared: bool = False,
+        refresh_interval: float = 1.0,
+        dedupe_similarity: float = 0.95,
+        dedupe_simhash_distance: int = 3
+    ):
+        """
+        Khởi tạo Simple Vector Database
+        
+        Đồng thời: nhiều reader / 1 writer. Search đọc state bất biến hiện tại, không lấy lock;
+        add/delete/compact tuần tự qua _write_lock, dựng state mới rồi swap tham chiếu.
+        
+        shared=True: nhiều uvicorn worker dùng chung 1 knowledge base. Ghi giữ flock liên process;
+        mỗi lần đọc kiểm tra version file (tối đa 1 lần / refresh_interval giây) và replay
+        phần log mới do worker khác ghi, nên documents mới hiện ra sau tối đa ~refresh_interval.
+        
+        dedupe_similarity / dedupe_simhash_distance: ngưỡng coi 2 documents là gần trùng
+        (cosine embedding / số bit SimHash khác nhau) khi add_documents(dedupe=...).
+        """
         self.storage_file = storage_file
-        self.documents = []
+        # Embed theo batch song song có giới hạn (retry/backoff khi bị 429)
+        self.embedder = embedder or EmbeddingBatcher()
+        # Snapshot nhị phân (mmap) + write-ahead log: add/delete chỉ append vào log
+        self.store = KnowledgeLogStore(storage_file, compact_every=compact_every, shared=shared)
+        self.refresh_interval = refresh_interval
+        self._next_refresh = 0.0
+        self.metadata_fields = tuple(metadata_fields)
+        self.index_file = f"{self.store.base_path}.ivf.npz"
+        self.quantizer_file = f"{self.store.base_path}.int8.npz"
+        # RLock: add/delete có thể gọi save() (compact) khi đang giữ lock
+        self._write_lock = threading.RLock()
+        self._next_id = 0
+        self._state = VectorDBState(self.metadata_fields, ann_index, quantizer)
+        # Fingerprint SimHash để chặn documents gần trùng khi insert, dựng lười ở lần dedupe đầu tiên
+        # (chỉ đọc / ghi khi đang giữ _write_lock)
+        self.dedupe_similarity = dedupe_similarity
+        self.fingerprints = SimHashIndex(max_distance=dedupe_simhash_distance)
+        self._fingerprints_ready = False
         self.load()
     
+    # State hiện tại (chỉ đọc)
+    @property
+    def documents(self) -> Sequence[Dict]:
+        return self._state.documents
+    
+    @property
+    def metadata_index(self) -> MetadataIndex:
+        return self._state.metadata_index
+    
+    @property
+    def lexical_index(self) -> BM25Index:
+        return self._state.lexical_index
+    
+    @property
+    def ann_index(self) -> Optional[IVFFlatIndex]:
+        return self._state.ann_index
+    
+    @property
+    def quantizer(self) -> Optional[Int8Quantizer]:
+        return self._state.quantizer
+    
     def load(self):
-        """Load data từ file"""
-        if os.path.exists(self.storage_file):
-            with open(self.storage_file, 'r', encoding='utf-8') as f:
-                self.documents = json.load(f)
+        """Load snapshot (mmap) + replay write-ahead log"""
+        with self._write_lock, self.store.locked():
+            self._reload()
+    
+    def _reload(self):
+        """Load lại toàn bộ từ đĩa (gọi khi đang giữ _write_lock)"""
+        documents, base, tail_embeddings = self.store.load()
+        state = self._state.copy()
+        state.documents = AppendOnlyList(documents)
+        state.reset_embeddings(base, tail_embeddings)
+        state.reindex()
+        self._load_index(state)
+        self._next_id = 0
+        self._bump_next_id(documents)
+        self._state = state
+        self._fingerprints_ready = False
+        self.fingerprints.reset()
+    
+    def _bump_next_id(self, documents: List[Dict]):
+        """Đẩy bộ đếm ID qua các ID dạng doc_<n> đã có"""
+        for doc in documents:
+            doc_id = str(doc['id'])
+            if doc_id.startswith("doc_") and doc_id[4:].isdigit():
+                self._next_id = max(self._next_id, int(doc_id[4:]) + 1)
+    
+    def _catch_up(self) -> bool:
+        """
+        Áp dụng thay đổi do process khác ghi (chế độ shared, gọi khi đang giữ lock)
+        
+        Cùng generation: chỉ replay phần log mới; process khác đã compact: load lại snapshot.
+        Returns:
+            True nếu state thay đổi
+        """
+        if not self.store.shared:
+            return False
+        version = self.store.read_version()
+        if version is None or version["version"] == self.store.version:
+            return False
+        if version["generation"] != self.store.generation or version["log_bytes"] < self.store.log_offset:
+            self._reload()
+            return True
+        
+        state = self._state
+        for entry in self.store.read_new_entries(version):
+            op = entry.get("op")
+            if op == "add":
+                new_docs = [
+                    {"id": doc['id'], "document": doc['document'], "metadata": doc['metadata'],
+                     "embedding": _decode_embedding(doc)}
+                    for doc in entry["docs"]
+                ]
+                state = state.copy()
+                state.append(new_docs)
+                self._bump_next_id(new_docs)
+                self._track_fingerprints(added=new_docs)
+            elif op == "delete":
+                state, _ = self._without_documents(state, set(entry["ids"]))
+                self._track_fingerprints(removed=entry["ids"])
+            elif op == "update":
+                state = self._with_metadata(state, entry["metadatas"])
+            elif op == "clear":
+                state = self._cleared(state)
+                self.fingerprints.reset()
+        self._state = state
+        return True
+    
+    def refresh(self) -> bool:
+        """Đồng bộ ngay với các worker khác (chế độ shared); True nếu có thay đổi"""
+        with self._write_lock, self.store.locked(exclusive=False):
+            return self._catch_up()
+    
+    def _maybe_refresh(self):
+        """
+        Gọi đầu mỗi thao tác đọc: kiểm tra version tối đa 1 lần / refresh_interval
+        
+        Không chờ: nếu writer trong process đang chạy (nó sẽ tự catch up) hoặc worker
+        khác đang giữ lock ghi (vd: đang compact) thì bỏ qua, thử lại ở lần đọc sau.
+        """
+        if not self.store.shared:
+            return
+        now = time.monotonic()
+        if now < self._next_refresh:
+            return
+        if not self._write_lock.acquire(blocking=False):
+            return
+        try:
+            with self.store.locked(exclusive=False, blocking=False) as acquired:
+                if acquired:
+                    self._next_refresh = now + self.refresh_interval
+                    self._catch_up()
+        finally:
+            self._write_lock.release()
     
     def save(self):
-        """Lưu data vào file"""
-        with open(self.storage_file, 'w', encoding='utf-8') as f:
-            json.dump(self.documents, f, ensure_ascii=False, indent=2)
-    
-    def add_documents(self, documents: List[str], metadatas: List[Dict] = None, ids: List[str] = None):
-        """Thêm documents vào database"""
-        if ids is None:
-            start_id = len(self.documents)
-            ids = [f"doc_{start_id + i}" for i in range(len(documents))]
-        
+        """Compact: ghi snapshot đầy đủ và truncate log"""
+        with self._write_lock, self.store.locked():
+            self._catch_up()
+            state = self._state.copy()
+            base = self.store.compact(state.documents, state.all_embeddings())
+            state.reset_embeddings(base)
+            for index, index_file in self._vector_indexes(state):
+                if index.needs_training(len(state.documents)):
+                    index.train(state.all_embeddings())
+                index.save(index_file, generation=self.store.generation)
+            self._state = state
+    
+    def _vector_indexes(self, state: VectorDBState):
+        """(ANN index / quantizer, file lưu) của state"""
+        indexes = []
+        if state.ann_index is not None:
+            indexes.append((state.ann_index, self.index_file))
+        if state.quantizer is not None:
+            indexes.append((state.quantizer, self.quantizer_file))
+        return indexes
+    
+    def _load_index(self, state: VectorDBState):
+        """Load ANN index / quantizer đã lưu cạnh snapshot, gán thêm các dòng từ log hoặc train mới"""
+        total = len(state.documents)
+        for index, index_file in self._vector_indexes(state):
+            loaded = index.load(index_file)
+            if (loaded and index.generation == self.store.generation
+                    and index.size == state.base_count):
+                # Khớp snapshot: chỉ cần thêm các dòng sau snapshot
+                if total > state.base_count:
+                    index.add(state.tail_embeddings())
+            elif loaded and total:
+                # Log đã xóa/đổi các dòng của snapshot: giữ tham số đã train, gán lại toàn bộ
+                index.reassign(state.all_embeddings())
+            else:
+                index.reset()
+            
+            if index.needs_training(total):
+                index.train(state.all_embeddings())
+    
+    def _maybe_compact(self):
+        """Compact khi log đã đủ dài (gọi khi đang giữ _write_lock)"""
+        if self.store.needs_compaction():
+            self.save()
+    
+    def add_documents(
+        self,
+        documents: List[str],
+        metadatas: List[Dict] = None,
+        ids: List[str] = None,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        dedupe: Optional[str] = None
+    ):
+        """
+        Thêm documents vào database
+        
+        Embeddings được tạo theo batch; nếu một số batch lỗi sau khi retry,
+        các documents đã embed xong vẫn được lưu và kết quả có status "partial".
+        Gọi embedding API nằm ngoài write lock: search và các writer khác không phải chờ.
+        
+        dedupe: None (thêm tất cả), "skip" (bỏ documents gần trùng) hoặc "merge" (bỏ và
+        tăng metadata "duplicates" của document đã có); kết quả có skipped = số bị bỏ.
+        """
+        if dedupe is not None and dedupe not in DEDUPE_MODES:
+            raise ValueError(f"Invalid dedupe mode: {dedupe}. Use one of {DEDUPE_MODES}")
         if metadatas is None:
             metadatas = [{"source": "manual"} for _ in documents]
         
-        # Tạo embeddings
-        for doc, metadata, doc_id in zip(documents, metadatas, ids):
-            result = genai.embed_content(
-                model="models/text-embedding-004",
-                content=doc,
-                task_type="retrieval_document"
-            )
+        # Tạo embeddings theo batch
+        embedded = self.embedder.embed(documents, task_type="retrieval_document", on_progress=on_progress)
+        failed = set(embedded['failed'])
+        if documents and len(failed) == len(documents):
+            raise RuntimeError(f"Embedding failed: {embedded['errors'][0]}")
+        
+        with self._write_lock, self.store.locked():
+            # Chế độ shared: thấy documents / ID của worker khác trước khi ghi tiếp
+            self._catch_up()
+            if ids is None:
+                # Bộ đếm tăng dần (không dùng len(documents)) để ID không trùng sau khi xóa
+                start_id = self._next_id
+                self._next_id += len(documents)
+                ids = [f"doc_{start_id + i}" for i in range(len(documents))]
             
-            self.documents.append({
-                "id": doc_id,
-                "document": doc,
-                "embedding": result['embedding'],
-                "metadata": metadata
+            new_docs = [
+                {
+                    "id": doc_id,
+                    "document": doc,
+                    "embedding": embedding,
+                    "metadata": metadata
+                }
+                for i, (doc, metadata, doc_id, embedding) in enumerate(
+                    zip(documents, metadatas, ids, embedded['embeddings'])
+                )
+                if i not in failed
+            ]
+            state = self._state
+            skipped = 0
+            merged = Counter()
+            if dedupe is not None:
+                # Kiểm tra + ghi trong cùng write lock: 2 request đồng thời không cùng lọt 1 nội dung
+                matches = self._find_duplicates(state, new_docs)
+                skipped = sum(match is not None for match in matches)
+                merged.update(
+                    match for doc, match in zip(new_docs, matches) if match is not None and match != doc['id']
+                )
+                new_docs = [doc for doc, match in zip(new_docs, matches) if match is None]
+            if new_docs:
+                # Chỉ append records mới vào log thay vì ghi lại toàn bộ file
+                self.store.append_documents(new_docs)
+                state = state.copy()
+                state.append(new_docs)
+            if dedupe == "merge" and merged:
+                state = self._merge_duplicates(state, merged)
+            self._state = state
+            self._track_fingerprints(added=new_docs)
+            self._maybe_compact()
+        
+        if failed:
+            return {
+                "status": "partial",
+                "count": len(new_docs),
+                "skipped": skipped,
+                "failed": len(failed),
+                "failed_ids": [ids[i] for i in sorted(failed)],
+                "errors": embedded['errors']
+            }
+        return {"status": "success", "count": len(new_docs), "skipped": skipped}
+    
+    # ------------------------------------------------------------------
+    # Chặn documents gần trùng (SimHash + cosine embedding)
+    # ------------------------------------------------------------------
+    
+    def _track_fingerprints(self, added: Sequence[Dict] = (), removed: Sequence[str] = ()):
+        """Cập nhật SimHash index (nếu đã dựng) theo documents vừa thêm / xóa"""
+        if not self._fingerprints_ready:
+            return
+        for doc_id in removed:
+            self.fingerprints.remove(doc_id)
+        for doc in added:
+            self.fingerprints.add(doc['id'], simhash(doc['document']))
+    
+    def _ensure_fingerprints(self, state: VectorDBState):
+        """Dựng SimHash index từ state hiện tại nếu chưa có"""
+        if self._fingerprints_ready:
+            return
+        self.fingerprints.reset()
+        for doc in state.documents:
+            self.fingerprints.add(doc['id'], simhash(doc['document']))
+        self._fingerprints_ready = True
+        print(f"✅ Built SimHash index over {len(self.fingerprints)} documents")
+    
+    def _find_duplicates(self, state: VectorDBState, new_docs: List[Dict]) -> List[Optional[str]]:
+        """
+        ID document gần trùng (None nếu không có) cho từng document mới
+        
+        1. SimHash: gần như trùng nguyên văn (không cần chấm điểm embedding)
+        2. Nearest neighbour trong corpus: cosine >= dedupe_similarity (diễn đạt lại)
+        3. Các document đứng trước trong cùng batch (SimHash + cosine)
+        """
+        if not new_docs:
+            return []
+        self._ensure_fingerprints(state)
+        fingerprints = [simhash(doc['document']) for doc in new_docs]
+        matches: List[Optional[str]] = [None] * len(new_docs)
+        for i, fingerprint in enumerate(fingerprints):
+            nearest = self.fingerprints.nearest(fingerprint)
+            if nearest is not None:
+                matches[i] = nearest[0]
+        
+        vectors = np.asarray([doc['embedding'] for doc in new_docs], dtype=np.float32)
+        if len(state.documents):
+            for i in range(len(new_docs)):
+                if matches[i] is None:
+                    rows, similarities = state.search_rows(vectors[i], 1)
+                    if len(rows) and similarities[0] >= self.dedupe_similarity:
+                        matches[i] = state.documents[int(rows[0])]['id']
+        
+        norms = np.linalg.norm(vectors, axis=1)
+        unit = vectors / np.where(norms > 0, norms, 1)[:, None]
+        batch_fingerprints = SimHashIndex(self.fingerprints.max_distance, self.fingerprints.bands)
+        kept: List[int] = []
+        for i, doc in enumerate(new_docs):
+            if matches[i] is None:
+                nearest = batch_fingerprints.nearest(fingerprints[i])
+                if nearest is not None:
+                    matches[i] = nearest[0]
+                elif kept:
+                    similarities = unit[kept] @ unit[i]
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.dedupe_similarity:
+                        matches[i] = new_docs[kept[best]]['id']
+            if matches[i] is None:
+                kept.append(i)
+                batch_fingerprints.add(doc['id'], fingerprints[i])
+        return matches
+    
+    def _merge_duplicates(self, state: VectorDBState, counts: Dict[str, int]) -> VectorDBState:
+        """Cộng số bản trùng đã gộp vào metadata "duplicates" của document được giữ lại (ghi log "update")"""
+        updates = {
+            doc['id']: {
+                **(doc['metadata'] or {}),
+                "duplicates": int((doc['metadata'] or {}).get("duplicates", 0)) + counts[doc['id']]
+            }
+            for doc in state.documents
+            if doc['id'] in counts
+        }
+        if not updates:
+            return state
+        self.store.update_metadata(updates)
+        return self._with_metadata(state, updates)
+    
+    def search(
+        self,
+        query: str,
+        n_results: int = 5,
+        n_probe: Optional[int] = None,
+        where: Optional[Dict] = None,
+        mode: str = "vector",
+        query_embedding: Optional[np.ndarray] = None
+    ) -> Dict:
+        """
+        Tìm kiếm documents tương tự
+        
+        - **n_probe**: Số cụm IVF quét (chỉ khi bật ANN index; None = mặc định của index)
+        - **where**: Filter metadata (vd: {"category": "programming"}, {"tags": {"$in": ["python"]}})
+        - **mode**: "vector" (cosine), "lexical" (BM25, không gọi embedding API)
+          hoặc "hybrid" (trộn thứ hạng BM25 + vector bằng Reciprocal Rank Fusion)
+        - **query_embedding**: Embedding đã tính sẵn của query (vd: dùng chung khi tìm trên nhiều segment)
+        
+        Với lexical/hybrid, kết quả có thêm "scores" (điểm BM25 / RRF);
+        distances của lexical là None vì không tính embedding.
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}', expected one of {SEARCH_MODES}")
+        self._maybe_refresh()
+        if not self._state.documents or n_results <= 0:
+            results = {"documents": [], "distances": [], "metadatas": [], "ids": []}
+            if mode != "vector":
+                results["scores"] = []
+            return results
+        
+        if mode == "lexical":
+            state = self._state
+            rows = state.filter_rows(where) if where else None
+            top_idx, top_scores = state.lexical_index.search(query, n_results, rows)
+            results = state.format_results(top_idx, [None] * len(top_idx))
+            results["scores"] = [float(score) for score in top_scores]
+            return results
+        
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        
+        # State mới nhất tại thời điểm chấm điểm, dùng cố định tới khi trả kết quả
+        state = self._state
+        if mode == "vector":
+            # Cosine similarity bằng phép nhân ma trận-vector (toàn bộ hoặc các cụm ANN gần nhất)
+            top_idx, top_similarities = state.search_rows(query_embedding, n_results, n_probe, where)
+            return state.format_results(top_idx, [float(1 - sim) for sim in top_similarities])
+        
+        # Hybrid: lấy nhiều ứng viên hơn từ mỗi nguồn rồi trộn thứ hạng
+        n_candidates = n_results * HYBRID_CANDIDATE_FACTOR
+        vector_rows, _ = state.search_rows(query_embedding, n_candidates, n_probe, where)
+        lexical_rows, _ = state.lexical_index.search(
+            query, n_candidates, state.filter_rows(where) if where else None
+        )
+        fused = reciprocal_rank_fusion([vector_rows.tolist(), lexical_rows.tolist()])[:n_results]
+        top_idx = np.asarray([row for row, _ in fused], dtype=np.int64)
+        similarities = state.similarities_at(query_embedding, top_idx) if len(top_idx) else []
+        results = state.format_results(top_idx, [float(1 - sim) for sim in similarities])
+        results["scores"] = [score for _, score in fused]
+        return results
+    
+    def embed_query(self, query: str) -> np.ndarray:
+        """Tạo embedding cho query"""
+        embedded = self.embedder.embed([query], task_type="retrieval_query")
+        if embedded['failed']:
+            raise RuntimeError(f"Embedding failed: {embedded['errors'][0]}")
+        return np.asarray(embedded['embeddings'][0], dtype=np.float32)
+    
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Tạo embeddings cho nhiều queries trong 1 lần gọi embedder"""
+        embedded = self.embedder.embed(queries, task_type="retrieval_query")
+        if embedded['failed']:
+            raise RuntimeError(f"Embedding failed: {embedded['errors'][0]}")
+        return np.asarray(embedded['embeddings'], dtype=np.float32)
+    
+    def search_batch(
+        self,
+        queries: List[str],
+        n_results: int = 5,
+        n_probe: Optional[int] = None,
+        where: Optional[Dict] = None,
+        query_embeddings: Optional[np.ndarray] = None
+    ) -> List[Dict]:
+        """
+        Tìm kiếm nhiều queries cùng lúc
+        
+        Embed tất cả queries trong 1 lần gọi embedder, sau đó chấm điểm bằng
+        1 phép nhân ma trận-ma trận (corpus hoặc các dòng khớp `where` x queries).
+        Khi bật ANN index, mỗi query vẫn chỉ quét các cụm gần nó nhất.
+        `query_embeddings` đã tính sẵn (vd: dùng chung cho nhiều segment) thì không embed lại.
+        
+        Returns:
+            List kết quả theo thứ tự queries, mỗi phần tử có dạng như search()
+        """
+        empty = {"documents": [], "distances": [], "metadatas": [], "ids": []}
+        if not queries:
+            return []
+        self._maybe_refresh()
+        if not self._state.documents or n_results <= 0:
+            return [dict(empty) for _ in queries]
+        
+        if query_embeddings is None:
+            query_embeddings = self.embed_queries(queries)
+        
+        state = self._state
+        if not where and state.index_ready(state.ann_index):
+            # Mỗi query có tập cụm ứng viên riêng
+            ranked = [state.search_rows(q, n_results, n_probe) for q in query_embeddings]
+        else:
+            rows = None
+            if where:
+                rows = state.filter_rows(where)
+                if len(rows) == 0:
+                    return [dict(empty) for _ in queries]
+            
+            shortlist_size = (state.quantizer.rerank_factor * n_results) if state.quantizer else 0
+            if state.index_ready(state.quantizer) and (rows is None or len(rows) > shortlist_size):
+                # Vòng 1 trên mã int8 cho cả batch, re-rank float32 từng query
+                approx = state.quantizer.scores(query_embeddings, rows)
+                ranked = []
+                for j, q in enumerate(query_embeddings):
+                    shortlist = state.top_k(approx[:, j], shortlist_size)
+                    if rows is not None:
+                        shortlist = rows[shortlist]
+                    similarities = state.similarities_at(q, shortlist)
+                    top = state.top_k(similarities, n_results)
+                    ranked.append((shortlist[top], similarities[top]))
+            else:
+                similarities = state.similarity_matrix(query_embeddings, rows)
+                ranked = []
+                for j in range(len(query_embeddings)):
+                    top = state.top_k(similarities[:, j], n_results)
+                    ranked.append((top if rows is None else rows[top], similarities[top, j]))
+        
+        return [
+            state.format_results(top_idx, [float(1 - sim) for sim in top_similarities])
+            for top_idx, top_similarities in ranked
+        ]
+    
+    def index_recall_report(
+        self,
+        k: int = 5,
+        sample_size: int = 100,
+        n_probes: Optional[List[int]] = None,
+        seed: int = 0
+    ) -> Dict:
+        """
+        So sánh recall@k và latency của ANN index với brute-force
+        
+        Dùng embeddings của các documents ngẫu nhiên làm query (không gọi API).
+        """
+        state = self._state
+        total = len(state.documents)
+        if state.ann_index is None or not state.ann_index.is_trained or total == 0:
+            return {"status": "unavailable", "message": "ANN index chưa được bật hoặc chưa train", "total_documents": total}
+        
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(total, min(sample_size, total), replace=False)
+        queries = state.all_embeddings()[sample]
+        
+        start = time.perf_counter()
+        truth = [set(state.top_k(state.similarities(q), k).tolist()) for q in queries]
+        brute_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        
+        n_lists = len(state.ann_index.centroids)
+        if n_probes is None:
+            n_probes = sorted({p for p in (1, 2, 4, 8, 16, 32, 64) if p <= n_lists} | {state.ann_index.n_probe})
+        
+        results = []
+        for n_probe in n_probes:
+            hits = 0
+            scanned = 0
+            start = time.perf_counter()
+            for q, expected in zip(queries, truth):
+                rows = state.ann_index.candidates(q, n_probe)
+                scanned += len(rows)
+                top = state.top_k(state.similarities_at(q, rows), k)
+                hits += len(expected & set(rows[top].tolist()))
+            latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            results.append({
+                "n_probe": n_probe,
+                f"recall@{k}": hits / sum(len(t) for t in truth),
+                "avg_latency_ms": round(latency_ms, 3),
+                "avg_candidates": scanned / len(queries)
             })
         
-        self.save()
-        return {"status": "success", "count": len(documents)}
+        return {
+            "status": "success",
+            "total_documents": total,
+            "n_lists": n_lists,
+            "queries": len(queries),
+            "k": k,
+            "brute_force_latency_ms": round(brute_ms, 3),
+            "results": results
+        }
     
-    def search(self, query: str, n_results: int = 5) -> Dict:
-        """Tìm kiếm documents tương tự"""
-        if not self.documents:
-            return {"documents": [], "distances": [], "metadatas": [], "ids": []}
-        
-        # Tạo embedding cho query
-        result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=query,
-            task_type="retrieval_query"
-        )
-        query_embedding = result['embedding']
-        
-        # Tính similarity với tất cả documents
-        similarities = []
-        for doc in self.documents:
-            similarity = cosine_similarity(query_embedding, doc['embedding'])
-            similarities.append({
-                "document": doc['document'],
-                "distance": 1 - similarity,
-                "metadata": doc['metadata'],
-                "id": doc['id'],
-                "similarity": similarity
+    def quantization_report(self, k: int = 5, sample_size: int = 100, seed: int = 0) -> Dict:
+        """
+        Đo bộ nhớ và recall@k của chế độ int8 + re-rank so với float32 chính xác
+        
+        Dùng embeddings của các documents ngẫu nhiên làm query (không gọi API).
+        """
+        state = self._state
+        total = len(state.documents)
+        if not state.index_ready(state.quantizer) or total == 0:
+            return {"status": "unavailable", "message": "Quantizer chưa được bật hoặc chưa train", "total_documents": total}
+        
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(total, min(sample_size, total), replace=False)
+        queries = state.all_embeddings()[sample]
+        dim = queries.shape[1]
+        
+        start = time.perf_counter()
+        truth = [set(state.top_k(state.similarities(q), k).tolist()) for q in queries]
+        exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        
+        results = []
+        for rerank_factor in sorted({1, 2, 4, 8, state.quantizer.rerank_factor}):
+            shortlist_size = rerank_factor * k
+            hits_int8_only = 0
+            hits = 0
+            start = time.perf_counter()
+            for q, expected in zip(queries, truth):
+                approx = state.quantizer.scores(q)
+                shortlist = state.top_k(approx, shortlist_size)
+                hits_int8_only += len(expected & set(shortlist[:k].tolist()))
+                top = state.top_k(state.similarities_at(q, shortlist), k)
+                hits += len(expected & set(shortlist[top].tolist()))
+            latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            expected_total = sum(len(t) for t in truth)
+            results.append({
+                "rerank_factor": rerank_factor,
+                f"recall@{k}_int8_only": hits_int8_only / expected_total,
+                f"recall@{k}_reranked": hits / expected_total,
+                "avg_latency_ms": round(latency_ms, 3)
             })
         
-        # Sắp xếp theo similarity
-        similarities.sort(key=lambda x: x['similarity'], reverse=True)
-        top_results = similarities[:n_results]
-        
+        float32_bytes = total * dim * 4
         return {
-            "documents": [r['document'] for r in top_results],
-            "distances": [r['distance'] for r in top_results],
-            "metadatas": [r['metadata'] for r in top_results],
-            "ids": [r['id'] for r in top_results]
+            "status": "success",
+            "total_documents": total,
+            "dimension": dim,
+            "queries": len(queries),
+            "k": k,
+            "memory": {
+                "float32_bytes": float32_bytes,
+                "int8_bytes": state.quantizer.nbytes,
+                "savings_ratio": round(float32_bytes / max(1, state.quantizer.nbytes), 2)
+            },
+            "exact_latency_ms": round(exact_ms, 3),
+            "results": results
         }
     
+    @staticmethod
+    def _without_documents(current: VectorDBState, id_set: set):
+        """(State mới không còn các IDs trong id_set, số documents bị xóa)"""
+        remaining = [doc for doc in current.documents if doc['id'] not in id_set]
+        deleted = len(current.documents) - len(remaining)
+        if not deleted:
+            return current, 0
+        keep = np.array([doc['id'] not in id_set for doc in current.documents], dtype=bool)
+        embeddings = current.all_embeddings()[keep]
+        state = current.copy()
+        state.documents = AppendOnlyList(remaining)
+        # Phần còn lại nằm trong RAM cho tới lần compact tiếp theo
+        state.reset_embeddings(None, embeddings)
+        state.reindex()
+        for index in state.vector_indexes():
+            if remaining:
+                index.reassign(embeddings)
+            else:
+                index.reset()
+        return state, deleted
+    
+    @staticmethod
+    def _with_metadata(current: VectorDBState, updates: Dict[str, Dict]) -> VectorDBState:
+        """State mới với metadata của các IDs trong updates được thay (embeddings, BM25 giữ nguyên)"""
+        documents = [
+            {**doc, "metadata": updates[doc['id']]} if doc['id'] in updates else doc
+            for doc in current.documents
+        ]
+        state = current.copy()
+        state.documents = AppendOnlyList(documents)
+        # Metadata index chỉ cần dựng lại khi đổi giá trị của trường được index
+        fields = state.metadata_index.fields
+        if any(
+            (old['metadata'] or {}).get(field) != (new['metadata'] or {}).get(field)
+            for old, new in zip(current.documents, documents) if old is not new
+            for field in fields
+        ):
+            state.metadata_index.rebuild([doc['metadata'] for doc in documents])
+        return state
+    
+    @staticmethod
+    def _cleared(current: VectorDBState) -> VectorDBState:
+        """State rỗng (giữ cấu hình index)"""
+        state = current.copy()
+        state.documents = AppendOnlyList()
+        state.reset_embeddings()
+        state.reindex()
+        for index in state.vector_indexes():
+            index.reset()
+        return state
+    
+    def delete_documents(self, ids: List[str]) -> Dict:
+        """Xóa documents theo IDs (ghi tombstone vào log)"""
+        with self._write_lock, self.store.locked():
+            self._catch_up()
+            state, deleted = self._without_documents(self._state, set(ids))
+            if deleted:
+                self.store.delete(ids)
+                self._state = state
+                self._track_fingerprints(removed=ids)
+                self._maybe_compact()
+        return {"status": "success", "deleted": deleted}
+    
     def delete_all(self):
         """Xóa tất cả documents"""
-        self.documents = []
-        self.save()
+        with self._write_lock, self.store.locked():
+            self._catch_up()
+            self.store.clear()
+            self._state = self._cleared(self._state)
+            self.fingerprints.reset()
+            self._maybe_compact()
         return {"status": "success", "message": "All documents deleted"}
     
     def get_count(self) -> int:
         """Lấy số lượng documents"""
-        return len(self.documents)
+        self._maybe_refresh()
+        return len(self._state.documents)
+    
+    def memory_usage(self) -> int:
+        """Ước lượng bộ nhớ (bytes) của state hiện tại"""
+        return self._state.memory_usage()
+    
+    def get_metadata_counts(self, field: str = "category", missing: str = "unknown") -> Dict:
+        """
+        Số documents theo từng giá trị của 1 trường metadata được index
+        
+        O(#giá trị) từ posting lists thay vì quét toàn bộ documents.
+        Documents không có trường này được đếm vào `missing` (trừ trường nhiều giá trị như tags).
+        """
+        self._maybe_refresh()
+        state = self._state
+        counts = state.metadata_index.value_counts(field)
+        if field != "tags":
+            without_field = len(state.documents) - sum(counts.values())
+            if without_field > 0:
+                counts[missing] = counts.get(missing, 0) + without_field
+        return counts
     
     def get_all_documents(self) -> Dict:
         """Lấy tất cả documents"""
+        self._maybe_refresh()
+        documents = self._state.documents
+        return {
+            "documents": [doc['document'] for doc in documents],
+            "metadatas": [doc['metadata'] for doc in documents],
+            "ids": [doc['id'] for doc in documents],
+            "count": len(documents)
+        }
+    
+    @staticmethod
+    def _cursor_row(state: VectorDBState, position: Dict) -> int:
+        """
+        Dòng bắt đầu của trang sau cursor
+        
+        Cursor giữ (offset, id cuối trang trước). Delete chỉ dồn các dòng lên trước,
+        nên nếu dòng offset-1 không còn là id đó thì dò ngược từ offset để tìm lại.
+        """
+        documents = state.documents
+        offset = min(max(0, int(position.get("offset", 0))), len(documents))
+        last_id = position.get("last_id")
+        if last_id is None or (offset and documents[offset - 1]['id'] == last_id):
+            return offset
+        for row in range(offset - 1, -1, -1):
+            if documents[row]['id'] == last_id:
+                return row + 1
+        # id cuối trang trước đã bị xóa: tiếp tục từ offset cũ
+        return offset
+    
+    @staticmethod
+    def _export_rows(
+        state: VectorDBState,
+        start: int,
+        end: int,
+        include_embeddings: bool = False,
+        include_documents: bool = True,
+        max_text_chars: Optional[int] = None
+    ):
+        embeddings = None
+        if include_embeddings and end > start:
+            embeddings, _ = state.gather_rows(np.arange(start, end))
+        for i, doc in enumerate(state.documents[start:end]):
+            yield export_record(
+                doc['id'], doc['document'], doc['metadata'],
+                embedding=embeddings[i] if embeddings is not None else None,
+                include_documents=include_documents,
+                max_text_chars=max_text_chars
+            )
+    
+    def get_documents_page(
+        self,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        include_embeddings: bool = False,
+        include_documents: bool = True,
+        max_text_chars: Optional[int] = None
+    ) -> Dict:
+        """
+        1 trang documents theo thứ tự thêm vào (cursor-based)
+        
+        Returns:
+            Dict items / count / total / next_cursor (None = trang cuối)
+        
+        Raises:
+            ValueError: Cursor không hợp lệ
+        """
+        self._maybe_refresh()
+        state = self._state
+        limit = clamp_page_size(limit)
+        start = self._cursor_row(state, decode_cursor(cursor))
+        end = min(start + limit, len(state.documents))
+        items = list(self._export_rows(state, start, end, include_embeddings, include_documents, max_text_chars))
+        next_cursor = None
+        if end < len(state.documents):
+            next_cursor = encode_cursor({"offset": end, "last_id": state.documents[end - 1]['id']})
         return {
-            "documents": [doc['document'] for doc in self.documents],
-            "metadatas": [doc['metadata'] for doc in self.documents],
-            "ids": [doc['id'] for doc in self.documents],
-            "count": len(self.documents)
+            "items": items,
+            "count": len(items),
+            "total": len(state.documents),
+            "next_cursor": next_cursor
         }
+    
+    def iter_documents(
+        self,
+        batch_size: int = 500,
+        include_embeddings: bool = False,
+        include_documents: bool = True,
+        max_text_chars: Optional[int] = None
+    ):
+        """
+        Duyệt toàn bộ documents, mỗi lần sinh 1 record (cho export NDJSON)
+        
+        Giữ 1 state cố định suốt lần duyệt: write đồng thời không làm lệch / lặp record.
+        Embeddings được lấy theo từng batch nên không dựng ma trận đầy đủ.
+        """
+        self._maybe_refresh()
+        state = self._state
+        for start in range(0, len(state.documents), batch_size):
+            end = min(start + batch_size, len(state.documents))
+            yield from self._export_rows(state, start, end, include_embeddings, include_documents, max_text_chars)
 
 # ============================================================================
 # FASTAPI APP SETUP
@@ -240,7 +1283,81 @@ app.add_middleware(
 )
 
 # Initialize Vector Database
-vector_db = SimpleVectorDB(storage_file="knowledge_base.json")
+# Cache embeddings theo (model, task_type, sha256(text)) dùng chung cho ingest, auto-prompt và search
+embedding_cache = EmbeddingCache(
+    db_path=os.getenv("EMBED_CACHE_FILE", "embedding_cache.sqlite3"),
+    max_memory_items=int(os.getenv("EMBED_CACHE_MEMORY_ITEMS", 10000))
+)
+embedding_batcher = EmbeddingBatcher(
+    batch_size=int(os.getenv("EMBED_BATCH_SIZE", 100)),
+    max_concurrency=int(os.getenv("EMBED_MAX_CONCURRENCY", 4)),
+    max_retries=int(os.getenv("EMBED_MAX_RETRIES", 5)),
+    cache=embedding_cache
+)
+# ANN index: VECTOR_INDEX=ivf để bật IVF-flat (mặc định brute-force "flat")
+def create_ann_index() -> Optional[IVFFlatIndex]:
+    if os.getenv("VECTOR_INDEX", "flat").lower() != "ivf":
+        return None
+    return IVFFlatIndex(
+        n_lists=int(os.getenv("IVF_N_LISTS", 0)),
+        n_probe=int(os.getenv("IVF_N_PROBE", 8)),
+        min_train_size=int(os.getenv("IVF_MIN_TRAIN_SIZE", 1000))
+    )
+
+# Quantization: VECTOR_QUANTIZATION=int8 để chấm điểm vòng 1 trên mã int8 rồi re-rank float32
+def create_quantizer() -> Optional[Int8Quantizer]:
+    if os.getenv("VECTOR_QUANTIZATION", "none").lower() != "int8":
+        return None
+    return Int8Quantizer(
+        rerank_factor=int(os.getenv("QUANT_RERANK_FACTOR", 4)),
+        min_train_size=int(os.getenv("QUANT_MIN_TRAIN_SIZE", 1000))
+    )
+
+# Nhiều uvicorn worker (UVICORN_WORKERS > 1): bật chế độ shared để mọi worker thấy documents
+# do worker khác thêm sau tối đa VECTOR_DB_REFRESH_SECONDS
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", 1))
+VECTOR_DB_SHARED = os.getenv("VECTOR_DB_SHARED", str(UVICORN_WORKERS > 1)).lower() == "true"
+
+# Chặn documents gần trùng khi thêm prompt / documents: skip | merge | off (mặc định: off, phải bật rõ ràng)
+DEDUPE_MODE = (os.getenv("DEDUPE_MODE") or "off").lower()
+if DEDUPE_MODE != "off" and DEDUPE_MODE not in DEDUPE_MODES:
+    raise ValueError(f"Invalid DEDUPE_MODE: {DEDUPE_MODE}. Use off or one of {DEDUPE_MODES}")
+DEDUPE = None if DEDUPE_MODE == "off" else DEDUPE_MODE
+
+def create_vector_db(storage_file: str) -> SimpleVectorDB:
+    """SimpleVectorDB với ANN index / quantizer riêng (mỗi segment 1 instance)"""
+    return SimpleVectorDB(
+        storage_file=storage_file,
+        embedder=embedding_batcher,
+        ann_index=create_ann_index(),
+        quantizer=create_quantizer(),
+        shared=VECTOR_DB_SHARED,
+        refresh_interval=float(os.getenv("VECTOR_DB_REFRESH_SECONDS", 1.0)),
+        dedupe_similarity=float(os.getenv("DEDUPE_SIMILARITY", 0.95)),
+        dedupe_simhash_distance=int(os.getenv("DEDUPE_SIMHASH_DISTANCE", 3))
+    )
+
+# Segment global (dùng chung) giữ nguyên file knowledge_base.json
+vector_db = create_vector_db("knowledge_base.json")
+# Segment theo user / course: load lười, evict LRU khi vượt SEGMENT_MEMORY_BUDGET_MB
+vector_segments = SegmentManager(
+    factory=create_vector_db,
+    global_db=vector_db,
+    segment_dir=os.getenv("SEGMENT_DIR", "knowledge_segments"),
+    memory_budget_bytes=int(float(os.getenv("SEGMENT_MEMORY_BUDGET_MB", 512)) * 1024 * 1024)
+)
+
+# Các bước blocking của /api/chat (requests tới Spring Boot / Groq / trang trường, Gmail, embed + search)
+# chạy trên executor có giới hạn thay vì trên event loop: 1 upstream chậm không chặn các request khác
+chat_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CHAT_BLOCKING_WORKERS", 32)),
+    thread_name_prefix="chat-blocking"
+)
+
+async def run_blocking(func, *args, **kwargs):
+    """Chạy hàm blocking trên chat_executor và await kết quả"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(chat_executor, partial(func, *args, **kwargs))
 
 # Initialize Agent Features
 if AGENT_FEATURES_AVAILABLE:
@@ -403,7 +1520,7 @@ Nếu bạn cần phân tích ảnh chi tiết, vui lòng chuyển sang Gemini."
 # HELPER FUNCTIONS
 # ============================================================================
 
-def get_user_id_from_token(token: str) -> Optional[int]:
+def fetch_user_id_from_profile(token: str) -> Optional[int]:
     """
     Get user_id from JWT token by calling Spring Boot API
     
@@ -413,9 +1530,6 @@ def get_user_id_from_token(token: str) -> Optional[int]:
     Returns:
         user_id (int) or None if failed
     """
-    if not token:
-        return None
-    
     try:
         # Call Spring Boot API to get user profile
         headers = {"Authorization": f"Bearer {token}"}
@@ -437,6 +1551,60 @@ def get_user_id_from_token(token: str) -> Optional[int]:
         print(f"❌ Error getting user_id from token: {e}")
         return None
 
+# Token -> user_id: verify JWT cục bộ nếu có JWT_SECRET (jwt.secret của Spring Boot),
+# cache theo TTL (không vượt quá exp) + single-flight, chỉ gọi profile khi thật sự cần
+identity_resolver = IdentityResolver(
+    fetch_user_id_from_profile,
+    signing_key=os.getenv("JWT_SECRET") or None,
+    cache_ttl=float(os.getenv("IDENTITY_CACHE_TTL", 300)),
+    max_entries=int(os.getenv("IDENTITY_CACHE_SIZE", 10000))
+)
+
+def get_user_id_from_token(token: str) -> Optional[int]:
+    """
+    Get user_id from JWT token (verify cục bộ / cache, gọi Spring Boot khi cache miss)
+    
+    Args:
+        token: JWT token string
+    
+    Returns:
+        user_id (int) or None if failed
+    """
+    return identity_resolver.resolve(token)
+
+def authorized_segment(
+    authorization: Optional[str],
+    user_id=None,
+    course_id: Optional[str] = None,
+    write: bool = False
+):
+    """
+    (user_id, course_id) mà request được phép dùng với vector_segments
+    
+    user_id luôn lấy từ token (như /api/chat), không tin giá trị client gửi lên:
+    - Token sai / hết hạn -> 401
+    - user_id trong request khác user của token (hoặc không có token) -> 401 / 403
+    - Đọc: có token thì phạm vi gồm cả segment của user đó
+    - Ghi: chỉ ghi vào segment user khi request có user_id; ghi vào segment course cần token
+    """
+    token_user_id = None
+    if authorization and authorization.startswith("Bearer "):
+        token_user_id = get_user_id_from_token(authorization.replace("Bearer ", ""))
+        if token_user_id is None:
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
+    
+    if user_id not in (None, ""):
+        if token_user_id is None:
+            raise HTTPException(status_code=401, detail="Authorization required to access a user segment")
+        if str(user_id) != str(token_user_id):
+            raise HTTPException(status_code=403, detail="Cannot access another user's documents")
+    if write and course_id not in (None, "") and token_user_id is None:
+        raise HTTPException(status_code=401, detail="Authorization required to write to a course segment")
+    
+    if write and user_id in (None, ""):
+        return None, course_id
+    return token_user_id, course_id
+
 # ============================================================================
 # PYDANTIC MODELS
 # ============================================================================
@@ -448,6 +1616,7 @@ class ChatRequest(BaseModel):
     use_rag: bool = True
     image_base64: Optional[str] = None  # Base64 encoded image for vision analysis
     image_mime_type: Optional[str] = None  # e.g., "image/jpeg", "image/png"
+    course_id: Optional[str] = None  # RAG tìm thêm trong segment của khóa học này
     
     model_config = ConfigDict(
         json_schema_extra={
@@ -513,6 +1682,9 @@ class ChatResponse(BaseModel):
 class DocumentRequest(BaseModel):
     documents: List[str]
     metadatas: Optional[List[dict]] = None
+    user_id: Optional[str] = None  # Lưu vào segment riêng của user (phải khớp token; mặc định: segment global)
+    course_id: Optional[str] = None  # Lưu vào segment của khóa học
+    dedupe: Optional[str] = None  # skip | merge | off (mặc định: DEDUPE_MODE)
     
     model_config = ConfigDict(
         json_schema_extra={
@@ -529,6 +1701,8 @@ class PromptRAGRequest(BaseModel):
     prompt: str
     category: Optional[str] = "general"
     tags: Optional[List[str]] = None
+    user_id: Optional[str] = None  # Lưu vào segment của user (phải khớp token)
+    course_id: Optional[str] = None  # Lưu vào segment của khóa học
     
     model_config = ConfigDict(
         json_schema_extra={
@@ -547,6 +1721,8 @@ class PromptRAGRequest(BaseModel):
 
 class SimplePromptRequest(BaseModel):
     prompt: str
+    user_id: Optional[str] = None  # Lưu vào segment của user (phải khớp token)
+    course_id: Optional[str] = None  # Lưu vào segment của khóa học
     
     model_config = ConfigDict(
         json_schema_extra={
@@ -559,6 +1735,17 @@ class SimplePromptRequest(BaseModel):
 class SearchRequest(BaseModel):
     query: str
     n_results: int = 5
+    where: Optional[dict] = None  # Filter metadata, vd: {"category": "programming"}
+    mode: str = "vector"  # vector | lexical (BM25, không gọi embedding) | hybrid (RRF)
+    user_id: Optional[str] = None  # Phải khớp token (segment của user lấy từ token)
+    course_id: Optional[str] = None  # Tìm thêm trong segment của khóa học
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str]
+    n_results: int = 5
+    where: Optional[dict] = None  # Filter metadata áp dụng cho tất cả queries
+    user_id: Optional[str] = None  # Phải khớp token (segment của user lấy từ token)
+    course_id: Optional[str] = None  # Tìm thêm trong segment của khóa học
 
 # ============================================================================
 # API ENDPOINTS
@@ -567,7 +1754,7 @@ class SearchRequest(BaseModel):
 @app.get("/", tags=["Health"])
 async def root():
     """Health check endpoint"""
-    doc_count = vector_db.get_count()
+    doc_count = await run_blocking(vector_db.get_count)
     return {
         "status": "running",
         "service": "AI Chat Service with RAG",
@@ -808,6 +1995,18 @@ async def test_tvu_schedule(request: TVUTestRequest):
         return {"success": False, "message": f"❌ Lỗi: {str(e)}"}
 
 
+def decode_chat_image(image_base64: str):
+    """Base64 -> PIL Image (ảnh gửi kèm tin nhắn chat)"""
+    import base64
+    from PIL import Image
+    import io
+    
+    image_data = base64.b64decode(image_base64)
+    print(f"   Decoded image size: {len(image_data)} bytes")
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+    return image
+
 @app.post("/api/chat", response_model=ChatResponse, tags=["Chat"])
 async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)):
     """
@@ -834,7 +2033,7 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
         if authorization and authorization.startswith("Bearer "):
             token = authorization.replace("Bearer ", "")
             # Get user_id from token
-            user_id = get_user_id_from_token(token)
+            user_id = await run_blocking(get_user_id_from_token, token)
         
         print(f"\n{'='*60}")
         print(f"📨 NEW CHAT REQUEST")
@@ -869,7 +2068,8 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
             
         elif GOOGLE_CLOUD_AGENT_AVAILABLE and google_cloud_agent:
             # Check for Google Cloud intents
-            gc_result = google_cloud_agent.handle_google_cloud_request(
+            gc_result = await run_blocking(
+                google_cloud_agent.handle_google_cloud_request,
                 message=request.message,
                 token=token or "",
                 image_url=None,  # TODO: Extract from message if available
@@ -905,7 +2105,7 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
                     agent_features.detect_gmail_search_intent(request.message)):
                     # Use OAuth Gmail API - requires authentication
                     print(f"📧 Using Gmail OAuth API (authenticated) - User ID: {user_id}")
-                    result = agent_features.handle_gmail_request(request.message, token, user_id=user_id)
+                    result = await run_blocking(agent_features.handle_gmail_request, request.message, token, user_id=user_id)
                 else:
                     # Email draft generation - NO authentication required
                     # Check if user provided email address
@@ -915,12 +2115,12 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
                     # Try to use Gmail handler which has better logic
                     if agent_features.detect_gmail_send_intent(request.message):
                         # This will auto-generate draft even without OAuth
-                        result = agent_features.handle_gmail_send(request.message, "", user_id=None)
+                        result = await run_blocking(agent_features.handle_gmail_send, request.message, "", user_id=None)
                     else:
                         # Fallback to legacy method if available
                         if token:
                             gemini_model = genai.GenerativeModel(request.model)
-                            result = agent_features.handle_email_request(request.message, token, gemini_model)
+                            result = await run_blocking(agent_features.handle_email_request, request.message, token, gemini_model)
                         else:
                             result = {
                                 "success": False,
@@ -957,7 +2157,7 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
             # Check for schedule intent
             if token and agent_features.detect_schedule_intent(request.message):
                 print(f"📅 Detected schedule intent in: {request.message}")
-                result = agent_features.get_schedule(token, message=request.message, force_sync=False)
+                result = await run_blocking(agent_features.get_schedule, token, message=request.message, force_sync=False)
                 
                 # Safely convert to string
                 response_text = result.get('message', '')
@@ -974,7 +2174,7 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
             # Check for grade intent
             if token and agent_features.detect_grade_intent(request.message):
                 print(f"📊 Detected grade intent in: {request.message}")
-                result = agent_features.get_grades(token)
+                result = await run_blocking(agent_features.get_grades, token)
                 
                 # Safely convert to string
                 response_text = result.get('message', '')
@@ -990,7 +2190,8 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
         # Detect tool action (YouTube, Google, Wikipedia) - ONLY if NO image
         tool_action = None
         if not has_image_input:
-            tool_action = detect_tool_intent(request.message)
+            # Intent "phát ..." tìm video YouTube bằng requests.get (blocking)
+            tool_action = await run_blocking(detect_tool_intent, request.message)
         
         if tool_action:
             # AI xác nhận action
@@ -1041,8 +2242,12 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
         prompt = request.message
         
         # Nếu bật RAG, tìm kiếm context từ vector DB
-        if request.use_rag and vector_db.get_count() > 0:
-            search_results = vector_db.search(request.message, n_results=3)
+        if request.use_rag:
+            # Chỉ quét segment global + segment của user / course đang hỏi
+            search_results = await run_blocking(
+                vector_segments.search,
+                request.message, n_results=3, user_id=user_id, course_id=request.course_id
+            )
             context_docs = search_results['documents']
             
             if context_docs:
@@ -1079,16 +2284,8 @@ Hãy trả lời dựa trên kiến thức của bạn."""
             print(f"   MIME type: {request.image_mime_type}")
             print(f"   Base64 length: {len(request.image_base64)}")
             
-            import base64
-            from PIL import Image
-            import io
-            
-            # Decode base64 image
-            image_data = base64.b64decode(request.image_base64)
-            print(f"   Decoded image size: {len(image_data)} bytes")
-            
-            # Convert bytes to PIL Image
-            image = Image.open(io.BytesIO(image_data))
+            # Decode base64 + PIL (CPU) trên executor
+            image = await run_blocking(decode_chat_image, request.image_base64)
             print(f"   Image format: {image.format}, Size: {image.size}")
             
             # Validate image
@@ -1160,7 +2357,8 @@ Hãy trả lời dựa trên kiến thức của bạn."""
                     
                     vision_prompt = request.message if request.message.strip() else "Hãy phân tích và mô tả chi tiết nội dung trong ảnh này"
                     
-                    ai_response = groq_client.generate_with_vision(
+                    ai_response = await run_blocking(
+                        groq_client.generate_with_vision,
                         prompt=vision_prompt,
                         image_base64=request.image_base64,
                         image_mime_type=request.image_mime_type,
@@ -1181,7 +2379,8 @@ Hãy trả lời dựa trên kiến thức của bạn."""
                     # Use content_parts[0] which may contain context
                     groq_final_prompt = content_parts[0] if isinstance(content_parts[0], str) else request.message
                     
-                    ai_response = groq_client.generate_text(
+                    ai_response = await run_blocking(
+                        groq_client.generate_text,
                         prompt=groq_final_prompt,
                         system_prompt=system_prompt,
                         model=groq_model
@@ -1194,7 +2393,7 @@ Hãy trả lời dựa trên kiến thức của bạn."""
                 traceback.print_exc()
                 # Fallback to Gemini with default Gemini model
                 gemini_model = genai.GenerativeModel("gemini-2.0-flash-exp")
-                response = gemini_model.generate_content(prompt)
+                response = await gemini_model.generate_content_async(prompt)
                 ai_response = response.text
                 actual_model = "gemini-2.0-flash-exp (fallback)"
         elif request.ai_provider == "groq" and not groq_client:
@@ -1202,7 +2401,7 @@ Hãy trả lời dựa trên kiến thức của bạn."""
             # Fallback to Gemini
             gemini_model_name = "gemini-2.0-flash-exp"
             model = genai.GenerativeModel(gemini_model_name)
-            response = model.generate_content(prompt)
+            response = await model.generate_content_async(prompt)
             ai_response = response.text
             actual_model = f"{gemini_model_name} (Groq unavailable)"
         else:
@@ -1221,7 +2420,7 @@ Hãy trả lời dựa trên kiến thức của bạn."""
             
             try:
                 print(f"📤 Sending to Gemini...")
-                response = model.generate_content(content_parts)
+                response = await model.generate_content_async(content_parts)
                 ai_response = response.text
                 actual_model = gemini_model_name
                 print(f"✅ Gemini response received: {len(ai_response)} chars")
@@ -1316,7 +2515,7 @@ async def send_email_confirmed(request: SendEmailRequest, authorization: Optiona
         if not user_id and authorization and authorization.startswith("Bearer "):
             token = authorization.replace("Bearer ", "")
             print(f"📧 Extracting user_id from token...")
-            user_id = get_user_id_from_token(token)
+            user_id = await run_blocking(get_user_id_from_token, token)
             print(f"📧 Got user_id from token: {user_id}")
         
         # If still no user_id, return clear error
@@ -1333,7 +2532,8 @@ async def send_email_confirmed(request: SendEmailRequest, authorization: Optiona
         from gmail_service import ai_send_email
         
         # Send email
-        result = ai_send_email(
+        result = await run_blocking(
+            ai_send_email,
             user_id=user_id,
             to=request.to,
             subject=request.subject,
@@ -1363,7 +2563,7 @@ async def send_email_confirmed(request: SendEmailRequest, authorization: Optiona
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
 @app.post("/api/rag/prompt/auto", tags=["RAG - Knowledge Base"])
-async def add_prompt_auto(request: SimplePromptRequest):
+async def add_prompt_auto(request: SimplePromptRequest, authorization: Optional[str] = Header(None)):
     """
     Thêm prompt với AI tự động sinh category và tags
     
@@ -1371,6 +2571,9 @@ async def add_prompt_auto(request: SimplePromptRequest):
     
     AI sẽ tự động phân tích và sinh category + tags phù hợp
     """
+    user_id, course_id = await run_blocking(
+        authorized_segment, authorization, request.user_id, request.course_id, write=True
+    )
     try:
         # Dùng Gemini để phân tích và sinh metadata
         analysis_prompt = f"""Phân tích văn bản sau và trả về JSON:
@@ -1414,25 +2617,30 @@ Chỉ trả về JSON."""
             "summary": summary
         }
         
-        result = vector_db.add_documents(
+        result = await run_blocking(
+            vector_segments.add_documents,
             documents=[request.prompt],
-            metadatas=[metadata]
+            metadatas=[metadata],
+            user_id=user_id,
+            course_id=course_id,
+            dedupe=DEDUPE
         )
         
         return {
             "status": "success",
-            "message": "Đã thêm prompt với metadata tự động",
+            "message": "Prompt đã có trong RAG knowledge base" if result.get("skipped") else "Đã thêm prompt với metadata tự động",
             "prompt": request.prompt,
             "category": category,
             "tags": tags,
             "summary": summary,
-            "total_documents": vector_db.get_count()
+            "segment": result['segment'],
+            "total_documents": await run_blocking(vector_segments.get_count, user_id, course_id)
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
 @app.post("/api/rag/prompt", tags=["RAG - Knowledge Base"])
-async def add_rag_prompt(request: PromptRAGRequest):
+async def add_rag_prompt(request: PromptRAGRequest, authorization: Optional[str] = Header(None)):
     """
     Thêm prompt/kiến thức vào RAG Knowledge Base
     
@@ -1442,6 +2650,9 @@ async def add_rag_prompt(request: PromptRAGRequest):
     
     AI sẽ tự động phân tích và sinh category + tags nếu không cung cấp
     """
+    user_id, course_id = await run_blocking(
+        authorized_segment, authorization, request.user_id, request.course_id, write=True
+    )
     try:
         # Nếu không có category hoặc tags, dùng AI để sinh tự động
         category = request.category
@@ -1491,106 +2702,285 @@ Chỉ trả về JSON, không thêm text khác."""
             "type": "prompt"
         }
         
-        result = vector_db.add_documents(
+        result = await run_blocking(
+            vector_segments.add_documents,
             documents=[request.prompt],
-            metadatas=[metadata]
+            metadatas=[metadata],
+            user_id=user_id,
+            course_id=course_id,
+            dedupe=DEDUPE
         )
         
         return {
             "status": "success",
-            "message": "Đã thêm prompt vào RAG knowledge base",
+            "message": "Prompt đã có trong RAG knowledge base" if result.get("skipped") else "Đã thêm prompt vào RAG knowledge base",
             "prompt": request.prompt,
             "category": category,
             "tags": tags,
             "auto_generated": request.category == "general" or not request.tags,
-            "total_documents": vector_db.get_count()
+            "segment": result['segment'],
+            "total_documents": await run_blocking(vector_segments.get_count, user_id, course_id)
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
 @app.post("/api/documents/add", tags=["RAG - Knowledge Base"])
-async def add_documents(request: DocumentRequest):
-    """Thêm nhiều documents vào Vector Database"""
+def add_documents(request: DocumentRequest, authorization: Optional[str] = Header(None)):
+    """
+    Thêm nhiều documents vào Vector Database
+    
+    Endpoint đồng bộ (FastAPI chạy trong threadpool) để bulk ingest không chặn event loop của chat.
+    Ghi vào segment của user cần Authorization của chính user đó.
+    """
+    user_id, course_id = authorized_segment(authorization, request.user_id, request.course_id, write=True)
+    dedupe = DEDUPE if request.dedupe is None else request.dedupe.lower()
     try:
-        result = vector_db.add_documents(
+        result = vector_segments.add_documents(
             documents=request.documents,
-            metadatas=request.metadatas
+            metadatas=request.metadatas,
+            user_id=user_id,
+            course_id=course_id,
+            dedupe=None if dedupe == "off" else dedupe
         )
-        return {
-            "status": "success",
+        response = {
+            "status": result['status'],
             "message": f"Đã thêm {result['count']} documents",
-            "total_documents": vector_db.get_count()
+            "skipped": result['skipped'],
+            "segment": result['segment'],
+            "total_documents": vector_segments.get_count(user_id, course_id)
         }
+        if result['skipped']:
+            response["message"] += f" ({result['skipped']} documents gần trùng bị bỏ qua)"
+        if result.get('failed'):
+            response["message"] += f" ({result['failed']} documents lỗi embedding)"
+            response["failed_ids"] = result['failed_ids']
+        return response
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
 @app.post("/api/documents/search", tags=["RAG - Knowledge Base"])
-async def search_documents(request: SearchRequest):
-    """Tìm kiếm documents tương tự trong Vector Database"""
+async def search_documents(request: SearchRequest, authorization: Optional[str] = Header(None)):
+    """
+    Tìm kiếm documents tương tự trong Vector Database
+    
+    Chỉ quét segment global + segment của user (theo token) / course_id (nếu có)
+    """
+    user_id, course_id = await run_blocking(authorized_segment, authorization, request.user_id, request.course_id)
     try:
-        results = vector_db.search(request.query, request.n_results)
+        results = await run_blocking(
+            vector_segments.search,
+            request.query,
+            request.n_results,
+            where=request.where,
+            mode=request.mode,
+            user_id=user_id,
+            course_id=course_id
+        )
+        items = [
+            {
+                "document": doc,
+                "distance": dist,
+                "metadata": meta,
+                "id": doc_id,
+                "segment": segment
+            }
+            for doc, dist, meta, doc_id, segment in zip(
+                results['documents'],
+                results['distances'],
+                results['metadatas'],
+                results['ids'],
+                results['segments']
+            )
+        ]
+        for item, score in zip(items, results.get('scores', [])):
+            item["score"] = score
         return {
             "query": request.query,
+            "mode": request.mode,
+            "results": items,
+            "count": len(results['documents'])
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
+
+@app.post("/api/documents/search/batch", tags=["RAG - Knowledge Base"])
+async def search_documents_batch(request: BatchSearchRequest, authorization: Optional[str] = Header(None)):
+    """
+    Tìm kiếm nhiều queries trong 1 request (vd: tạo quiz nhiều chủ đề)
+    
+    Tất cả queries được embed trong 1 lần gọi và chấm điểm cùng lúc bằng phép nhân ma trận,
+    trên segment global + segment của user (theo token) / course_id (nếu có)
+    """
+    user_id, course_id = await run_blocking(authorized_segment, authorization, request.user_id, request.course_id)
+    try:
+        batch_results = await run_blocking(
+            vector_segments.search_batch,
+            request.queries, request.n_results, where=request.where, user_id=user_id, course_id=course_id
+        )
+        return {
             "results": [
                 {
-                    "document": doc,
-                    "distance": dist,
-                    "metadata": meta,
-                    "id": doc_id
+                    "query": query,
+                    "results": [
+                        {
+                            "document": doc,
+                            "distance": dist,
+                            "metadata": meta,
+                            "id": doc_id,
+                            "segment": segment
+                        }
+                        for doc, dist, meta, doc_id, segment in zip(
+                            results['documents'],
+                            results['distances'],
+                            results['metadatas'],
+                            results['ids'],
+                            results['segments']
+                        )
+                    ],
+                    "count": len(results['documents'])
                 }
-                for doc, dist, meta, doc_id in zip(
-                    results['documents'],
-                    results['distances'],
-                    results['metadatas'],
-                    results['ids']
-                )
+                for query, results in zip(request.queries, batch_results)
             ],
-            "count": len(results['documents'])
+            "count": len(batch_results)
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
 @app.get("/api/documents", tags=["RAG - Knowledge Base"])
-async def get_all_documents():
-    """Lấy tất cả documents trong Vector Database"""
+async def get_all_documents(
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_embeddings: bool = False,
+    include_documents: bool = True,
+    max_text_chars: Optional[int] = None,
+    course_id: Optional[str] = None,
+    authorization: Optional[str] = Header(None)
+):
+    """
+    Lấy documents trong Vector Database (segment global + user theo token + course_id)
+    
+    - Không có cursor/limit: format cũ {documents, metadatas, ids, count} (toàn bộ)
+    - Có cursor hoặc limit: 1 trang {items, count, total, next_cursor}; gửi lại
+      next_cursor để lấy trang tiếp theo (null = hết)
+    Corpus lớn: dùng phân trang hoặc GET /api/documents/export (NDJSON).
+    """
+    user_id, course_id = await run_blocking(authorized_segment, authorization, course_id=course_id)
     try:
-        return vector_db.get_all_documents()
+        if cursor is None and limit is None:
+            return await run_blocking(vector_segments.get_all_documents, user_id=user_id, course_id=course_id)
+        return await run_blocking(
+            vector_segments.get_documents_page,
+            cursor, limit, include_embeddings, include_documents, max_text_chars,
+            user_id=user_id, course_id=course_id
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
+@app.get("/api/documents/export", tags=["RAG - Knowledge Base"])
+def export_documents(
+    include_embeddings: bool = False,
+    include_documents: bool = True,
+    max_text_chars: Optional[int] = None,
+    course_id: Optional[str] = None,
+    authorization: Optional[str] = Header(None)
+):
+    """Export documents (global + user theo token + course_id) dạng NDJSON (1 document / dòng, stream dần)"""
+    user_id, course_id = authorized_segment(authorization, course_id=course_id)
+    records = vector_segments.iter_documents(
+        include_embeddings=include_embeddings,
+        include_documents=include_documents,
+        max_text_chars=max_text_chars,
+        user_id=user_id,
+        course_id=course_id
+    )
+    return StreamingResponse(ndjson_lines(records), media_type="application/x-ndjson")
+
 @app.delete("/api/documents", tags=["RAG - Knowledge Base"])
-async def delete_all_documents():
-    """Xóa tất cả documents trong Vector Database"""
+async def delete_all_documents(
+    user_id: Optional[str] = None,
+    course_id: Optional[str] = None,
+    authorization: Optional[str] = Header(None)
+):
+    """
+    Xóa documents trong Vector Database
+    
+    Không có user_id / course_id: chỉ xóa segment global (như trước khi chia segment);
+    có user_id (phải khớp token) hoặc course_id: chỉ xóa segment đó
+    """
+    user_id, course_id = await run_blocking(authorized_segment, authorization, user_id, course_id, write=True)
     try:
-        return vector_db.delete_all()
+        return await run_blocking(vector_segments.delete_all, user_id=user_id, course_id=course_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
 @app.get("/api/documents/count", tags=["RAG - Knowledge Base"])
-async def get_document_count():
-    """Lấy số lượng documents trong Vector Database"""
-    return {"count": vector_db.get_count()}
+async def get_document_count(course_id: Optional[str] = None, authorization: Optional[str] = Header(None)):
+    """Lấy số lượng documents (global + user theo token + course_id)"""
+    user_id, course_id = await run_blocking(authorized_segment, authorization, course_id=course_id)
+    return {"count": await run_blocking(vector_segments.get_count, user_id, course_id)}
 
 @app.get("/api/rag/stats", tags=["RAG - Knowledge Base"])
-async def get_rag_stats():
-    """Lấy thống kê về RAG Knowledge Base"""
+async def get_rag_stats(course_id: Optional[str] = None, authorization: Optional[str] = Header(None)):
+    """Lấy thống kê về RAG Knowledge Base (global + user theo token + course_id)"""
+    user_id, course_id = await run_blocking(authorized_segment, authorization, course_id=course_id)
     try:
-        all_docs = vector_db.get_all_documents()
-        
-        # Thống kê theo category
-        categories = {}
-        for meta in all_docs['metadatas']:
-            cat = meta.get('category', 'unknown')
-            categories[cat] = categories.get(cat, 0) + 1
+        # Thống kê theo category từ metadata index (không materialise toàn bộ documents)
+        categories = await run_blocking(
+            vector_segments.get_metadata_counts, "category", user_id=user_id, course_id=course_id
+        )
         
         return {
-            "total_documents": all_docs['count'],
+            "total_documents": await run_blocking(vector_segments.get_count, user_id, course_id),
             "categories": categories,
             "status": "active"
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
+@app.get("/api/rag/segments", tags=["RAG - Knowledge Base"])
+async def get_segment_stats():
+    """Các segment (global / user / course) đang nằm trong RAM và bộ nhớ ước lượng so với budget"""
+    return await run_blocking(vector_segments.get_stats)
+
+@app.get("/api/rag/index/recall", tags=["RAG - Knowledge Base"])
+def get_index_recall_report(k: int = 5, sample_size: int = 100):
+    """
+    Báo cáo recall@k và latency của ANN index (IVF) so với brute-force
+    
+    Dùng để chọn IVF_N_PROBE phù hợp: mỗi dòng kết quả ứng với 1 giá trị n_probe.
+    Endpoint đồng bộ (threadpool): chấm điểm sample_size queries không chặn event loop.
+    """
+    try:
+        return vector_db.index_recall_report(k=k, sample_size=sample_size)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
+
+@app.get("/api/rag/quantization/report", tags=["RAG - Knowledge Base"])
+def get_quantization_report(k: int = 5, sample_size: int = 100):
+    """
+    Báo cáo bộ nhớ tiết kiệm và recall@k của chế độ int8 + re-rank trên corpus hiện tại
+    
+    Mỗi dòng kết quả ứng với 1 rerank_factor (số ứng viên re-rank = rerank_factor * k).
+    Endpoint đồng bộ (threadpool): chấm điểm sample_size queries không chặn event loop.
+    """
+    try:
+        return vector_db.quantization_report(k=k, sample_size=sample_size)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
+
+@app.get("/api/rag/embedding-cache/stats", tags=["RAG - Knowledge Base"])
+async def get_embedding_cache_stats():
+    """Thống kê hit/miss của embedding cache (RAM LRU + SQLite)"""
+    return embedding_cache.stats()
+
 @app.get("/api/models", tags=["Models"])
 async def list_models():
     """Liệt kê các model Gemini có sẵn"""
@@ -1880,8 +3270,8 @@ Sau phần giải thích, hãy đưa ra 2-3 ví dụ minh họa."""
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
 @app.post("/api/ai/ingest", response_model=IngestResponse, tags=["AI - Extended"])
-async def ingest_document(request: IngestRequest):
-    """Ingest tài liệu vào RAG Vector Database"""
+def ingest_document(request: IngestRequest):
+    """Ingest tài liệu vào RAG Vector Database (chạy trong threadpool, không chặn event loop)"""
     try:
         # Simplified: chỉ xử lý text content
         # Trong production cần thêm PDF, DOC parsing
@@ -1911,9 +3301,9 @@ async def ingest_document(request: IngestRequest):
         )
         
         return IngestResponse(
-            status="success",
-            message=f"Đã ingest {len(chunks)} chunks vào RAG database",
-            documents_added=len(chunks)
+            status=result['status'],
+            message=f"Đã ingest {result['count']}/{len(chunks)} chunks vào RAG database",
+            documents_added=result['count']
         )
     
     except Exception as e:
@@ -1923,20 +3313,21 @@ async def ingest_document(request: IngestRequest):
 # CREDENTIAL MANAGER INTEGRATION
 # ============================================================================
 
-# Import credential API router - DISABLED due to heavy dependencies
-# To enable: pip install sentence-transformers (takes long time)
+# Credential vector search API (/api/credentials/vector/..., /api/credentials/ai/select-credential)
+# Cần chromadb + sentence-transformers (model chỉ load ở request đầu tiên).
+# Tắt mặc định: các endpoint nhận user_id trong body, không kiểm tra token -> chỉ bật
+# (CREDENTIAL_API_ENABLED=true) khi service chạy sau gateway đã xác thực (Spring Boot)
 CREDENTIAL_API_AVAILABLE = False
-print("⚠️  Credential Manager API disabled (sentence-transformers too heavy)")
-print("   AI semantic search for credentials not available")
-
-# Uncomment below to enable (requires sentence-transformers)
-# try:
-#     from credential_api import router as credential_router
-#     app.include_router(credential_router)
-#     CREDENTIAL_API_AVAILABLE = True
-#     print("✅ Credential Manager API loaded")
-# except Exception as e:
-#     print(f"⚠️  Credential Manager API error: {e}")
+if os.getenv("CREDENTIAL_API_ENABLED", "false").lower() == "true":
+    try:
+        from credential_api import router as credential_router
+        app.include_router(credential_router)
+        CREDENTIAL_API_AVAILABLE = True
+        print("✅ Credential Manager API loaded")
+    except Exception as e:
+        print(f"⚠️  Credential Manager API error: {e}")
+else:
+    print("⚠️  Credential Manager API disabled (set CREDENTIAL_API_ENABLED=true to enable)")
 
 # ============================================================================
 # TEST TVU SCHEDULE ENDPOINT (For quick testing)
@@ -2406,12 +3797,16 @@ if __name__ == "__main__":
     print(f"📊 Vector DB Documents: {vector_db.get_count()}")
     if CREDENTIAL_API_AVAILABLE:
         print(f"🔐 Credential Manager: Enabled")
+    if UVICORN_WORKERS > 1:
+        print(f"👷 Workers: {UVICORN_WORKERS} (shared vector DB: {VECTOR_DB_SHARED})")
     print("=" * 60)
     
     uvicorn.run(
-        app,
+        # Nhiều worker cần import string để mỗi process tự import app
+        "main:app" if UVICORN_WORKERS > 1 else app,
         host="0.0.0.0",
         port=port,
         reload=False,
+        workers=UVICORN_WORKERS,
         log_level="info"
     )
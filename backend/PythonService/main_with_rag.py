@@ -4,12 +4,16 @@ Sử dụng Vector Database để tăng cường khả năng trả lời của A
 """
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import google.generativeai as genai
 import os
 from dotenv import load_dotenv
-from chroma_vector_service import get_chroma_service
+from chroma_vector_service import DEDUPE_MODES, IngestJobCompletedError, get_chroma_service
+from model_registry import get_model_registry
+from pagination import ndjson_lines
+from write_behind import WriteBehindQueue
 
 # Load environment variables
 load_dotenv()
@@ -39,6 +43,41 @@ app.add_middleware(
 # Initialize ChromaDB Vector Database
 vector_db = get_chroma_service()
 
+# Embedding model load lười; warm-up trong background để request đầu tiên không phải chờ load
+if os.getenv("EMBED_MODEL_WARMUP", "true").lower() == "true":
+    get_model_registry().warm_up()
+
+
+# Chặn documents gần trùng khi auto-save Q&A / thêm prompt: skip | merge | off (mặc định: off, phải bật rõ ràng)
+DEDUPE_MODE = (os.getenv("DEDUPE_MODE") or "off").lower()
+if DEDUPE_MODE != "off" and DEDUPE_MODE not in DEDUPE_MODES:
+    raise ValueError(f"Invalid DEDUPE_MODE: {DEDUPE_MODE}. Use off or one of {DEDUPE_MODES}")
+DEDUPE = None if DEDUPE_MODE == "off" else DEDUPE_MODE
+
+def save_qa_records(records: List[dict]):
+    """Ghi 1 batch Q&A vào ChromaDB (embed chung 1 lần)"""
+    result = vector_db.add_documents(
+        documents=[record["document"] for record in records],
+        metadatas=[record["metadata"] for record in records],
+        dedupe=DEDUPE
+    )
+    if result["status"] == "error":
+        raise RuntimeError(result["message"])
+
+# AUTO-SAVE Q&A chạy nền: response chat không phải chờ embed + ghi đĩa
+qa_writer = WriteBehindQueue(
+    save_qa_records,
+    max_size=int(os.getenv("QA_WRITE_QUEUE_SIZE", 1000)),
+    batch_size=int(os.getenv("QA_WRITE_BATCH_SIZE", 32)),
+    flush_interval=float(os.getenv("QA_WRITE_FLUSH_SECONDS", 2.0)),
+    name="qa-write-behind"
+)
+
+@app.on_event("shutdown")
+def flush_qa_writer():
+    """Ghi nốt các Q&A còn trong hàng đợi trước khi tắt server"""
+    qa_writer.close(timeout=30)
+
 # Pydantic models
 class ChatRequest(BaseModel):
     message: str
@@ -91,6 +130,18 @@ class PromptRAGRequest(BaseModel):
 class SearchRequest(BaseModel):
     query: str
     n_results: int = 5
+    mode: str = "vector"  # vector | lexical (BM25, không encode query) | hybrid (RRF)
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str]
+    n_results: int = 5
+
+class IngestRequest(BaseModel):
+    documents: List[str]
+    metadatas: Optional[List[dict]] = None
+    job_id: Optional[str] = None  # Gửi lại cùng job_id + documents để chạy tiếp sau lỗi
+    batch_size: Optional[int] = None
+    dedupe: Optional[str] = None  # skip | merge: bỏ documents gần trùng
 
 # Root endpoint
 @app.get("/", tags=["Health"])
@@ -122,7 +173,7 @@ async def chat(request: ChatRequest):
         
         # Nếu bật RAG, tìm kiếm context từ vector DB
         if request.use_rag and vector_db.get_count() > 0:
-            search_results = vector_db.search(request.message, n_results=3)
+            search_results = await vector_db.search_async(request.message, n_results=3)
             context_docs = search_results['documents']
             
             if context_docs:
@@ -140,21 +191,16 @@ Hãy trả lời câu hỏi dựa trên context được cung cấp. Nếu conte
         model = genai.GenerativeModel(request.model)
         response = model.generate_content(prompt)
         
-        # AUTO-SAVE: Lưu Q&A vào ChromaDB để cải thiện RAG
-        try:
-            qa_text = f"Q: {request.message}\nA: {response.text}"
-            vector_db.add_documents(
-                documents=[qa_text],
-                metadatas=[{
-                    "type": "qa",
-                    "category": "chat_history",
-                    "question": request.message[:100],  # Lưu 100 ký tự đầu
-                    "model": request.model
-                }]
-            )
-        except Exception as save_error:
-            # Không fail request nếu lưu lỗi
-            print(f"Warning: Failed to save Q&A to ChromaDB: {save_error}")
+        # AUTO-SAVE: Đưa Q&A vào hàng đợi ghi nền (hàng đợi đầy thì bỏ, không fail request)
+        qa_writer.submit({
+            "document": f"Q: {request.message}\nA: {response.text}",
+            "metadata": {
+                "type": "qa",
+                "category": "chat_history",
+                "question": request.message[:100],  # Lưu 100 ký tự đầu
+                "model": request.model
+            }
+        })
         
         return ChatResponse(
             response=response.text,
@@ -198,12 +244,13 @@ async def add_rag_prompt(request: PromptRAGRequest):
         # Thêm vào vector DB
         result = vector_db.add_documents(
             documents=[request.prompt],
-            metadatas=[metadata]
+            metadatas=[metadata],
+            dedupe=DEDUPE
         )
         
         return {
             "status": "success",
-            "message": "Đã thêm prompt vào RAG knowledge base",
+            "message": "Prompt đã có trong RAG knowledge base" if result.get("skipped") else "Đã thêm prompt vào RAG knowledge base",
             "prompt": request.prompt,
             "category": request.category,
             "tags": request.tags,
@@ -244,43 +291,178 @@ async def search_documents(request: SearchRequest):
     Tìm kiếm documents tương tự trong Vector Database
     """
     try:
-        results = vector_db.search(request.query, request.n_results)
+        results = await vector_db.search_async(request.query, request.n_results, mode=request.mode)
+        items = [
+            {
+                "document": doc,
+                "distance": dist,
+                "metadata": meta,
+                "id": doc_id
+            }
+            for doc, dist, meta, doc_id in zip(
+                results['documents'],
+                results['distances'],
+                results['metadatas'],
+                results['ids']
+            )
+        ]
+        for item, score in zip(items, results.get('scores', [])):
+            item["score"] = score
         return {
             "query": request.query,
+            "mode": request.mode,
+            "results": items,
+            "count": len(results['documents'])
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Lỗi khi tìm kiếm: {str(e)}"
+        )
+
+@app.post("/api/documents/search/batch", tags=["RAG - Knowledge Base"])
+def search_documents_batch(request: BatchSearchRequest):
+    """
+    Tìm kiếm nhiều queries trong 1 request (encode và query ChromaDB theo batch)
+    """
+    try:
+        batch_results = vector_db.search_batch(request.queries, request.n_results)
+        return {
             "results": [
                 {
-                    "document": doc,
-                    "distance": dist,
-                    "metadata": meta,
-                    "id": doc_id
+                    "query": query,
+                    "results": [
+                        {
+                            "document": doc,
+                            "distance": dist,
+                            "metadata": meta,
+                            "id": doc_id
+                        }
+                        for doc, dist, meta, doc_id in zip(
+                            results['documents'],
+                            results['distances'],
+                            results['metadatas'],
+                            results['ids']
+                        )
+                    ],
+                    "count": len(results['documents'])
                 }
-                for doc, dist, meta, doc_id in zip(
-                    results['documents'],
-                    results['distances'],
-                    results['metadatas'],
-                    results['ids']
-                )
+                for query, results in zip(request.queries, batch_results)
             ],
-            "count": len(results['documents'])
+            "count": len(batch_results)
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Lỗi khi tìm kiếm: {str(e)}"
         )
 
+@app.post("/api/documents/ingest", tags=["RAG - Knowledge Base"])
+def ingest_documents(request: IngestRequest):
+    """
+    Ingest số lượng lớn documents theo batch (encode song song, commit từng batch)
+    
+    Nếu bị lỗi giữa chừng, response có job_id + resume_from_batch: gửi lại cùng
+    job_id và documents để bỏ qua các batch đã commit.
+    """
+    metadatas = request.metadatas or [None] * len(request.documents)
+    try:
+        result = vector_db.ingest_stream(
+            ({"document": doc, "metadata": metadata} for doc, metadata in zip(request.documents, metadatas)),
+            batch_size=request.batch_size or int(os.getenv("INGEST_BATCH_SIZE", 64)),
+            workers=int(os.getenv("INGEST_WORKERS", 2)),
+            job_id=request.job_id,
+            dedupe=request.dedupe
+        )
+    except IngestJobCompletedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if result["status"] == "error":
+        raise HTTPException(status_code=500, detail=result)
+    return result
+
+@app.post("/api/rag/dedupe/compact", tags=["RAG - Knowledge Base"])
+def compact_duplicates(dry_run: bool = True):
+    """
+    Gộp các documents gần trùng đang có (SimHash + cosine >= DEDUPE_SIMILARITY)
+    
+    Mặc định dry_run=true: chỉ đếm; gọi với dry_run=false để xóa bản trùng.
+    """
+    return vector_db.compact_duplicates(dry_run=dry_run)
+
+@app.get("/api/documents/ingest/{job_id}", tags=["RAG - Knowledge Base"])
+async def get_ingest_job(job_id: str):
+    """Checkpoint của 1 job ingest (số batch / documents đã commit)"""
+    try:
+        job = vector_db.get_ingest_job(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Ingest job {job_id} not found")
+    return job
+
+@app.get("/api/rag/query-encoder/stats", tags=["RAG - Knowledge Base"])
+async def get_query_encoder_stats():
+    """Histogram kích thước batch và thời gian chờ của micro-batcher encode query"""
+    return vector_db.query_batcher.stats()
+
+@app.get("/api/rag/qa-writer/stats", tags=["RAG - Knowledge Base"])
+async def get_qa_writer_stats():
+    """Hàng đợi ghi nền Q&A: độ sâu, số record đã ghi / bị bỏ / lỗi"""
+    return qa_writer.stats()
+
+@app.get("/api/rag/embedding-models", tags=["RAG - Knowledge Base"])
+async def get_embedding_model_stats():
+    """Các embedding model đang load trong process (dùng chung giữa các service)"""
+    return get_model_registry().stats()
+
 @app.get("/api/documents", tags=["RAG - Knowledge Base"])
-async def get_all_documents():
-    """Lấy tất cả documents trong Vector Database"""
+def get_all_documents(
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_embeddings: bool = False,
+    include_documents: bool = True,
+    max_text_chars: Optional[int] = None
+):
+    """
+    Lấy documents trong Vector Database
+    
+    - Không có cursor/limit: format cũ {documents, metadatas, ids, count} (toàn bộ)
+    - Có cursor hoặc limit: 1 trang {items, count, total, next_cursor}; gửi lại
+      next_cursor để lấy trang tiếp theo (null = hết)
+    Collection lớn: dùng phân trang hoặc GET /api/documents/export (NDJSON).
+    """
     try:
-        results = vector_db.get_all_documents()
-        return results
+        if cursor is None and limit is None:
+            return vector_db.get_all_documents()
+        return vector_db.get_documents_page(cursor, limit, include_embeddings, include_documents, max_text_chars)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Lỗi khi lấy documents: {str(e)}"
         )
 
+@app.get("/api/documents/export", tags=["RAG - Knowledge Base"])
+def export_documents(
+    include_embeddings: bool = False,
+    include_documents: bool = True,
+    max_text_chars: Optional[int] = None
+):
+    """Export toàn bộ documents dạng NDJSON (1 document / dòng, đọc từ ChromaDB theo batch)"""
+    records = vector_db.iter_documents(
+        include_embeddings=include_embeddings,
+        include_documents=include_documents,
+        max_text_chars=max_text_chars
+    )
+    return StreamingResponse(ndjson_lines(records), media_type="application/x-ndjson")
+
 @app.delete("/api/documents", tags=["RAG - Knowledge Base"])
 async def delete_all_documents():
     """Xóa tất cả documents trong Vector Database"""
@@ -300,21 +482,21 @@ async def get_document_count():
     return {"count": count}
 
 @app.get("/api/rag/stats", tags=["RAG - Knowledge Base"])
-async def get_rag_stats():
+def get_rag_stats():
     """
     Lấy thống kê về RAG Knowledge Base
     """
     try:
-        all_docs = vector_db.get_all_documents()
-        
-        # Thống kê theo category
+        # Thống kê theo category (chỉ đọc metadata theo batch, không tải nội dung documents)
         categories = {}
-        for meta in all_docs['metadatas']:
-            cat = meta.get('category', 'unknown')
+        total = 0
+        for record in vector_db.iter_documents(include_documents=False):
+            cat = (record['metadata'] or {}).get('category', 'unknown')
             categories[cat] = categories.get(cat, 0) + 1
+            total += 1
         
         return {
-            "total_documents": all_docs['count'],
+            "total_documents": total,
             "categories": categories,
             "status": "active"
         }
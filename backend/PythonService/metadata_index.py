@@ -0,0 +1,201 @@
+"""
+Metadata Inverted Index
+Inverted index trên các trường metadata (category, tags, type, source) của SimpleVectorDB
+
+- Posting list: (field, value) -> các row ids có metadata khớp, append-only khi insert
+  (dùng chung giữa các bản copy(), không copy lại posting list lớn)
+- Filter `where` (cú pháp giống ChromaDB) thu hẹp tập ứng viên trước khi chấm điểm
+- Đếm theo giá trị (vd: số documents mỗi category) là O(#values), không quét corpus
+"""
+import copy
+from typing import Callable, Dict, List, Optional, Sequence
+import logging
+
+import numpy as np
+
+from append_only import GrowableArray, rows_before
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEXED_FIELDS = ("category", "tags", "type", "source")
+
+
+def metadata_values(value, split_commas: bool = False) -> List:
+    """
+    Các giá trị index của 1 trường metadata
+
+    Trường list trả về từng phần tử; với split_commas (dùng cho tags), chuỗi
+    "python, ai" được tách thành ["python", "ai"] như metadata ChromaDB.
+    """
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        values = list(value)
+    elif split_commas and isinstance(value, str):
+        values = [part.strip() for part in value.split(",")]
+    else:
+        values = [value]
+    return [v if isinstance(v, (str, int, float, bool)) else str(v) for v in values if v != ""]
+
+
+class _SharedRows:
+    """Posting lists dùng chung giữa các bản copy() của 1 MetadataIndex"""
+
+    __slots__ = ("postings", "end")
+
+    def __init__(self, fields: Sequence[str]):
+        self.postings: Dict[str, Dict[object, GrowableArray]] = {field: {} for field in fields}
+        # Số documents đã được index vào các posting list dùng chung
+        self.end = 0
+
+
+class MetadataIndex:
+    """Posting lists cho các trường metadata được index"""
+
+    def __init__(self, fields: Sequence[str] = DEFAULT_INDEXED_FIELDS):
+        """
+        Args:
+            fields: Các trường metadata được index
+        """
+        self.fields = tuple(fields)
+        self._shared = _SharedRows(self.fields)
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def copy(self) -> "MetadataIndex":
+        """Bản sao O(1): add() trên bản sao chỉ append phía sau, index gốc chỉ đọc row < size của nó"""
+        return copy.copy(self)
+
+    def _detach(self):
+        """Tách khỏi posting lists dùng chung (đã bị 1 bản copy khác append tiếp), giữ các row < size"""
+        shared = _SharedRows(self.fields)
+        for field, values in self._shared.postings.items():
+            for value, posting in list(values.items()):
+                count = len(rows_before(posting.view(), self._size))
+                if count:
+                    shared.postings[field][value] = posting.truncated(count)
+        shared.end = self._size
+        self._shared = shared
+
+    def add(self, metadatas: Sequence[Dict]):
+        """
+        Index metadata của các documents mới (nối tiếp cuối corpus)
+
+        Append vào posting lists dùng chung: những bản copy() khác vẫn thấy đúng
+        trạng thái cũ vì chỉ đọc các row < size của chúng.
+        """
+        if self._shared.end != self._size:
+            self._detach()
+        new_rows: Dict[str, Dict[object, List[int]]] = {field: {} for field in self.fields}
+        for row, metadata in enumerate(metadatas, start=self._size):
+            metadata = metadata or {}
+            for field in self.fields:
+                # dict.fromkeys: bỏ giá trị trùng (vd tags lặp) để posting list không lặp row
+                values = metadata_values(metadata.get(field), split_commas=(field == "tags"))
+                for value in dict.fromkeys(values):
+                    new_rows[field].setdefault(value, []).append(row)
+
+        for field, values in new_rows.items():
+            field_postings = self._shared.postings[field]
+            for value, rows in values.items():
+                posting = field_postings.get(value)
+                if posting is None:
+                    posting = GrowableArray(dtype=np.int64)
+                    posting.append(rows)
+                    field_postings[value] = posting
+                else:
+                    posting.append(rows)
+        self._size += len(metadatas)
+        self._shared.end = self._size
+
+    def rebuild(self, metadatas: Sequence[Dict]):
+        """Dựng lại toàn bộ index (sau khi xóa documents, row ids thay đổi)"""
+        self._shared = _SharedRows(self.fields)
+        self._size = 0
+        self.add(metadatas)
+
+    def value_counts(self, field: str) -> Dict:
+        """Số documents cho từng giá trị của 1 trường được index"""
+        counts = {}
+        for value, posting in list(self._shared.postings[field].items()):
+            count = len(rows_before(posting.view(), self._size))
+            if count:
+                counts[value] = count
+        return counts
+
+    def _rows_for_value(self, field: str, value) -> np.ndarray:
+        posting = self._shared.postings[field].get(value)
+        if posting is None:
+            return np.zeros(0, dtype=np.int64)
+        return rows_before(posting.view(), self._size)
+
+    def rows(
+        self,
+        where: Dict,
+        get_metadatas: Optional[Callable[[], Sequence[Dict]]] = None
+    ) -> np.ndarray:
+        """
+        Row ids (đã sort) khớp filter `where`
+
+        Hỗ trợ: {"field": value}, {"field": {"$eq": v}}, {"field": {"$in": [...]}},
+        {"$and": [...]}, {"$or": [...]}. Trường list (tags) khớp nếu chứa giá trị.
+
+        Args:
+            where: Filter metadata
+            get_metadatas: Hàm trả về metadata theo row id, chỉ được gọi khi filter
+                có trường không được index (fallback quét tuần tự)
+        """
+        result: Optional[np.ndarray] = None
+        for key, condition in where.items():
+            if key == "$and":
+                parts = [self.rows(sub, get_metadatas) for sub in condition]
+                rows = parts[0] if parts else np.arange(self._size, dtype=np.int64)
+                for part in parts[1:]:
+                    rows = np.intersect1d(rows, part, assume_unique=True)
+            elif key == "$or":
+                parts = [self.rows(sub, get_metadatas) for sub in condition]
+                rows = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+            elif key in self._shared.postings:
+                rows = self._field_rows(key, condition)
+            elif get_metadatas is not None:
+                rows = self._scan(key, condition, get_metadatas())
+            else:
+                raise ValueError(f"Metadata field '{key}' is not indexed")
+            result = rows if result is None else np.intersect1d(result, rows, assume_unique=True)
+        if result is None:
+            return np.arange(self._size, dtype=np.int64)
+        return result
+
+    @staticmethod
+    def _scan(field: str, condition, metadatas: Sequence[Dict]) -> np.ndarray:
+        """Fallback cho trường không được index: quét metadata"""
+        return np.asarray(
+            [row for row, metadata in enumerate(metadatas)
+             if _matches((metadata or {}).get(field), condition)],
+            dtype=np.int64
+        )
+
+    def _field_rows(self, field: str, condition) -> np.ndarray:
+        if isinstance(condition, dict):
+            if "$eq" in condition:
+                return self._rows_for_value(field, condition["$eq"])
+            if "$in" in condition:
+                parts = [self._rows_for_value(field, v) for v in condition["$in"]]
+                return np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+            raise ValueError(f"Unsupported filter operator for '{field}': {list(condition)}")
+        return self._rows_for_value(field, condition)
+
+
+def _matches(value, condition) -> bool:
+    """So khớp 1 giá trị metadata với điều kiện filter"""
+    values = metadata_values(value)
+    if isinstance(condition, dict):
+        if "$eq" in condition:
+            return condition["$eq"] in values
+        if "$in" in condition:
+            return any(v in values for v in condition["$in"])
+        raise ValueError(f"Unsupported filter operator: {list(condition)}")
+    return condition in values
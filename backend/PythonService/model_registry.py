@@ -0,0 +1,239 @@
+"""
+Embedding Model Registry
+Registry dùng chung trong process cho các model SentenceTransformer
+
+- Load lười: model chỉ được load ở lần dùng đầu tiên (không tốn RAM / thời gian khởi động
+  nếu không có endpoint vector nào được gọi), các service dùng chung 1 instance
+- Warm-up: load trước trong background thread sau khi server khởi động
+- Unload: model không dùng quá idle_unload_seconds, hoặc khi RAM trống của máy thấp hơn
+  min_free_memory_mb (cần psutil), sẽ được giải phóng; lần dùng sau tự load lại
+- Backend: "torch" (SentenceTransformer) hoặc "onnx" (onnxruntime, int8, xem onnx_encoder.py);
+  onnx không khả dụng / export lỗi thì tự quay về torch
+"""
+import gc
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+import logging
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+
+
+class EmbeddingModelRegistry:
+    """Load 1 lần, dùng chung và unload các model SentenceTransformer"""
+
+    def __init__(
+        self,
+        idle_unload_seconds: float = 0,
+        min_free_memory_mb: float = 0,
+        check_interval: float = 30.0,
+        backend: str = "torch",
+        onnx_dir: str = "onnx_models",
+        onnx_quantize: bool = True,
+        onnx_threads: int = 0,
+        onnx_min_cosine: float = 0.98
+    ):
+        """
+        Args:
+            idle_unload_seconds: Unload model không được dùng trong khoảng này (0 = không bao giờ)
+            min_free_memory_mb: Unload các model đang không dùng khi RAM trống dưới mức này (0 = tắt)
+            check_interval: Chu kỳ (giây) kiểm tra idle / memory pressure
+            backend: "torch" hoặc "onnx"
+            onnx_dir: Thư mục cache các model đã export ONNX
+            onnx_quantize: Dùng graph int8 (dynamic quantization) thay vì fp32
+            onnx_threads: Số thread intra-op của onnxruntime (0 = mặc định)
+            onnx_min_cosine: Cosine tối thiểu giữa embeddings ONNX và PyTorch khi export
+        """
+        self.idle_unload_seconds = idle_unload_seconds
+        self.min_free_memory_mb = min_free_memory_mb
+        self.check_interval = check_interval
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.onnx_quantize = onnx_quantize
+        self.onnx_threads = onnx_threads
+        self.onnx_min_cosine = onnx_min_cosine
+        self._models: Dict[str, object] = {}
+        self._last_used: Dict[str, float] = {}
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+        self.loads = 0
+        self.unloads = 0
+
+    def get(self, name: str = DEFAULT_EMBEDDING_MODEL):
+        """Model đã load (load ở lần gọi đầu tiên; các thread gọi đồng thời chỉ load 1 lần)"""
+        with self._lock:
+            model = self._models.get(name)
+            if model is not None:
+                self._last_used[name] = time.monotonic()
+                return model
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                model = self._models.get(name)
+            if model is None:
+                model = self._load(name)
+                with self._lock:
+                    self._models[name] = model
+                    self.loads += 1
+            with self._lock:
+                self._last_used[name] = time.monotonic()
+        self._ensure_reaper()
+        return model
+
+    def _load(self, name: str):
+        if self.backend == "onnx":
+            from onnx_encoder import ONNX_AVAILABLE, load_onnx_encoder
+            if ONNX_AVAILABLE:
+                try:
+                    start = time.perf_counter()
+                    model = load_onnx_encoder(
+                        name,
+                        base_dir=self.onnx_dir,
+                        quantize=self.onnx_quantize,
+                        num_threads=self.onnx_threads,
+                        min_cosine=self.onnx_min_cosine
+                    )
+                    logger.info(f"Loaded ONNX embedding model {name} ({model.model_file}) in {time.perf_counter() - start:.1f}s")
+                    return model
+                except Exception as e:
+                    logger.warning(f"⚠️ ONNX backend failed for {name}, falling back to PyTorch: {e}")
+            else:
+                logger.warning("⚠️ onnxruntime/transformers not installed, falling back to PyTorch")
+
+        # Import lười: sentence_transformers kéo theo torch (mất vài giây)
+        from sentence_transformers import SentenceTransformer
+
+        start = time.perf_counter()
+        model = SentenceTransformer(name)
+        logger.info(f"Loaded embedding model {name} in {time.perf_counter() - start:.1f}s")
+        return model
+
+    def is_loaded(self, name: str = DEFAULT_EMBEDDING_MODEL) -> bool:
+        with self._lock:
+            return name in self._models
+
+    def warm_up(self, names: Iterable[str] = (DEFAULT_EMBEDDING_MODEL,), background: bool = True):
+        """Load trước các model (mặc định trong background thread, không chặn startup)"""
+        names = list(names)
+
+        def load_all():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    logger.warning(f"⚠️ Warm-up of embedding model {name} failed: {e}")
+
+        if not background:
+            load_all()
+            return None
+        thread = threading.Thread(target=load_all, name="embedding-model-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def unload(self, name: str) -> bool:
+        """
+        Giải phóng 1 model
+
+        Service đang encode dở vẫn giữ tham chiếu tới instance cũ nên không bị lỗi;
+        bộ nhớ được thu hồi khi lần encode đó xong.
+        """
+        with self._lock:
+            model = self._models.pop(name, None)
+            self._last_used.pop(name, None)
+            if model is None:
+                return False
+            self.unloads += 1
+        del model
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+        logger.info(f"Unloaded embedding model {name}")
+        return True
+
+    def unload_idle(self, max_idle_seconds: float) -> List[str]:
+        """Unload các model không được dùng trong max_idle_seconds giây"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [name for name, used in self._last_used.items() if now - used >= max_idle_seconds]
+        return [name for name in idle if self.unload(name)]
+
+    def under_memory_pressure(self) -> bool:
+        if not PSUTIL_AVAILABLE or self.min_free_memory_mb <= 0:
+            return False
+        return psutil.virtual_memory().available < self.min_free_memory_mb * 1024 * 1024
+
+    def _ensure_reaper(self):
+        """Thread nền unload model idle / khi thiếu RAM (chỉ chạy nếu có cấu hình)"""
+        if self._reaper is not None or (self.idle_unload_seconds <= 0 and self.min_free_memory_mb <= 0):
+            return
+        with self._lock:
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, name="embedding-model-reaper", daemon=True)
+                self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                if self.under_memory_pressure():
+                    # Thiếu RAM: bỏ các model không được dùng trong chu kỳ vừa rồi
+                    self.unload_idle(self.check_interval)
+                elif self.idle_unload_seconds > 0:
+                    self.unload_idle(self.idle_unload_seconds)
+            except Exception as e:
+                logger.warning(f"⚠️ Embedding model reaper error: {e}")
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "loaded": {
+                    name: {
+                        "idle_seconds": round(now - self._last_used[name], 1),
+                        "implementation": type(model).__name__
+                    }
+                    for name, model in self._models.items()
+                },
+                "loads": self.loads,
+                "unloads": self.unloads,
+                "idle_unload_seconds": self.idle_unload_seconds,
+                "min_free_memory_mb": self.min_free_memory_mb
+            }
+
+
+# Singleton instance (lock: các service khởi tạo đồng thời vẫn dùng chung 1 registry)
+_model_registry = None
+_model_registry_lock = threading.Lock()
+
+
+def get_model_registry() -> EmbeddingModelRegistry:
+    """Get or create singleton instance"""
+    global _model_registry
+    with _model_registry_lock:
+        if _model_registry is None:
+            _model_registry = EmbeddingModelRegistry(
+                idle_unload_seconds=float(os.getenv("EMBED_MODEL_IDLE_UNLOAD_SECONDS", 0)),
+                min_free_memory_mb=float(os.getenv("EMBED_MODEL_MIN_FREE_MEMORY_MB", 0)),
+                backend=os.getenv("EMBED_MODEL_BACKEND", "torch").lower(),
+                onnx_dir=os.getenv("EMBED_ONNX_DIR", "onnx_models"),
+                onnx_quantize=os.getenv("EMBED_ONNX_QUANTIZE", "true").lower() == "true",
+                onnx_threads=int(os.getenv("EMBED_ONNX_THREADS", 0)),
+                onnx_min_cosine=float(os.getenv("EMBED_ONNX_MIN_COSINE", 0.98))
+            )
+        return _model_registry
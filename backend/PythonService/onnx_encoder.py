@@ -0,0 +1,241 @@
+"""
+ONNX Sentence Encoder
+Chạy model SentenceTransformer (MiniLM đa ngôn ngữ) bằng onnxruntime trên CPU
+
+- Export 1 lần: transformer của SentenceTransformer -> ONNX (batch / sequence động),
+  sau đó quantize_dynamic sang int8; lưu cùng tokenizer và cấu hình pooling
+- Các lần sau chỉ cần onnxruntime + tokenizer (không import torch)
+- Pooling giống SentenceTransformer (mean theo attention mask / cls / max, Normalize nếu có)
+- Khi export: so cosine giữa embeddings ONNX và PyTorch trên các câu mẫu,
+  từ chối model nếu thấp hơn min_cosine
+- encode() cùng interface với SentenceTransformer.encode (str -> 1D, list -> 2D)
+"""
+import json
+import os
+import time
+from typing import List, Optional, Union
+import logging
+
+import numpy as np
+
+try:
+    import onnxruntime as ort
+    from transformers import AutoTokenizer
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = "encoder_config.json"
+FP32_FILE = "model.onnx"
+INT8_FILE = "model.int8.onnx"
+
+# Câu mẫu (Việt + Anh) để kiểm tra ONNX khớp PyTorch khi export
+PROBE_SENTENCES = [
+    "Xem thời khóa biểu tuần này",
+    "Điểm thi môn Cấu trúc dữ liệu của tôi là bao nhiêu?",
+    "Machine Learning là một nhánh của trí tuệ nhân tạo.",
+    "Watch movies and TV shows",
+    "Gửi email cho giảng viên về bài tập lớn",
+    "FastAPI là framework Python hiện đại để xây dựng API.",
+    "check my grades",
+    "IT3100"
+]
+
+
+def model_dir_for(base_dir: str, model_name: str) -> str:
+    return os.path.join(base_dir, model_name.replace("/", "__"))
+
+
+def cosine_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Cosine similarity giữa từng cặp dòng của a và b"""
+    denom = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    return np.divide((a * b).sum(axis=1), denom, out=np.zeros(len(a), dtype=np.float32), where=denom > 0)
+
+
+class OnnxSentenceEncoder:
+    """Encode câu bằng graph ONNX đã export (fp32 hoặc int8)"""
+
+    def __init__(self, model_dir: str, quantized: bool = True, num_threads: int = 0):
+        """
+        Args:
+            model_dir: Thư mục do export_onnx_model() tạo
+            quantized: Dùng graph int8 (nếu có) thay vì fp32
+            num_threads: Số thread intra-op của onnxruntime (0 = mặc định: số core vật lý)
+        """
+        with open(os.path.join(model_dir, CONFIG_FILE), 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+        model_file = INT8_FILE if quantized and self.config.get("int8_file") else FP32_FILE
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, model_file), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model_file = model_file
+        self.pooling = self.config["pooling"]
+        self.normalize = self.config["normalize"]
+        self.max_seq_length = self.config["max_seq_length"]
+        self.dimension = self.config["dimension"]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        show_progress_bar: bool = False,
+        convert_to_numpy: bool = True,
+        **kwargs
+    ) -> np.ndarray:
+        """Embeddings float32: str -> (dim,), list -> (n, dim)"""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        embeddings = np.empty((len(sentences), self.dimension), dtype=np.float32)
+        # Gom câu dài gần nhau vào cùng batch để ít padding (như SentenceTransformer)
+        order = np.argsort([-len(sentence) for sentence in sentences], kind='stable')
+        for start in range(0, len(sentences), batch_size):
+            rows = order[start:start + batch_size]
+            embeddings[rows] = self._encode_batch([sentences[i] for i in rows])
+        return embeddings[0] if single else embeddings
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        tokens = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="np"
+        )
+        feeds = {name: tokens[name].astype(np.int64) for name in self.input_names}
+        token_embeddings = self.session.run(None, feeds)[0]
+        mask = tokens["attention_mask"].astype(np.float32)[:, :, None]
+
+        if self.pooling == "cls":
+            pooled = token_embeddings[:, 0]
+        elif self.pooling == "max":
+            pooled = np.where(mask > 0, token_embeddings, -1e9).max(axis=1)
+        else:
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if self.normalize:
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.astype(np.float32)
+
+
+def export_onnx_model(
+    model_name: str,
+    model_dir: str,
+    quantize: bool = True,
+    min_cosine: float = 0.98,
+    opset: int = 14
+) -> dict:
+    """
+    Export SentenceTransformer sang ONNX (+ int8) và kiểm tra độ khớp với PyTorch
+
+    Cần torch + sentence_transformers (chỉ lúc export).
+
+    Returns:
+        Cấu hình đã lưu (kèm min cosine so với PyTorch)
+
+    Raises:
+        ValueError: Pooling không hỗ trợ, hoặc embeddings lệch quá min_cosine
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    start = time.perf_counter()
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0].auto_model.eval()
+    pooling = st_model[1].get_pooling_mode_str()
+    if pooling not in ("mean", "cls", "max"):
+        raise ValueError(f"Unsupported pooling mode for ONNX export: {pooling}")
+
+    os.makedirs(model_dir, exist_ok=True)
+    sample = st_model.tokenizer(["xin chào"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+    class TokenEmbeddings(torch.nn.Module):
+        """Bọc transformer: inputs theo vị trí -> last_hidden_state"""
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["token_embeddings"]}
+    fp32_path = os.path.join(model_dir, FP32_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer),
+            tuple(sample[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["token_embeddings"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            do_constant_folding=True
+        )
+    if quantize:
+        quantize_dynamic(fp32_path, os.path.join(model_dir, INT8_FILE), weight_type=QuantType.QInt8)
+    st_model.tokenizer.save_pretrained(model_dir)
+
+    config = {
+        "model_name": model_name,
+        "pooling": pooling,
+        "normalize": any(type(module).__name__ == "Normalize" for module in st_model),
+        "max_seq_length": st_model.max_seq_length,
+        "dimension": st_model.get_sentence_embedding_dimension(),
+        "int8_file": INT8_FILE if quantize else None
+    }
+    config_path = os.path.join(model_dir, CONFIG_FILE)
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+    # So khớp với PyTorch trên câu mẫu (dùng graph sẽ chạy thật: int8 nếu có)
+    reference = st_model.encode(PROBE_SENTENCES, convert_to_numpy=True)
+    encoded = OnnxSentenceEncoder(model_dir, quantized=quantize).encode(PROBE_SENTENCES)
+    config["min_cosine_vs_torch"] = float(cosine_rows(reference, encoded).min())
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+    if config["min_cosine_vs_torch"] < min_cosine:
+        os.remove(config_path)
+        raise ValueError(
+            f"ONNX embeddings diverge from PyTorch: min cosine "
+            f"{config['min_cosine_vs_torch']:.4f} < {min_cosine}"
+        )
+    logger.info(
+        f"Exported {model_name} to ONNX in {time.perf_counter() - start:.1f}s "
+        f"(min cosine vs PyTorch {config['min_cosine_vs_torch']:.4f})"
+    )
+    return config
+
+
+def load_onnx_encoder(
+    model_name: str,
+    base_dir: str = "onnx_models",
+    quantize: bool = True,
+    num_threads: int = 0,
+    min_cosine: float = 0.98
+) -> OnnxSentenceEncoder:
+    """Encoder ONNX cho model_name, export lần đầu nếu chưa có trong base_dir"""
+    model_dir = model_dir_for(base_dir, model_name)
+    config_path = os.path.join(model_dir, CONFIG_FILE)
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        # Export cũ không có bản int8 hoặc đã được kiểm tra với ngưỡng lỏng hơn -> export lại
+        if (quantize and not config.get("int8_file")) or config.get("min_cosine_vs_torch", 0) < min_cosine:
+            export_onnx_model(model_name, model_dir, quantize=quantize, min_cosine=min_cosine)
+    else:
+        export_onnx_model(model_name, model_dir, quantize=quantize, min_cosine=min_cosine)
+    return OnnxSentenceEncoder(model_dir, quantized=quantize, num_threads=num_threads)
@@ -0,0 +1,64 @@
+"""
+Pagination / Export helpers
+Dùng chung cho SimpleVectorDB (main.py) và ChromaVectorService
+
+- Cursor opaque: JSON nhỏ mã hóa base64 url-safe (client chỉ gửi lại nguyên văn)
+- Record export: bỏ embeddings / nội dung document hoặc cắt bớt text dài theo yêu cầu
+- NDJSON: mỗi record 1 dòng JSON, sinh dần (không dựng toàn bộ response trong RAM)
+"""
+import base64
+import binascii
+import json
+from typing import Dict, Iterable, Iterator, Optional
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(position: Dict) -> str:
+    raw = json.dumps(position, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Dict:
+    """Giải mã cursor (None/"" = trang đầu); cursor hỏng -> ValueError"""
+    if not cursor:
+        return {}
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        position = json.loads(raw.decode("utf-8"))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if not isinstance(position, dict):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return position
+
+
+def clamp_page_size(limit: Optional[int]) -> int:
+    return max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+
+
+def export_record(
+    doc_id: str,
+    document: str,
+    metadata: Dict,
+    embedding=None,
+    include_documents: bool = True,
+    max_text_chars: Optional[int] = None
+) -> Dict:
+    """1 document dạng dict để trả về / export (embedding chỉ có khi được truyền vào)"""
+    record = {"id": doc_id, "metadata": metadata}
+    if include_documents:
+        if max_text_chars is not None and len(document) > max_text_chars:
+            record["document"] = document[:max_text_chars]
+            record["truncated"] = True
+        else:
+            record["document"] = document
+    if embedding is not None:
+        record["embedding"] = [float(x) for x in embedding]
+    return record
+
+
+def ndjson_lines(records: Iterable[Dict]) -> Iterator[str]:
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + "\n"
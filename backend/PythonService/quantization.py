@@ -0,0 +1,166 @@
+"""
+Scalar Int8 Quantization
+Lưu embeddings dạng mã int8 (1 byte/chiều thay vì 4) cho vòng chấm điểm đầu của SimpleVectorDB
+
+- Train: chuẩn hóa L2 từng dòng, scale theo từng chiều = max|x| / 127
+- Vòng 1: chấm điểm xấp xỉ trên mã int8 (theo từng chunk để bộ nhớ tạm có giới hạn)
+- Vòng 2: SimpleVectorDB re-rank các ứng viên tốt nhất bằng vectors float32 đầy đủ
+  (nằm trong snapshot mmap trên đĩa, chỉ các dòng được re-rank mới bị đọc vào RAM)
+- Persist: scale + mã int8 lưu cạnh knowledge base (.int8.npz)
+"""
+import copy
+import os
+from typing import Optional
+import logging
+
+import numpy as np
+
+from vector_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+SCORE_CHUNK_ROWS = 256  # chunk nhỏ để bản float32 tạm nằm gọn trong cache CPU
+
+
+class Int8Quantizer:
+    """Mã hóa int8 đối xứng theo từng chiều trên vectors đã chuẩn hóa"""
+
+    def __init__(self, rerank_factor: int = 4, min_train_size: int = 1000):
+        """
+        Args:
+            rerank_factor: Số ứng viên re-rank = rerank_factor * n_results
+            min_train_size: Corpus nhỏ hơn mức này dùng float32 trực tiếp
+        """
+        self.rerank_factor = max(1, rerank_factor)
+        self.min_train_size = min_train_size
+        self.scale: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self.generation = 0
+        self._codes: Optional[np.ndarray] = None
+        self._size = 0
+
+    @property
+    def is_trained(self) -> bool:
+        return self.scale is not None
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        """Bộ nhớ của mã int8 đang dùng"""
+        return 0 if self._codes is None else self._size * self._codes.shape[1]
+
+    def copy(self) -> "Int8Quantizer":
+        """
+        Bản sao nông (copy-on-write)
+
+        Buffer mã dùng chung: add() trên bản sao chỉ ghi vào phần dư sau _size
+        (bản gốc không đọc tới) hoặc cấp phát buffer mới khi đầy.
+        """
+        return copy.copy(self)
+
+    def needs_training(self, total: int) -> bool:
+        """Có nên tính (lại) scale cho corpus kích thước total không"""
+        if total < self.min_train_size:
+            return False
+        return not self.is_trained or total >= 2 * self.trained_size
+
+    def _encode(self, embeddings: np.ndarray) -> np.ndarray:
+        normalized = normalize_rows(embeddings)
+        return np.clip(np.rint(normalized / self.scale), -127, 127).astype(np.int8)
+
+    def _append_codes(self, codes: np.ndarray):
+        """Append mã vào buffer (tăng capacity gấp đôi khi đầy)"""
+        needed = self._size + len(codes)
+        if self._codes is None or needed > len(self._codes):
+            capacity = max(needed, 2 * (len(self._codes) if self._codes is not None else 0), 64)
+            grown = np.empty((capacity, codes.shape[1]), dtype=np.int8)
+            if self._size:
+                grown[:self._size] = self._codes[:self._size]
+            self._codes = grown
+        self._codes[self._size:needed] = codes
+        self._size = needed
+
+    def train(self, embeddings: np.ndarray):
+        """Tính scale theo từng chiều và mã hóa toàn bộ corpus"""
+        normalized = normalize_rows(embeddings)
+        max_abs = np.abs(normalized).max(axis=0)
+        self.scale = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+        self.trained_size = len(normalized)
+        self._codes = None
+        self._size = 0
+        self._append_codes(np.clip(np.rint(normalized / self.scale), -127, 127).astype(np.int8))
+        logger.info(f"Trained int8 quantizer over {self.trained_size} vectors")
+
+    def reassign(self, embeddings: np.ndarray):
+        """Mã hóa lại toàn bộ với scale hiện tại (sau khi xóa/đổi thứ tự)"""
+        if not self.is_trained:
+            return
+        self._codes = None
+        self._size = 0
+        if len(embeddings):
+            self._append_codes(self._encode(embeddings))
+
+    def add(self, embeddings: np.ndarray):
+        """Mã hóa các vectors mới (nối tiếp cuối corpus); giá trị vượt scale bị clip"""
+        if not self.is_trained or len(embeddings) == 0:
+            return
+        self._append_codes(self._encode(embeddings))
+
+    def reset(self):
+        """Xóa quantizer (giữ cấu hình)"""
+        self.scale = None
+        self.trained_size = 0
+        self._codes = None
+        self._size = 0
+
+    def scores(self, query_embedding: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Cosine similarity xấp xỉ của query với các dòng (None = toàn bộ corpus)
+
+        Query được nhân sẵn với scale nên mỗi dòng chỉ cần 1 phép nhân vô hướng
+        với mã int8 (đổi sang float32 theo chunk). query_embedding dạng (m, dim)
+        cho nhiều queries cùng lúc, kết quả có shape (số dòng, m).
+        """
+        scaled_query = (normalize_rows(query_embedding) * self.scale).T
+        if rows is not None:
+            return self._codes[rows].astype(np.float32) @ scaled_query
+        result = np.empty((self._size,) + scaled_query.shape[1:], dtype=np.float32)
+        for start in range(0, self._size, SCORE_CHUNK_ROWS):
+            end = min(start + SCORE_CHUNK_ROWS, self._size)
+            result[start:end] = self._codes[start:end].astype(np.float32) @ scaled_query
+        return result
+
+    def save(self, path: str, generation: int = 0):
+        """Lưu scale + mã int8 của snapshot `generation` (ghi file tạm rồi os.replace)"""
+        if not self.is_trained:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            scale=self.scale,
+            codes=self._codes[:self._size],
+            trained_size=np.array(self.trained_size),
+            generation=np.array(generation)
+        )
+        os.replace(tmp_path, path)
+        self.generation = generation
+
+    def load(self, path: str) -> bool:
+        """Load quantizer đã lưu, trả về False nếu không có file"""
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            self.scale = data['scale']
+            self.trained_size = int(data['trained_size'])
+            self.generation = int(data['generation'])
+            codes = data['codes']
+        self._codes = None
+        self._size = 0
+        if len(codes):
+            self._append_codes(codes)
+        return True
@@ -0,0 +1,173 @@
+"""
+Query Micro-Batcher
+Gom các query đến cùng lúc thành 1 batch trước khi encode bằng embedding model local
+
+- Caller gửi 1 text, nhận Future (sync: encode(), async: await encode_async())
+- Worker thread chờ tối đa window_ms kể từ query đầu tiên hoặc tới khi đủ max_batch,
+  encode cả batch trong 1 lần gọi model rồi trả kết quả cho từng Future
+- Texts trùng nhau trong cùng batch chỉ encode 1 lần
+- Histogram kích thước batch và thời gian chờ trong hàng đợi (ms)
+"""
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Sequence
+import logging
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+QUEUE_WAIT_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    """Histogram đơn giản với các bucket cố định (giá trị <= bound)"""
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self) -> Dict:
+        buckets = {f"<={bound:g}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets["+inf"] = self.counts[-1]
+        return {
+            "buckets": buckets,
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max
+        }
+
+
+class QueryMicroBatcher:
+    """Micro-batching trước 1 hàm encode(List[str]) -> embeddings"""
+
+    def __init__(
+        self,
+        encode_fn: Callable[[List[str]], Sequence],
+        window_ms: float = 5.0,
+        max_batch: int = 32
+    ):
+        """
+        Args:
+            encode_fn: Hàm encode 1 list texts, trả về embeddings cùng thứ tự
+            window_ms: Thời gian tối đa chờ gom thêm query sau query đầu tiên của batch
+            max_batch: Số query tối đa mỗi lần encode
+        """
+        self.encode_fn = encode_fn
+        self.window = max(0.0, window_ms) / 1000
+        self.max_batch = max(1, max_batch)
+        self._queue: "queue.Queue" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait_ms = Histogram(QUEUE_WAIT_BUCKETS_MS)
+        self.encode_ms = Histogram(QUEUE_WAIT_BUCKETS_MS)
+
+    def _ensure_worker(self):
+        """Khởi động worker thread ở query đầu tiên"""
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="query-micro-batcher", daemon=True)
+                self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        """Đưa 1 query vào hàng đợi, Future trả về embedding của nó"""
+        future: Future = Future()
+        self._ensure_worker()
+        self._queue.put((text, future, time.perf_counter()))
+        return future
+
+    def encode(self, text: str, timeout: Optional[float] = None):
+        """Encode 1 query (chặn thread gọi tới khi batch chứa nó encode xong)"""
+        return self.submit(text).result(timeout)
+
+    async def encode_async(self, text: str):
+        """Encode 1 query mà không chặn event loop"""
+        return await asyncio.wrap_future(self.submit(text))
+
+    def close(self):
+        """Dừng worker thread sau khi xử lý hết các query đang chờ"""
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def _collect(self, first) -> tuple:
+        """Gom batch bắt đầu từ `first`; trả về (batch, stop)"""
+        batch = [first]
+        deadline = first[2] + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                # Hết window: vẫn lấy ngay các query đã xếp hàng (tích lại trong lúc encode batch trước)
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stop = self._collect(first)
+            # Bỏ các Future đã bị hủy (vd: client ngắt kết nối)
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            try:
+                embeddings = self.encode_fn(texts)
+            except Exception as e:
+                logger.error(f"❌ Query batch encode failed ({len(batch)} queries): {e}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+
+            position = {text: i for i, text in enumerate(texts)}
+            for text, future, _ in batch:
+                future.set_result(embeddings[position[text]])
+
+            with self._stats_lock:
+                self.batch_sizes.observe(len(batch))
+                self.encode_ms.observe((finished - started) * 1000)
+                for _, _, enqueued in batch:
+                    self.queue_wait_ms.observe((started - enqueued) * 1000)
+
+    def stats(self) -> Dict:
+        """Cấu hình + histogram kích thước batch, thời gian chờ hàng đợi và thời gian encode (ms)"""
+        with self._stats_lock:
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch": self.max_batch,
+                "pending": self._queue.qsize(),
+                "batch_size": self.batch_sizes.snapshot(),
+                "queue_wait_ms": self.queue_wait_ms.snapshot(),
+                "encode_ms": self.encode_ms.snapshot()
+            }
@@ -0,0 +1,463 @@
+"""
+Segmented Vector Store
+Chia knowledge base thành các segment theo user / course + 1 segment global dùng chung
+
+- Mỗi segment là 1 SimpleVectorDB riêng (snapshot + WAL + index riêng) trong SEGMENT_DIR
+- Search chỉ quét global + segment của user/course đang hỏi, không quét dữ liệu tenant khác
+- Segment được load lười khi cần tới và bị evict (LRU) khi vượt memory budget
+- Segment đang được dùng (pin) không bao giờ bị evict; segment global luôn nằm trong RAM
+"""
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+import logging
+
+from knowledge_store import KnowledgeLogStore
+from pagination import clamp_page_size, decode_cursor, encode_cursor
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_SEGMENT = "global"
+
+_SAFE_KEY = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def _key_part(value) -> str:
+    """
+    Phần ID trong tên segment, 1-1 với ID (2 ID khác nhau không bao giờ chung segment)
+
+    ID chỉ gồm [A-Za-z0-9_-] giữ nguyên (tên file segment cũ không đổi); ID khác được
+    mã hóa "~" + hex UTF-8 - ID giữ nguyên không bao giờ chứa "~" nên không thể trùng.
+    """
+    value = str(value)
+    if _SAFE_KEY.match(value):
+        return value
+    return "~" + value.encode("utf-8").hex()
+
+
+def segment_key(user_id=None, course_id=None) -> str:
+    """Segment chứa documents của user (ưu tiên) hoặc course; không có cả hai -> global"""
+    if user_id not in (None, ""):
+        return f"user_{_key_part(user_id)}"
+    if course_id not in (None, ""):
+        return f"course_{_key_part(course_id)}"
+    return GLOBAL_SEGMENT
+
+
+def segment_scope(user_id=None, course_id=None) -> List[str]:
+    """Các segment 1 request được phép tìm: global + segment của user + segment của course"""
+    keys = [GLOBAL_SEGMENT]
+    if user_id not in (None, ""):
+        keys.append(segment_key(user_id=user_id))
+    if course_id not in (None, ""):
+        keys.append(segment_key(course_id=course_id))
+    return keys
+
+
+class SegmentManager:
+    """Load lười + evict LRU các segment SimpleVectorDB theo memory budget"""
+
+    def __init__(
+        self,
+        factory: Callable[[str], object],
+        global_db,
+        segment_dir: str = "knowledge_segments",
+        memory_budget_bytes: int = 512 * 1024 * 1024
+    ):
+        """
+        Args:
+            factory: Hàm tạo SimpleVectorDB từ đường dẫn storage file của segment
+            global_db: SimpleVectorDB của segment global (knowledge_base.json hiện có)
+            segment_dir: Thư mục chứa các segment user/course
+            memory_budget_bytes: Tổng bộ nhớ ước lượng tối đa của các segment đã load
+        """
+        self.factory = factory
+        self.segment_dir = segment_dir
+        self.memory_budget_bytes = memory_budget_bytes
+        os.makedirs(segment_dir, exist_ok=True)
+        # LRU: segment dùng gần nhất nằm cuối
+        self._segments: "OrderedDict[str, object]" = OrderedDict({GLOBAL_SEGMENT: global_db})
+        self._usage: Dict[str, int] = {GLOBAL_SEGMENT: global_db.memory_usage()}
+        self._pins: Dict[str, int] = {}
+        # Segment đang được load (ngoài _lock): request khác cùng segment chờ Event thay vì load lần 2
+        self._loading: Dict[str, threading.Event] = {}
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.evictions = 0
+
+    @property
+    def global_db(self):
+        return self._segments[GLOBAL_SEGMENT]
+
+    def storage_file(self, key: str) -> str:
+        return os.path.join(self.segment_dir, f"{key}.json")
+
+    def segment_keys(self) -> List[str]:
+        """Mọi segment đang có (trong RAM hoặc trên đĩa), global đứng đầu"""
+        keys = set()
+        for name in os.listdir(self.segment_dir):
+            for suffix in (".docs.json", ".json.wal", ".json"):
+                if name.endswith(suffix):
+                    keys.add(name[:-len(suffix)])
+                    break
+        with self._lock:
+            keys.update(self._segments)
+        keys.discard(GLOBAL_SEGMENT)
+        return [GLOBAL_SEGMENT] + sorted(keys)
+
+    def exists(self, key: str) -> bool:
+        """Segment đã có dữ liệu (trong RAM hoặc trên đĩa)"""
+        with self._lock:
+            if key in self._segments:
+                return True
+        return KnowledgeLogStore(self.storage_file(key)).exists()
+
+    @contextmanager
+    def open_segment(self, key: str, create: bool = False) -> Iterator[Optional[object]]:
+        """
+        Lấy SimpleVectorDB của segment và pin nó trong suốt khối with
+
+        Segment chưa tồn tại trả về None (trừ khi create=True). Pin đảm bảo
+        không có 2 instance của cùng 1 segment ghi vào cùng WAL sau khi bị evict.
+        Load (snapshot, replay WAL, train index) chạy ngoài _lock: segment đang load
+        không chặn search / ghi trên các segment khác.
+        """
+        db = self._pin_or_load(key, create)
+        if db is None:
+            yield None
+            return
+        try:
+            yield db
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+                self._usage[key] = db.memory_usage()
+                self._evict()
+
+    def _pin_or_load(self, key: str, create: bool):
+        """Pin segment đã load; chưa load thì 1 thread load (các thread khác chờ), None nếu không tồn tại"""
+        while True:
+            with self._lock:
+                db = self._segments.get(key)
+                if db is not None:
+                    self._pin(key)
+                    return db
+                loading = self._loading.get(key)
+                if loading is None:
+                    if not (create or self.exists(key)):
+                        return None
+                    loading = self._loading[key] = threading.Event()
+                    leader = True
+                else:
+                    leader = False
+            if not leader:
+                # Thread khác đang load: chờ rồi kiểm tra lại (load lỗi thì thread này thử load)
+                loading.wait()
+                continue
+            try:
+                db = self.factory(self.storage_file(key))
+                with self._lock:
+                    self._segments[key] = db
+                    self._usage[key] = db.memory_usage()
+                    self.loads += 1
+                    self._pin(key)
+            finally:
+                with self._lock:
+                    del self._loading[key]
+                loading.set()
+            logger.info(f"Loaded segment {key} ({db.get_count()} documents)")
+            return db
+
+    def _pin(self, key: str):
+        """Đánh dấu segment đang dùng + LRU (gọi khi đang giữ _lock)"""
+        self._segments.move_to_end(key)
+        self._pins[key] = self._pins.get(key, 0) + 1
+        self._evict()
+
+    def _evict(self):
+        """Bỏ các segment ít dùng nhất (không pin, khác global) tới khi về dưới budget"""
+        for key in list(self._segments):
+            if sum(self._usage.values()) <= self.memory_budget_bytes:
+                return
+            if key == GLOBAL_SEGMENT or key in self._pins:
+                continue
+            # Reader đang giữ state cũ vẫn dùng được; dữ liệu đã nằm trong snapshot + WAL
+            del self._segments[key]
+            del self._usage[key]
+            self.evictions += 1
+            logger.info(f"Evicted segment {key}")
+
+    def add_documents(
+        self,
+        documents: List[str],
+        metadatas: List[Dict] = None,
+        ids: List[str] = None,
+        user_id=None,
+        course_id=None,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        dedupe: Optional[str] = None
+    ) -> Dict:
+        """
+        Thêm documents vào segment của user/course (hoặc global), ghi user_id/course_id vào metadata
+
+        dedupe (skip / merge) chỉ so với documents trong cùng segment đó.
+        """
+        key = segment_key(user_id, course_id)
+        if metadatas is None:
+            metadatas = [{"source": "manual"} for _ in documents]
+        if key != GLOBAL_SEGMENT:
+            owner = {"user_id": str(user_id)} if user_id not in (None, "") else {"course_id": str(course_id)}
+            metadatas = [{**(metadata or {}), **owner} for metadata in metadatas]
+        with self.open_segment(key, create=True) as db:
+            result = db.add_documents(documents, metadatas, ids, on_progress=on_progress, dedupe=dedupe)
+        result["segment"] = key
+        return result
+
+    def get_count(self, user_id=None, course_id=None) -> int:
+        """Tổng số documents trong global + segment của user/course"""
+        total = 0
+        for key in segment_scope(user_id, course_id):
+            with self.open_segment(key) as db:
+                if db is not None:
+                    total += db.get_count()
+        return total
+
+    def get_all_documents(self, user_id=None, course_id=None) -> Dict:
+        """Tất cả documents của global + segment của user/course (format cũ, không phân trang)"""
+        merged = {"documents": [], "metadatas": [], "ids": [], "count": 0}
+        for key in segment_scope(user_id, course_id):
+            with self.open_segment(key) as db:
+                if db is None:
+                    continue
+                result = db.get_all_documents()
+                for field in ("documents", "metadatas", "ids"):
+                    merged[field].extend(result[field])
+        merged["count"] = len(merged["ids"])
+        return merged
+
+    def get_metadata_counts(self, field: str = "category", missing: str = "unknown", user_id=None, course_id=None) -> Dict:
+        """Số documents theo giá trị metadata, cộng dồn trên global + segment của user/course"""
+        counts = Counter()
+        for key in segment_scope(user_id, course_id):
+            with self.open_segment(key) as db:
+                if db is not None:
+                    counts.update(db.get_metadata_counts(field, missing))
+        return dict(counts)
+
+    def delete_all(self, user_id=None, course_id=None) -> Dict:
+        """
+        Xóa toàn bộ 1 segment: của user (ưu tiên) hoặc course, không có cả hai -> chỉ global
+
+        Không bao giờ lan sang segment của tenant khác.
+        """
+        key = segment_key(user_id, course_id)
+        cleared = []
+        with self.open_segment(key) as db:
+            if db is not None:
+                db.delete_all()
+                cleared.append(key)
+        return {"status": "success", "message": "All documents deleted", "segments": cleared}
+
+    def delete_documents(self, ids: List[str], user_id=None, course_id=None) -> Dict:
+        """Xóa documents theo IDs trong segment của user/course (hoặc global)"""
+        key = segment_key(user_id, course_id)
+        with self.open_segment(key) as db:
+            if db is None:
+                return {"status": "success", "deleted": 0}
+            return db.delete_documents(ids)
+
+    def search(
+        self,
+        query: str,
+        n_results: int = 5,
+        where: Optional[Dict] = None,
+        mode: str = "vector",
+        user_id=None,
+        course_id=None
+    ) -> Dict:
+        """
+        Tìm trên global + segment của user/course rồi trộn kết quả
+
+        Query chỉ được embed 1 lần và dùng chung cho mọi segment. Trộn theo
+        distance (vector) hoặc theo score (BM25 / RRF của từng segment).
+        Kết quả có thêm "segments": segment chứa từng document.
+        """
+        with ExitStack() as stack:
+            dbs = []
+            for key in segment_scope(user_id, course_id):
+                db = stack.enter_context(self.open_segment(key))
+                if db is not None and db.get_count():
+                    dbs.append((key, db))
+
+            query_embedding = None
+            if dbs and mode != "lexical" and n_results > 0:
+                query_embedding = self.global_db.embed_query(query)
+
+            hits = []
+            for key, db in dbs:
+                results = db.search(query, n_results, where=where, mode=mode, query_embedding=query_embedding)
+                for i in range(len(results["ids"])):
+                    hits.append({
+                        "segment": key,
+                        "id": results["ids"][i],
+                        "document": results["documents"][i],
+                        "metadata": results["metadatas"][i],
+                        "distance": results["distances"][i],
+                        "score": results["scores"][i] if "scores" in results else None
+                    })
+
+        if mode == "vector":
+            hits.sort(key=lambda hit: hit["distance"])
+        else:
+            hits.sort(key=lambda hit: hit["score"], reverse=True)
+        hits = hits[:max(0, n_results)]
+
+        merged = {
+            "documents": [hit["document"] for hit in hits],
+            "distances": [hit["distance"] for hit in hits],
+            "metadatas": [hit["metadata"] for hit in hits],
+            "ids": [hit["id"] for hit in hits],
+            "segments": [hit["segment"] for hit in hits]
+        }
+        if mode != "vector":
+            merged["scores"] = [hit["score"] for hit in hits]
+        return merged
+
+    def search_batch(
+        self,
+        queries: List[str],
+        n_results: int = 5,
+        where: Optional[Dict] = None,
+        user_id=None,
+        course_id=None
+    ) -> List[Dict]:
+        """
+        Nhiều queries trên global + segment của user/course
+
+        Queries được embed 1 lần (dùng chung cho mọi segment), kết quả của từng
+        query được trộn theo distance như search().
+        """
+        with ExitStack() as stack:
+            dbs = []
+            for key in segment_scope(user_id, course_id):
+                db = stack.enter_context(self.open_segment(key))
+                if db is not None and db.get_count():
+                    dbs.append((key, db))
+
+            hits = [[] for _ in queries]
+            if dbs and queries and n_results > 0:
+                query_embeddings = self.global_db.embed_queries(queries)
+                for key, db in dbs:
+                    batch = db.search_batch(queries, n_results, where=where, query_embeddings=query_embeddings)
+                    for query_hits, results in zip(hits, batch):
+                        query_hits.extend(
+                            (results["distances"][i], key, results["ids"][i], results["documents"][i], results["metadatas"][i])
+                            for i in range(len(results["ids"]))
+                        )
+
+        merged = []
+        for query_hits in hits:
+            query_hits.sort(key=lambda hit: hit[0])
+            query_hits = query_hits[:max(0, n_results)]
+            merged.append({
+                "documents": [hit[3] for hit in query_hits],
+                "distances": [hit[0] for hit in query_hits],
+                "metadatas": [hit[4] for hit in query_hits],
+                "ids": [hit[2] for hit in query_hits],
+                "segments": [hit[1] for hit in query_hits]
+            })
+        return merged
+
+    def get_documents_page(
+        self,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        include_embeddings: bool = False,
+        include_documents: bool = True,
+        max_text_chars: Optional[int] = None,
+        user_id=None,
+        course_id=None
+    ) -> Dict:
+        """
+        1 trang documents của global + segment của user/course, lần lượt từng segment
+
+        Cursor = segment đang đọc + cursor bên trong segment đó (xem SimpleVectorDB.get_documents_page).
+
+        Raises:
+            ValueError: Cursor không hợp lệ / không thuộc phạm vi của request
+        """
+        keys = segment_scope(user_id, course_id)
+        limit = clamp_page_size(limit)
+        position = decode_cursor(cursor)
+        segment = position.get("segment", keys[0])
+        if segment not in keys:
+            raise ValueError(f"Invalid cursor: {cursor}")
+        inner = position.get("cursor")
+        items = []
+        next_cursor = None
+        for key in keys[keys.index(segment):]:
+            with self.open_segment(key) as db:
+                page = None
+                if db is not None:
+                    page = db.get_documents_page(
+                        inner, limit - len(items), include_embeddings, include_documents, max_text_chars
+                    )
+            inner = None
+            if page is None:
+                continue
+            items.extend({**item, "segment": key} for item in page["items"])
+            if page["next_cursor"]:
+                next_cursor = encode_cursor({"segment": key, "cursor": page["next_cursor"]})
+                break
+            if len(items) >= limit:
+                following = keys[keys.index(key) + 1:]
+                if following:
+                    next_cursor = encode_cursor({"segment": following[0]})
+                break
+        return {
+            "items": items,
+            "count": len(items),
+            "total": self.get_count(user_id, course_id),
+            "next_cursor": next_cursor
+        }
+
+    def iter_documents(
+        self,
+        batch_size: int = 500,
+        include_embeddings: bool = False,
+        include_documents: bool = True,
+        max_text_chars: Optional[int] = None,
+        user_id=None,
+        course_id=None
+    ) -> Iterator[Dict]:
+        """Duyệt documents của global + segment của user/course (segment đang đọc được pin)"""
+        for key in segment_scope(user_id, course_id):
+            with self.open_segment(key) as db:
+                if db is None:
+                    continue
+                for record in db.iter_documents(batch_size, include_embeddings, include_documents, max_text_chars):
+                    yield {**record, "segment": key}
+
+    def get_stats(self) -> Dict:
+        """Các segment đang load, bộ nhớ ước lượng và số lần load/evict"""
+        with self._lock:
+            return {
+                "segment_dir": self.segment_dir,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "memory_usage_bytes": sum(self._usage.values()),
+                "loaded": {
+                    key: {
+                        "documents": db.get_count(),
+                        "memory_bytes": self._usage[key],
+                        "pinned": key in self._pins or key == GLOBAL_SEGMENT
+                    }
+                    for key, db in self._segments.items()
+                },
+                "loads": self.loads,
+                "evictions": self.evictions
+            }
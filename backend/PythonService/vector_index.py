@@ -0,0 +1,210 @@
+"""
+Approximate Nearest Neighbour Index
+IVF-flat (inverted file) trên ma trận embeddings NumPy của SimpleVectorDB
+
+- Train: spherical k-means chia corpus thành n_lists cụm (centroids)
+- Add: gán vector mới vào cụm gần nhất (cập nhật tăng dần, không cần train lại)
+- Search: chỉ chấm điểm các vectors trong n_probe cụm gần query nhất
+  (n_probe lớn -> recall cao hơn nhưng chậm hơn; n_probe = n_lists tương đương brute-force)
+- Persist: centroids + assignments lưu cạnh knowledge base (.ivf.npz)
+"""
+import copy
+import math
+import os
+from typing import List, Optional
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ASSIGN_CHUNK_ROWS = 8192
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Chuẩn hóa L2 từng dòng (dòng 0 giữ nguyên 0)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+class IVFFlatIndex:
+    """Inverted-file index với centroids k-means, danh sách đầy đủ (flat) trong mỗi cụm"""
+
+    def __init__(
+        self,
+        n_lists: int = 0,
+        n_probe: int = 8,
+        min_train_size: int = 1000,
+        retrain_growth: float = 4.0,
+        kmeans_iterations: int = 10,
+        max_train_samples: int = 50000
+    ):
+        """
+        Args:
+            n_lists: Số cụm (0 = tự chọn ~sqrt(N))
+            n_probe: Số cụm quét mặc định mỗi query
+            min_train_size: Corpus nhỏ hơn mức này dùng brute-force
+            retrain_growth: Train lại khi corpus lớn gấp bao nhiêu lần lúc train
+            kmeans_iterations: Số vòng lặp k-means
+            max_train_samples: Số vectors tối đa dùng để train centroids
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.retrain_growth = retrain_growth
+        self.kmeans_iterations = kmeans_iterations
+        self.max_train_samples = max_train_samples
+
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self.generation = 0  # Generation snapshot mà assignments đã lưu khớp với
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._lists: Optional[List[np.ndarray]] = None
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    @property
+    def size(self) -> int:
+        return len(self._assignments)
+
+    def copy(self) -> "IVFFlatIndex":
+        """
+        Bản sao nông (copy-on-write)
+
+        train/add/reassign chỉ gán lại thuộc tính bằng mảng mới, không sửa mảng
+        đang dùng chung, nên bản gốc vẫn search được trong lúc bản sao cập nhật.
+        """
+        return copy.copy(self)
+
+    def needs_training(self, total: int) -> bool:
+        """Có nên train (lại) centroids cho corpus kích thước total không"""
+        if total < self.min_train_size:
+            return False
+        if not self.is_trained:
+            return True
+        return total >= self.trained_size * self.retrain_growth
+
+    # ------------------------------------------------------------------
+    # Build
+    # ------------------------------------------------------------------
+
+    def _assign(self, normalized: np.ndarray) -> np.ndarray:
+        """Cụm gần nhất (cosine) cho từng vector đã chuẩn hóa"""
+        assignments = np.empty(len(normalized), dtype=np.int32)
+        for start in range(0, len(normalized), ASSIGN_CHUNK_ROWS):
+            chunk = normalized[start:start + ASSIGN_CHUNK_ROWS]
+            assignments[start:start + len(chunk)] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return assignments
+
+    def train(self, embeddings: np.ndarray, seed: int = 0):
+        """Train centroids bằng spherical k-means và gán lại toàn bộ corpus"""
+        normalized = normalize_rows(embeddings)
+        total = len(normalized)
+        n_lists = self.n_lists or int(math.sqrt(total))
+        n_lists = max(1, min(n_lists, total))
+
+        rng = np.random.default_rng(seed)
+        if total > self.max_train_samples:
+            sample = normalized[rng.choice(total, self.max_train_samples, replace=False)]
+        else:
+            sample = normalized
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            self.centroids = centroids
+            labels = self._assign(sample)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            empty = counts == 0
+            if empty.any():
+                # Cụm rỗng: khởi tạo lại bằng điểm ngẫu nhiên
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+            centroids = normalize_rows(sums)
+
+        self.centroids = centroids
+        self.trained_size = total
+        self._assignments = self._assign(normalized)
+        self._lists = None
+        logger.info(f"Trained IVF index: {n_lists} lists over {total} vectors")
+
+    def reassign(self, embeddings: np.ndarray):
+        """Gán lại toàn bộ vectors với centroids hiện tại (sau khi xóa/đổi thứ tự)"""
+        if not self.is_trained:
+            return
+        self._assignments = self._assign(normalize_rows(embeddings))
+        self._lists = None
+
+    def add(self, embeddings: np.ndarray):
+        """Gán các vectors mới (nối tiếp cuối corpus) vào cụm gần nhất"""
+        if not self.is_trained or len(embeddings) == 0:
+            return
+        new_assignments = self._assign(normalize_rows(embeddings))
+        self._assignments = np.concatenate([self._assignments, new_assignments])
+        self._lists = None
+
+    def reset(self):
+        """Xóa index (giữ cấu hình)"""
+        self.centroids = None
+        self.trained_size = 0
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._lists = None
+
+    # ------------------------------------------------------------------
+    # Search
+    # ------------------------------------------------------------------
+
+    def _inverted_lists(self) -> List[np.ndarray]:
+        """Danh sách row ids theo từng cụm (dựng lại lười sau mỗi lần add)"""
+        if self._lists is None:
+            order = np.argsort(self._assignments, kind='stable')
+            bounds = np.searchsorted(self._assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+        return self._lists
+
+    def candidates(self, query_embedding: np.ndarray, n_probe: Optional[int] = None) -> np.ndarray:
+        """Row ids trong n_probe cụm gần query nhất"""
+        n_probe = max(1, min(n_probe or self.n_probe, len(self.centroids)))
+        centroid_scores = self.centroids @ normalize_rows(query_embedding)
+        if n_probe < len(centroid_scores):
+            probes = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        else:
+            probes = np.arange(len(centroid_scores))
+        lists = self._inverted_lists()
+        return np.concatenate([lists[i] for i in probes])
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def save(self, path: str, generation: int = 0):
+        """Lưu centroids + assignments của snapshot `generation` (ghi file tạm rồi os.replace)"""
+        if not self.is_trained:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            centroids=self.centroids,
+            assignments=self._assignments,
+            trained_size=np.array(self.trained_size),
+            generation=np.array(generation)
+        )
+        os.replace(tmp_path, path)
+        self.generation = generation
+
+    def load(self, path: str) -> bool:
+        """Load index đã lưu, trả về False nếu không có file"""
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            self.centroids = data['centroids']
+            self._assignments = data['assignments'].astype(np.int32)
+            self.trained_size = int(data['trained_size'])
+            self.generation = int(data['generation'])
+        self._lists = None
+        return True
@@ -0,0 +1,163 @@
+"""
+Write-Behind Queue
+Ghi nền các record (vd: Q&A của chat) vào vector DB, không để request phải chờ
+
+- submit() không bao giờ chặn: hàng đợi có giới hạn, đầy thì bỏ record và đếm dropped
+- Worker thread gom tối đa batch_size record (hoặc chờ tối đa flush_interval giây kể từ
+  record đầu tiên) rồi gọi flush_fn 1 lần cho cả batch (embed chung 1 lần)
+- close() ghi nốt các record còn trong hàng đợi (gọi khi server shutdown)
+- stats(): độ sâu hàng đợi, số record đã ghi / bị bỏ / lỗi, histogram kích thước batch
+"""
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+import logging
+
+from query_batcher import BATCH_SIZE_BUCKETS, Histogram
+
+logger = logging.getLogger(__name__)
+
+# 1 lần flush = embed + ghi cả batch (Chroma / đĩa), lâu hơn nhiều so với chờ trong hàng đợi query
+FLUSH_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class WriteBehindQueue:
+    """Hàng đợi có giới hạn + worker ghi theo batch"""
+
+    def __init__(
+        self,
+        flush_fn: Callable[[List[Dict]], object],
+        max_size: int = 1000,
+        batch_size: int = 32,
+        flush_interval: float = 2.0,
+        name: str = "write-behind"
+    ):
+        """
+        Args:
+            flush_fn: Hàm ghi 1 batch record (vd: embed + add_documents)
+            max_size: Số record tối đa chờ ghi; vượt quá thì record mới bị bỏ
+            batch_size: Số record tối đa mỗi lần gọi flush_fn
+            flush_interval: Thời gian tối đa (giây) 1 record nằm chờ gom batch
+            name: Tên worker thread / log
+        """
+        self.flush_fn = flush_fn
+        self.max_size = max(1, max_size)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_interval)
+        self.name = name
+        self._queue: "queue.Queue" = queue.Queue(maxsize=self.max_size)
+        self._closing = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.flush_ms = Histogram(FLUSH_BUCKETS_MS)
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+
+    def submit(self, record: Dict) -> bool:
+        """Đưa 1 record vào hàng đợi; False nếu hàng đợi đầy / đang đóng (record bị bỏ)"""
+        if self._closing.is_set():
+            with self._stats_lock:
+                self.dropped += 1
+            return False
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+            logger.warning(f"⚠️ {self.name} queue full ({self.max_size}), dropping record")
+            return False
+        with self._stats_lock:
+            self.enqueued += 1
+        return True
+
+    def _collect(self) -> List[Dict]:
+        """Gom 1 batch: chờ record đầu tiên rồi gom thêm tới batch_size / hết flush_interval"""
+        try:
+            first = self._queue.get(timeout=self.flush_interval or 0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # Đang đóng: không chờ, chỉ lấy các record đã có
+                if remaining > 0 and not self._closing.is_set():
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[Dict]):
+        started = time.perf_counter()
+        try:
+            self.flush_fn(batch)
+        except Exception as e:
+            with self._stats_lock:
+                self.failed += len(batch)
+            logger.error(f"❌ {self.name} failed to write {len(batch)} records: {e}")
+        else:
+            with self._stats_lock:
+                self.written += len(batch)
+                self.batch_sizes.observe(len(batch))
+                self.flush_ms.observe((time.perf_counter() - started) * 1000)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch:
+                self._write(batch)
+            elif self._closing.is_set():
+                return
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Chờ tới khi mọi record đã submit được ghi xong (True) hoặc hết timeout (False)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout: Optional[float] = None):
+        """Ngừng nhận record mới, ghi nốt hàng đợi rồi dừng worker"""
+        self._closing.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+            if self._worker.is_alive():
+                logger.warning(f"⚠️ {self.name} closed with {self._queue.qsize()} records still pending")
+            self._worker = None
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {
+                "depth": self._queue.qsize(),
+                "max_size": self.max_size,
+                "batch_size": self.batch_size,
+                "flush_interval": self.flush_interval,
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "batches": self.batch_sizes.snapshot(),
+                "flush_ms": self.flush_ms.snapshot()
+            }